@@ -0,0 +1,145 @@
+"""
+Drives run_partitioned against the stub Neo4j endpoint and checks what the
+writers sent it.
+
+python -m unittest discover -s tests
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from werkzeug.serving import make_server
+from wikia_dstk.knowledge_graph import stub_neo4j
+from wikia_dstk.knowledge_graph.batch_writer import GraphBatchWriter, partition, run_partitioned
+from wikia_dstk.knowledge_graph.identity import NodeIdentityMap
+from wikia_dstk.knowledge_graph.infoboxes_to_graph import handle_doc
+
+
+def handle_page(writer, doc):
+    page = (u'Page', dict(wid=doc[u'wid'], name=doc[u'name']))
+    wiki = (u'Wiki', dict(wiki_id=doc[u'wid']))
+    writer.merge_node(*page)
+    writer.merge_node(*wiki)
+    writer.merge_relationship(u'involves', wiki, page)
+
+
+def wid_of(doc):
+    return doc[u'wid']
+
+
+class RunPartitionedTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = make_server(u'127.0.0.1', 0, stub_neo4j.app, threaded=True)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+        cls.graph_db = u'http://127.0.0.1:%d/' % cls.server.server_port
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def setUp(self):
+        for name in stub_neo4j.counts:
+            stub_neo4j.counts[name] = 0
+        stub_neo4j.statements_seen.clear()
+        self.tmp = tempfile.mkdtemp()
+        # two wikis on each of the two writers
+        self.wids = []
+        wid = 0
+        while len(self.wids) < 4:
+            wid += 1
+            if len([w for w in self.wids if partition(w, 2) == partition(wid, 2)]) < 2:
+                self.wids.append(wid)
+        self.docs = [dict(wid=wid, name=u'page %d' % i) for wid in self.wids for i in range(25)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def assertMatchesStub(self, totals):
+        self.assertEqual(stub_neo4j.counts[u'requests'], totals[u'requests'])
+        self.assertEqual(stub_neo4j.counts[u'statements'], totals[u'statements'])
+        self.assertEqual(stub_neo4j.counts[u'rows'], totals[u'nodes'] + totals[u'relationships'])
+
+    def test_one_request_per_writer(self):
+        totals = run_partitioned(self.graph_db, iter(self.docs), handle_page, wid_of, workers=2, batch_size=1000)
+        self.assertEqual(totals[u'docs'], 100)
+        self.assertEqual(totals[u'nodes'], 100 + 4)
+        self.assertEqual(totals[u'relationships'], 100)
+        # each writer sends its pages, wikis and relationships as three statements in one request
+        self.assertEqual(totals[u'requests'], 2)
+        self.assertEqual(totals[u'statements'], 6)
+        self.assertEqual(totals[u'dropped_nodes'] + totals[u'dropped_relationships'], 0)
+        self.assertMatchesStub(totals)
+
+    def test_small_batches(self):
+        totals = run_partitioned(self.graph_db, iter(self.docs), handle_page, wid_of, workers=2, batch_size=10)
+        self.assertEqual(totals[u'docs'], 100)
+        self.assertEqual(totals[u'relationships'], 100)
+        self.assertTrue(totals[u'requests'] >= (totals[u'nodes'] + totals[u'relationships']) / 10)
+        self.assertMatchesStub(totals)
+
+    def test_known_nodes_are_skipped(self):
+        path = os.path.join(self.tmp, u'ids.db')
+        first = run_partitioned(self.graph_db, iter(self.docs), handle_page, wid_of, workers=2,
+                                identities=NodeIdentityMap(path=path))
+        second = run_partitioned(self.graph_db, iter(self.docs), handle_page, wid_of, workers=2,
+                                 identities=NodeIdentityMap(path=path))
+        self.assertEqual(second[u'nodes'], 0)
+        # every page, and its wiki once per page
+        self.assertEqual(second[u'known'], 200)
+        self.assertEqual(second[u'relationships'], 100)
+        # relationships between known nodes are matched by ID
+        by_id = [rows for statement, rows in stub_neo4j.statements_seen.items() if u'WHERE id(a)' in statement]
+        self.assertEqual(sum(by_id), 100)
+        self.assertEqual(stub_neo4j.counts[u'rows'], first[u'nodes'] + first[u'relationships'] + 100)
+
+    def test_warm_replaces_stale_ids(self):
+        path = os.path.join(self.tmp, u'ids.db')
+        run_partitioned(self.graph_db, iter(self.docs), handle_page, wid_of, workers=2,
+                        identities=NodeIdentityMap(path=path))
+        # the stub exports no nodes, as a rebuilt database wouldn't
+        identities = NodeIdentityMap(path=path)
+        self.assertEqual(identities.warm(GraphBatchWriter(self.graph_db), {u'Page': [u'wid', u'name']},
+                                         wiki=self.wids[0]), 0)
+        totals = run_partitioned(self.graph_db, iter(self.docs), handle_page, wid_of, workers=2,
+                                 identities=identities)
+        # only the warmed wiki's pages are written again
+        self.assertEqual(totals[u'nodes'], 25)
+        self.assertEqual(totals[u'known'], 175)
+
+    def test_failed_batches_are_counted(self):
+        totals = run_partitioned(u'http://127.0.0.1:1/', iter(self.docs), handle_page, wid_of, workers=2,
+                                 retries=0)
+        self.assertEqual(totals[u'docs'], 100)
+        self.assertEqual(totals[u'nodes'] + totals[u'relationships'], 0)
+        self.assertEqual(totals[u'dropped_nodes'], 104)
+        self.assertEqual(totals[u'dropped_relationships'], 100)
+
+    def test_infoboxes(self):
+        docs = [{u'id': u'%d_%d' % (wid, i), u'wid': wid, u'title_en': u'Page %d' % i,
+                 u'infoboxes_txt': [u'box|Born|1970', u'box|Home town|springfield', u'no value', u'box| : |x']}
+                for wid in self.wids for i in range(5)]
+        totals = run_partitioned(self.graph_db, iter(docs), handle_doc, wid_of, workers=2)
+        self.assertEqual(totals[u'docs'], 20)
+        # a row per page with its ids, a Subject row per page, a row per wiki, and two objects per wiki
+        self.assertEqual(totals[u'nodes'], 20 + 20 + 4 + 8)
+        # two infobox keys and an involves per page, and an involves per box value
+        self.assertEqual(totals[u'relationships'], 20 * 3 + 20 * 2)
+        self.assertMatchesStub(totals)
+
+    def test_client_errors_are_not_retried(self):
+        writer = GraphBatchWriter(self.graph_db, retries=3)
+        writer.merge_relationship(u'', (u'Page', dict(wid=1, name=u'a')), (u'Page', dict(wid=1, name=u'b')))
+        writer.flush()
+        stats = writer.stats()
+        self.assertEqual(stats[u'requests'], 1)
+        self.assertEqual(stats[u'dropped_nodes'] + stats[u'dropped_relationships'], 1)
+
+
+if __name__ == u'__main__':
+    unittest.main()
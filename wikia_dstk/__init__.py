@@ -1,6 +1,8 @@
 import logging
 import os
+import threading
 from argparse import ArgumentParser
+from multiprocessing import TimeoutError
 
 logfile = u'/var/log/wikia_dstk.log'
 log_level = logging.INFO
@@ -79,3 +81,45 @@ def argstring_from_namespace(namespace, unknowns=[]):
     for key in argdict:
         arglist.append("--%s=%s" % (key.replace('_', '-'), str(argdict[key])))
     return " ".join(arglist + unknowns)
+
+
+class Future(object):
+    """
+    A result that will be set from another thread. Mirrors the parts of
+    multiprocessing.pool.AsyncResult the scripts use: ready, wait and get.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._value = None
+        self._error = None
+
+    def set_result(self, value):
+        self._value = value
+        self._event.set()
+
+    def set_exception(self, error):
+        self._error = error
+        self._event.set()
+
+    def ready(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        self._event.wait(timeout)
+
+    def get(self, timeout=None):
+        """
+        Block until the result is set, and return it
+
+        :type timeout: float
+        :param timeout: Seconds to wait before giving up
+
+        :rtype: object
+        :return: The result, or raises whatever exception was set instead
+        """
+        if not self._event.wait(timeout):
+            raise TimeoutError()
+        if self._error is not None:
+            raise self._error
+        return self._value
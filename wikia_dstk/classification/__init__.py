@@ -1,5 +1,9 @@
+import hashlib
 import logging
 import numpy as np
+import os
+from multiprocessing import Pool
+from scipy.sparse import issparse
 from sklearn.neighbors import KNeighborsClassifier
 from sklearn.svm import SVC
 from sklearn.tree import DecisionTreeClassifier
@@ -8,7 +12,9 @@ from sklearn.naive_bayes import GaussianNB
 from sklearn.lda import LDA
 from sklearn.qda import QDA
 from sklearn.linear_model import LogisticRegression
-from collections import OrderedDict, defaultdict
+from sklearn.decomposition import TruncatedSVD
+from sklearn.pipeline import Pipeline
+from collections import OrderedDict
 
 
 log_level = logging.INFO
@@ -34,44 +40,107 @@ wid_to_class = dict([(wid, idx) for idx, (label, wids) in enumerate(vertical_lab
 class_to_label = dict([(idx, label) for idx, (label, wids) in enumerate(vertical_labels.items())])
 
 
-def predict_ensemble(classifier_strings, training_vectors, vector_classes, test_vectors):
+# shared with forked workers by predict_ensemble
+_ensemble_data = None
+
+
+def _array_digest(sha, matrix):
+    """
+    Feeds a dense or sparse matrix's contents into a hash
+    """
+    arrays = [matrix.data, matrix.indices, matrix.indptr] if issparse(matrix) else [np.asarray(matrix)]
+    for array in arrays:
+        sha.update(str(array.dtype) + str(array.shape))
+        sha.update(np.ascontiguousarray(array).view(np.uint8))
+
+
+def _fit_predict(classifier_string):
+    """
+    Trains one classifier and predicts probabilities in a worker
+    :return: the classifier key and a (test rows, classes) probability matrix, its columns in the order of the
+             sorted training classes
+    :rtype: tuple
+    """
+    training_vectors, vector_classes, test_vectors, classes = _ensemble_data
+    if issparse(training_vectors):
+        clf = Classifiers.get_sparse(classifier_string, n_features=training_vectors.shape[1])
+    else:
+        clf = Classifiers.get(classifier_string)
+    classifier_name = Classifiers.classifier_keys_to_names[classifier_string]
+
+    logger.info(u"Training a %s classifier on %d instances..." % (classifier_name, training_vectors.shape[0]))
+    clf.fit(training_vectors, vector_classes)
+    logger.info(u"Predicting with %s for %d unknowns..." % (classifier_name, test_vectors.shape[0]))
+    probabilities = np.zeros((test_vectors.shape[0], len(classes)))
+    # a classifier only has columns for the classes it saw; a Pipeline keeps them on its last step
+    fitted = clf.steps[-1][1] if isinstance(clf, Pipeline) else clf
+    probabilities[:, np.searchsorted(classes, fitted.classes_)] = clf.predict_proba(test_vectors)
+    return classifier_string, probabilities
+
+
+def predict_ensemble(classifier_strings, training_vectors, vector_classes, test_vectors, processes=None,
+                     cache_dir=None):
     """
     Performs ensemble prediction for a set of classifiers listed by key name in Classifiers class
     :param classifier_strings: a non-empty list of classifier keys
     :type classifier_strings: list
-    :param training_vectors: a numpy array of training vectors
+    :param training_vectors: a numpy array or sparse matrix of training vectors
     :type training_vectors:class:`numpy.array`
     :param vector_classes: a list of numeric class ids for each vector, in order
     :type vector_classes: list
-    :param test_vectors: a numpy array of vectors to predict class for
+    :param test_vectors: a numpy array or sparse matrix of vectors to predict class for
     :type test_vectors:class:`numpy.array`
+    :param processes: how many classifiers to train at once; defaults to one per classifier
+    :type processes: int
+    :param cache_dir: where to keep each classifier's probabilities for this training and test set, so other
+                      combinations of the same classifiers can be evaluated without refitting
+    :type cache_dir: str
     :return: an ordered list of classes for each test vector row
     :rtype: list
     """
-    scores = defaultdict(lambda: defaultdict(list))
-    for classifier_string in classifier_strings:
-        clf = Classifiers.get(classifier_string)
-        classifier_name = Classifiers.classifier_keys_to_names[classifier_string]
-
-        logger.info(u"Training a %s classifier on %d instances..." % (classifier_name, len(training_vectors)))
-        clf.fit(training_vectors, vector_classes)
-        logger.info(u"Predicting with %s for %d unknowns..." % (classifier_name, len(test_vectors)))
-        prediction_probabilities = clf.predict_proba(test_vectors)
-        prediction_counts = defaultdict(int)
-        for i, p in enumerate(prediction_probabilities):
-            prediction_counts[class_to_label[list(p).index(max(p))]] += 1
-            scores[i][classifier_string].append(p)
-        logger.info((classifier_string, prediction_counts))
+    global _ensemble_data
+    classes = np.unique(vector_classes)
+    sha = hashlib.sha1()
+    _array_digest(sha, training_vectors)
+    _array_digest(sha, np.asarray(vector_classes))
+    _array_digest(sha, test_vectors)
+    data_hash = sha.hexdigest()
+
+    def cache_path(classifier_string):
+        return os.path.join(cache_dir, u"%s-%s.npy" % (classifier_string, data_hash))
+
+    probabilities = dict()
+    if cache_dir:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        for classifier_string in classifier_strings:
+            if os.path.exists(cache_path(classifier_string)):
+                logger.info(u"Using cached probabilities for %s" % classifier_string)
+                probabilities[classifier_string] = np.load(cache_path(classifier_string))
+
+    to_fit = [c for c in classifier_strings if c not in probabilities]
+    if to_fit:
+        _ensemble_data = (training_vectors, np.asarray(vector_classes), test_vectors, classes)
+        pool = Pool(processes=processes or len(to_fit))
+        try:
+            for classifier_string, classifier_probabilities in pool.imap_unordered(_fit_predict, to_fit):
+                probabilities[classifier_string] = classifier_probabilities
+                if cache_dir:
+                    np.save(cache_path(classifier_string), classifier_probabilities)
+        finally:
+            pool.terminate()
+            _ensemble_data = None
+
+    stacked = np.array([probabilities[c] for c in classifier_strings])  # (classifiers, rows, classes)
+    for classifier_string, classifier_probabilities in zip(classifier_strings, stacked):
+        counts = np.bincount(np.argmax(classifier_probabilities, axis=1), minlength=len(classes))
+        logger.info((classifier_string, dict([(class_to_label.get(c, c), int(n)) for c, n in zip(classes, counts)])))
 
     logger.info(u"%s Predictions" % (u"Finalizing" if len(classifier_strings) == 1 else u"Interpolating"))
-    prediction_counts = defaultdict(int)
-    predictions = []
-    for i in scores:
-        combined = (np.sum(scores[i].values(), axis=0) / float(len(scores[i])))[0]
-        predictions.append(list(combined).index(max(combined)))
-        prediction_counts[class_to_label[predictions[-1]]] += 1
-    logger.info(prediction_counts)
-    return predictions
+    predictions = classes[np.argmax(stacked.mean(axis=0), axis=1)]
+    counts = np.bincount(np.searchsorted(classes, predictions), minlength=len(classes))
+    logger.info(dict([(class_to_label.get(c, c), int(n)) for c, n in zip(classes, counts)]))
+    return predictions.tolist()
 
 
 class Classifiers():
@@ -104,6 +173,12 @@ class Classifiers():
         u"maxent": u"Maximum Entropy",
     }
 
+    # these fit and predict on scipy.sparse matrices without densifying them
+    sparse_capable = [u"knn", u"linear_svm", u"rbf_svm", u"maxent"]
+
+    # cheap enough to fit once per row for leave-one-out cross-validation
+    loo_capable = [u"knn", u"naive_bayes", u"decision_tree", u"maxent"]
+
     @classmethod
     def get(cls, val):
         """
@@ -114,6 +189,31 @@ class Classifiers():
 
         return apply(apply, cls.classifiers[cls.classifier_keys_to_names[val]])
 
+    @classmethod
+    def get_sparse(cls, val, n_components=300, n_features=None):
+        """
+        Instantiates a classifier that accepts sparse input. Classifiers that only
+        take dense arrays are fronted with a TruncatedSVD projection.
+        :param val: the classifier key
+        :type val: str
+        :param n_components: the number of dimensions to project dense-only classifiers' input to
+        :type n_components: int
+        :param n_features: the width of the input, which caps n_components
+        :type n_features: int
+        :return: a classifier or pipeline
+        :rtype: object
+        """
+        clf = cls.get(val)
+        if val in cls.sparse_capable:
+            return clf
+        if n_features is not None:
+            n_components = min(n_components, n_features - 1)
+        # a fixed max_features, like random_forest's, can't exceed the projection's width
+        max_features = clf.get_params().get(u'max_features')
+        if isinstance(max_features, int) and max_features > n_components:
+            clf.set_params(max_features=n_components)
+        return Pipeline([(u'svd', TruncatedSVD(n_components=n_components)), (u'clf', clf)])
+
     def __getattr__(self, item):
         return self.get(item)
 
@@ -0,0 +1,143 @@
+"""
+Versioned, on-disk classifier ensembles for classify_wiki.
+
+An artifact is a directory named for the hash of everything that determines
+training -- the labelled wikis, their features, the classifier keys and the
+SVD width -- holding:
+
+- vectorizer.pkl: the fitted TfidfVectorizer
+- one <classifier key>.pkl per classifier
+- meta.json: the class names, classifier order, hash and when it was built
+
+Models are written uncompressed with joblib, so loading memory-maps their
+numpy arrays instead of reading them into memory. Artifacts are written to
+a temporary directory and renamed into place, and a LATEST file names the
+most recently trained one. Training on a set that has already been trained
+on finds the existing artifact, skips the work and marks it the latest.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from collections import OrderedDict
+from sklearn.externals import joblib
+from . import logger
+
+ARTIFACT_DIR = os.getenv(u'CLASSIFIER_ARTIFACT_DIR', u'/mnt/classifier_artifacts/')
+LATEST = u'LATEST'
+META = u'meta.json'
+VECTORIZER = u'vectorizer.pkl'
+
+
+def training_hash(wid_to_class, wid_to_features, classifier_strings, svd_components):
+    """
+    Hashes everything that determines what training produces
+    :param wid_to_class: labelled wiki IDs to class names
+    :type wid_to_class: dict
+    :param wid_to_features: labelled wiki IDs to their feature strings
+    :type wid_to_features: dict
+    :param classifier_strings: classifier keys, in ensemble order
+    :type classifier_strings: list
+    :param svd_components: the SVD width for dense-only classifiers
+    :type svd_components: int
+    :return: a hex digest
+    :rtype: str
+    """
+    sha = hashlib.sha1()
+    sha.update(u"%s|%d\n" % (u",".join(classifier_strings), svd_components))
+    for wid in sorted(wid_to_features):
+        sha.update((u"%s,%s,%s\n" % (wid, wid_to_class[wid], wid_to_features[wid])).encode(u'utf8'))
+    return sha.hexdigest()
+
+
+def artifact_path(hsh, directory=ARTIFACT_DIR):
+    return os.path.join(directory, hsh)
+
+
+def exists(hsh, directory=ARTIFACT_DIR):
+    # meta.json is written last, so without it the artifact is incomplete
+    return os.path.exists(os.path.join(artifact_path(hsh, directory), META))
+
+
+def latest(directory=ARTIFACT_DIR):
+    """
+    :return: the path of the most recently built artifact, or None
+    :rtype: str
+    """
+    try:
+        with open(os.path.join(directory, LATEST)) as fl:
+            return artifact_path(fl.read().strip(), directory)
+    except IOError:
+        return None
+
+
+def mark_latest(hsh, directory=ARTIFACT_DIR):
+    """
+    Points LATEST at an artifact
+    :param hsh: the artifact's training hash
+    :type hsh: str
+    :param directory: where artifacts live
+    :type directory: str
+    :return: the artifact's path
+    :rtype: str
+    """
+    latest_tmp = os.path.join(directory, u"%s.tmp.%d" % (LATEST, os.getpid()))
+    with open(latest_tmp, u'w') as fl:
+        fl.write(hsh)
+    os.rename(latest_tmp, os.path.join(directory, LATEST))
+    return artifact_path(hsh, directory)
+
+
+def save(hsh, vectorizer, classifiers, classes, directory=ARTIFACT_DIR):
+    """
+    Writes an artifact and marks it the latest
+    :param hsh: the training hash
+    :type hsh: str
+    :param vectorizer: the fitted vectorizer
+    :type vectorizer: class:`sklearn.feature_extraction.text.TfidfVectorizer`
+    :param classifiers: classifier keys to fitted classifiers, in ensemble order
+    :type classifiers: class:`collections.OrderedDict`
+    :param classes: class names, indexed by the numeric labels the classifiers were fitted on
+    :type classes: list
+    :param directory: where artifacts live
+    :type directory: str
+    :return: the artifact's path
+    :rtype: str
+    """
+    path = artifact_path(hsh, directory)
+    tmp_path = u"%s.tmp.%d" % (path, os.getpid())
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    joblib.dump(vectorizer, os.path.join(tmp_path, VECTORIZER))
+    for classifier_string, clf in classifiers.items():
+        joblib.dump(clf, os.path.join(tmp_path, u"%s.pkl" % classifier_string))
+    with open(os.path.join(tmp_path, META), u'w') as fl:
+        json.dump(dict(hash=hsh, classes=classes, classifiers=classifiers.keys(), created=time.time()), fl)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+    mark_latest(hsh, directory)
+    logger.info(u"Saved classifier artifact to %s" % path)
+    return path
+
+
+def load(path, mmap_mode=u'r'):
+    """
+    Loads an artifact, memory-mapping its arrays
+    :param path: the artifact's directory
+    :type path: str
+    :param mmap_mode: how to map arrays, or None to read them into memory
+    :type mmap_mode: str
+    :return: the vectorizer, classifier keys to classifiers, and class names
+    :rtype: tuple
+    """
+    with open(os.path.join(path, META)) as fl:
+        meta = json.load(fl)
+    vectorizer = joblib.load(os.path.join(path, VECTORIZER), mmap_mode=mmap_mode)
+    classifiers = OrderedDict([(classifier_string,
+                                joblib.load(os.path.join(path, u"%s.pkl" % classifier_string), mmap_mode=mmap_mode))
+                               for classifier_string in meta[u'classifiers']])
+    return vectorizer, classifiers, meta[u'classes']
@@ -1,84 +1,148 @@
 import sys
 import time
 import numpy as np
-from . import logger, Classifiers
-from collections import OrderedDict, defaultdict
+from . import logger, Classifiers, artifacts
+from collections import OrderedDict
+from itertools import islice
 from sklearn.feature_extraction.text import TfidfVectorizer
 from argparse import ArgumentParser, FileType
 
 
 def get_args():
     ap = ArgumentParser(description=u"Trains a single or ensemble model and generates predictions")
+    ap.add_argument(u'--mode', dest=u'mode', default=u'all', choices=[u'all', u'train', u'predict'],
+                    help=u"Train and predict in one go, only train and save the model, "
+                         u"or only predict with a saved model")
+    ap.add_argument(u'--artifact-dir', dest=u'artifact_dir', default=artifacts.ARTIFACT_DIR,
+                    help=u"Where trained models are saved")
+    ap.add_argument(u'--artifact', dest=u'artifact', default=None,
+                    help=u"The saved model to predict with; defaults to the latest in --artifact-dir")
     ap.add_argument(u'--classifiers', dest=u'classifiers', default=[], action=u"append",
                     help=u"The classifiers to use; refer to Classifiers class for string keys")
     ap.add_argument(u'--infile', dest=u'infile', type=FileType(u'r'), default=sys.stdin,
-                    help=u"The data source for wikis and their features. Expects stdin by default.")
+                    help=u"The data source for wikis and their features. Expects stdin by default. "
+                         u"In predict mode, it's streamed in batches.")
     ap.add_argument(u'--class-file', dest=u'class_file', type=FileType(u'r'),
                     help=u"The CSV file correlating wikis to classes")
     ap.add_argument(u'--outfile', dest=u'outfile', type=FileType(u'w'), default=sys.stdout,
                     help=u"The output file, correlating wikis to their string vertical name. Defaults to stdout.")
+    ap.add_argument(u'--svd-components', dest=u'svd_components', type=int, default=300,
+                    help=u"Dimensions to project features to for classifiers that can't take sparse input")
+    ap.add_argument(u'--batch-size', dest=u'batch_size', type=int, default=10000,
+                    help=u"Unknown wikis to predict per predict_proba call")
     return ap.parse_args()
 
 
-def main():
-    start = time.time()
-    args = get_args()
-
-    if args.class_file:
-        wid_to_class = OrderedDict()
-        groups = OrderedDict()
-        for line in args.class_file:
-            splt = line.strip().split(',')
-            groups[splt[1]] = groups.get(splt[1], []) + [int(splt[0])]
-            wid_to_class[int(splt[0])] = splt[1]
-        classes = groups.keys()
-
-    logger.info(u"Loading CSV...")
-    lines = [line.decode(u'utf8').strip() for line in args.infile if line.strip()]
-    wid_to_features = OrderedDict([(int(splt[0]), u" ".join(splt[1:])) for splt in
-                                   [line.split(u',') for line in lines]
-                                   if int(splt[0]) in wid_to_class
-                                   ])
-
-    unknowns = OrderedDict([(int(splt[0]), u" ".join(splt[1:])) for splt in
-                            [line.split(u',') for line in lines]
-                            if int(splt[0]) not in wid_to_class
-                            ])
+def parse_line(line):
+    splt = line.decode(u'utf8').strip().split(u',')
+    return int(splt[0]), u" ".join(splt[1:])
+
+
+def train(args, wid_to_class, classes, wid_to_features):
+    """
+    Fits the vectorizer and ensemble, unless an artifact for the same training set already exists
+    :param args: the parsed arguments
+    :type args: class:`argparse.Namespace`
+    :param wid_to_class: labelled wiki IDs to class names
+    :type wid_to_class: dict
+    :param classes: class names, in label order
+    :type classes: list
+    :param wid_to_features: labelled wiki IDs to feature strings
+    :type wid_to_features: class:`collections.OrderedDict`
+    :return: the artifact's path
+    :rtype: str
+    """
+    hsh = artifacts.training_hash(wid_to_class, wid_to_features, args.classifiers, args.svd_components)
+    if artifacts.exists(hsh, args.artifact_dir):
+        logger.info(u"Already trained on this set as %s" % hsh)
+        return artifacts.mark_latest(hsh, args.artifact_dir)
 
     logger.info(u"Vectorizing...")
     vectorizer = TfidfVectorizer()
-    feature_keys, feature_rows = zip(*[(classes.index(wid_to_class[int(key)]), features)
-                                       for key, features in wid_to_features.items()
-                                       if int(key) in wid_to_class])
+    feature_keys, feature_rows = zip(*[(classes.index(wid_to_class[key]), features)
+                                       for key, features in wid_to_features.items()])
 
-    vectorizer.fit_transform(feature_rows)
-    logger.info(u"Vectorized feature rows")
-    training_vectors = vectorizer.transform(feature_rows).toarray()
+    training_vectors = vectorizer.fit_transform(feature_rows)
     logger.info(u"Vectorized training features")
 
     logger.info(u"Training %d classifiers" % len(args.classifiers))
 
-    classifiers = dict()
+    classifiers = OrderedDict()
     for classifier_string in args.classifiers:
-        clf = Classifiers.get(classifier_string)
+        clf = Classifiers.get_sparse(classifier_string, n_components=args.svd_components,
+                                     n_features=training_vectors.shape[1])
         classifier_name = Classifiers.classifier_keys_to_names[classifier_string]
 
-        logger.info(u"Training a %s classifier on %d instances..." % (classifier_name, len(training_vectors)))
+        logger.info(u"Training a %s classifier on %d instances..." % (classifier_name, training_vectors.shape[0]))
         clf.fit(training_vectors, feature_keys)
         classifiers[classifier_string] = clf
         logger.info(u"Trained.")
 
-    for counter, (wid, unknown) in enumerate(unknowns.items()):
-        prediction_matrix = [classifier.predict_proba(vectorizer.transform([unknown]).toarray())
-                             for classifier in classifiers.values()]
-        summed_probabilities = np.sum(prediction_matrix, axis=0)[0]
-        unknown_class = classes[list(summed_probabilities).index(max(summed_probabilities))]
-        args.outfile.write(u"%s,%s\n" % (wid, unknown_class))
-        if counter % 1000 == 0:
-            logger.info(counter)
+    return artifacts.save(hsh, vectorizer, classifiers, classes, args.artifact_dir)
+
+
+def predict(args, path, unknowns):
+    """
+    Writes the predicted class of each unknown wiki, a batch at a time
+    :param args: the parsed arguments
+    :type args: class:`argparse.Namespace`
+    :param path: the artifact to predict with
+    :type path: str
+    :param unknowns: (wiki ID, feature string) tuples
+    :type unknowns: iterator
+    """
+    load_start = time.time()
+    vectorizer, classifiers, classes = artifacts.load(path)
+    logger.info(u"Loaded %s in %.2f seconds" % (path, time.time() - load_start))
+
+    predicted = 0
+    while True:
+        batch = list(islice(unknowns, args.batch_size))
+        if not batch:
+            break
+        wids, features = zip(*batch)
+        vectors = vectorizer.transform(features)
+        summed_probabilities = np.sum([classifier.predict_proba(vectors)
+                                       for classifier in classifiers.values()], axis=0)
+        for wid, class_index in zip(wids, np.argmax(summed_probabilities, axis=1)):
+            args.outfile.write(u"%s,%s\n" % (wid, classes[class_index]))
+        predicted += len(batch)
+        logger.info(u"Predicted %d" % predicted)
+
+
+def main():
+    start = time.time()
+    args = get_args()
+
+    if args.mode == u'predict':
+        path = args.artifact or artifacts.latest(args.artifact_dir)
+        if path is None:
+            raise ValueError(u"No trained model in %s; run with --mode train first" % args.artifact_dir)
+        predict(args, path, (parse_line(line) for line in args.infile if line.strip()))
+        logger.info(u"Finished in %.2f seconds" % (time.time() - start))
+        return
+
+    wid_to_class = OrderedDict()
+    groups = OrderedDict()
+    for line in args.class_file:
+        splt = line.strip().split(',')
+        groups[splt[1]] = groups.get(splt[1], []) + [int(splt[0])]
+        wid_to_class[int(splt[0])] = splt[1]
+    classes = groups.keys()
+
+    logger.info(u"Loading CSV...")
+    rows = [parse_line(line) for line in args.infile if line.strip()]
+    wid_to_features = OrderedDict([(wid, features) for wid, features in rows if wid in wid_to_class])
+    unknowns = [(wid, features) for wid, features in rows if wid not in wid_to_class]
+
+    path = train(args, wid_to_class, classes, wid_to_features)
+
+    if args.mode == u'all' and unknowns:
+        logger.info(u"Predicting %d unknowns..." % len(unknowns))
+        predict(args, path, iter(unknowns))
 
     logger.info(u"Finished in %.2f seconds" % (time.time() - start))
 
 
 if __name__ == u'__main__':
-    main()
\ No newline at end of file
+    main()
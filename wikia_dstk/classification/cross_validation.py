@@ -0,0 +1,146 @@
+"""
+Cross-validates classifiers over a feature matrix that is vectorized once.
+
+Folds are index arrays into that one matrix, so no fold copies the training
+set. The matrix and labels are module globals set before the worker pool
+forks, so workers share them copy-on-write and each task only carries its
+classifier key and fold indices. Every classifier and fold pair is a task.
+
+Modes:
+
+- kfold: shuffled, contiguous folds
+- stratified: each fold holds roughly the same share of every class
+- loo: leave-one-out, one fold per row; only run for the classifiers in
+  Classifiers.loo_capable, since it means one fit per row
+"""
+
+import numpy as np
+import time
+from multiprocessing import Pool
+from sklearn.metrics import f1_score
+from . import logger, Classifiers
+
+MODES = [u'kfold', u'stratified', u'loo']
+
+# shared with forked workers
+_matrix = None
+_labels = None
+
+
+def folds(labels, mode=u'stratified', k=10, seed=0):
+    """
+    Splits rows into train and test index arrays
+    :param labels: the class of each row
+    :type labels: class:`numpy.array`
+    :param mode: one of MODES
+    :type mode: str
+    :param k: the number of folds, for kfold and stratified
+    :type k: int
+    :param seed: seeds the shuffle
+    :type seed: int
+    :return: (train indices, test indices) tuples
+    :rtype: list
+    """
+    n = len(labels)
+    rng = np.random.RandomState(seed)
+    if mode == u'loo':
+        test_sets = [np.array([i]) for i in range(n)]
+    elif mode == u'kfold':
+        test_sets = np.array_split(rng.permutation(n), k)
+    elif mode == u'stratified':
+        assignments = np.zeros(n, dtype=int)
+        offset = 0
+        for label in np.unique(labels):
+            members = rng.permutation(np.nonzero(labels == label)[0])
+            # carry on where the last class left off, so small classes don't all land in fold 0
+            assignments[members] = (np.arange(len(members)) + offset) % k
+            offset += len(members)
+        test_sets = [np.nonzero(assignments == fold)[0] for fold in range(k)]
+    else:
+        raise ValueError(u"Unknown cross-validation mode %s" % mode)
+    everything = np.arange(n)
+    return [(np.setdiff1d(everything, test, assume_unique=True), test)
+            for test in test_sets if len(test)]
+
+
+def run_fold(task):
+    """
+    Fits and predicts one fold in a worker
+    :param task: classifier key, fold number, train indices, test indices and SVD components
+    :type task: tuple
+    :return: classifier key, fold number, test indices, predictions, fit seconds and predict seconds
+    :rtype: tuple
+    """
+    classifier_string, fold, train, test, n_components = task
+    clf = Classifiers.get_sparse(classifier_string, n_components=n_components, n_features=_matrix.shape[1])
+    start = time.time()
+    clf.fit(_matrix[train], _labels[train])
+    fit_seconds = time.time() - start
+    start = time.time()
+    predictions = clf.predict(_matrix[test])
+    return classifier_string, fold, test, predictions, fit_seconds, time.time() - start
+
+
+def cross_validate(matrix, labels, classifier_strings, mode=u'stratified', k=10, processes=8, n_components=300,
+                   seed=0):
+    """
+    Cross-validates each classifier over the same folds
+    :param matrix: a row of features per instance, sparse or dense
+    :type matrix: class:`scipy.sparse.csr_matrix`
+    :param labels: the class of each row
+    :type labels: list
+    :param classifier_strings: classifier keys from Classifiers
+    :type classifier_strings: list
+    :param mode: one of MODES
+    :type mode: str
+    :param k: the number of folds, for kfold and stratified
+    :type k: int
+    :param processes: the number of worker processes
+    :type processes: int
+    :param n_components: the SVD dimensions for classifiers that can't take sparse input
+    :type n_components: int
+    :param seed: seeds the fold shuffle
+    :type seed: int
+    :return: classifier key to its accuracy, macro-F1 and total fit and predict seconds
+    :rtype: dict
+    """
+    global _matrix, _labels
+    _matrix = matrix
+    _labels = np.array(labels)
+
+    if mode == u'loo':
+        skipped = [c for c in classifier_strings if c not in Classifiers.loo_capable]
+        if skipped:
+            logger.info(u"Skipping %s for leave-one-out; use kfold or stratified for them" % u", ".join(skipped))
+        classifier_strings = [c for c in classifier_strings if c in Classifiers.loo_capable]
+
+    splits = folds(_labels, mode, k, seed)
+    tasks = [(classifier_string, fold, train, test, n_components)
+             for classifier_string in classifier_strings
+             for fold, (train, test) in enumerate(splits)]
+    logger.info(u"Running %d classifiers over %d %s folds" % (len(classifier_strings), len(splits), mode))
+
+    predictions = dict([(c, np.zeros(len(_labels), dtype=_labels.dtype)) for c in classifier_strings])
+    timings = dict([(c, [0.0, 0.0]) for c in classifier_strings])
+    pool = Pool(processes=processes)
+    try:
+        # leave-one-out makes many tiny tasks, so hand them out in chunks
+        chunksize = max(1, len(tasks) / (processes * 4))
+        for classifier_string, fold, test, predicted, fit_seconds, predict_seconds in pool.imap_unordered(
+                run_fold, tasks, chunksize):
+            predictions[classifier_string][test] = predicted
+            timings[classifier_string][0] += fit_seconds
+            timings[classifier_string][1] += predict_seconds
+            logger.info(u"%s fold %d done" % (classifier_string, fold))
+    finally:
+        pool.terminate()
+
+    results = dict()
+    for classifier_string in classifier_strings:
+        predicted = predictions[classifier_string]
+        results[classifier_string] = dict(accuracy=float(np.mean(predicted == _labels)),
+                                          macro_f1=float(f1_score(_labels, predicted, average=u'macro')),
+                                          fit_seconds=timings[classifier_string][0],
+                                          predict_seconds=timings[classifier_string][1],
+                                          folds=len(splits))
+    return results
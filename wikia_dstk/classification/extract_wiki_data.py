@@ -3,6 +3,7 @@ from collections import OrderedDict
 from textblob import TextBlob
 from nltk.util import bigrams
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from traceback import format_exc
 from nltk.stem.snowball import EnglishStemmer
 from nltk.tokenize.regexp import WhitespaceTokenizer
@@ -10,12 +11,21 @@ from nltk.corpus import stopwords
 from boto import connect_s3
 import requests
 import codecs
+import hashlib
+import json
+import os
+import time
 import traceback
 
 
 stemmer = EnglishStemmer()
 tokenizer = WhitespaceTokenizer()
 stops = stopwords.words(u'english')
+session = requests.Session()
+
+# the fields wiki_to_feature reads; a wiki whose fields are unchanged gets its cached features
+FEATURE_FIELDS = [u'hub_s', u'top_categories_mv_en', u'top_articles_mv_en', u'description_txt', u'sitename_txt',
+                  u'main_page_text']
 
 
 def get_args():
@@ -24,9 +34,20 @@ def get_args():
     ap.add_argument(u'--solr-host', dest=u"solr_host", default=u"http://search-s10:8983")
     ap.add_argument(u'--outfile', dest=u'outfile', default=u'wiki_data.csv')
     ap.add_argument(u'--s3dest', dest=u's3dest')
+    ap.add_argument(u'--solr-threads', dest=u'solr_threads', default=8, type=int,
+                    help=u"Concurrent Solr requests")
+    ap.add_argument(u'--cache-dir', dest=u'cache_dir', default=u'/mnt/wiki_feature_cache/',
+                    help=u"Where to keep each wiki's features, keyed by a hash of the fields they come from")
     return ap.parse_args()
 
 
+def solr_select(tup):
+    core, solr_host, params = tup
+    response = session.get(u'%s/solr/%s/select' % (solr_host, core), params=params)
+    response.raise_for_status()
+    return response.json()[u'response']
+
+
 def get_wiki_data(args):
     """
     Gets wiki data as JSON docs for all English wikis with 50 or more articles (content pages).
@@ -38,14 +59,16 @@ def get_wiki_data(args):
               u'start': 0,
               u'wt': u'json',
               u'q': u'lang_s:en AND articles_i:[50 TO *]',
+              u'sort': u'id asc',  # pages are fetched concurrently, so they need a stable order
               u'rows': 500}
-    data = []
-    while True:
-        response = requests.get(u'%s/solr/xwiki/select' % args.solr_host, params=params).json()
-        data += response[u'response'][u'docs']
-        if response[u'response'][u'numFound'] < params[u'rows'] + params[u'start']:
-            return OrderedDict([(d[u'id'], d) for d in data])
-        params[u'start'] += params[u'rows']
+    first = solr_select((u'xwiki', args.solr_host, params))
+    pages = [dict(params, start=start) for start in range(params[u'rows'], first[u'numFound'], params[u'rows'])]
+    data = first[u'docs']
+    pool = ThreadPool(processes=args.solr_threads)
+    for response in pool.imap(solr_select, [(u'xwiki', args.solr_host, page) for page in pages]):
+        data += response[u'docs']
+    pool.close()
+    return OrderedDict([(d[u'id'], d) for d in data])
 
 
 def get_mainpage_text(args, wikis):
@@ -56,6 +79,7 @@ def get_mainpage_text(args, wikis):
     :return: OrderedDict of search docs, id to doc, with mainpage raw text added
     :rtype:class:`collections.OrderedDict`
     """
+    queries = []
     for i in range(0, len(wikis), 100):
         query = u'(%s) AND is_main_page:true' % u' OR ' .join([u"wid:%s" % wid for wid in wikis.keys()[i:i+100]])
         params = {u'wt': u'json',
@@ -63,9 +87,12 @@ def get_mainpage_text(args, wikis):
                   u'rows': 100,
                   u'q': query,
                   u'fl': u'wid,html_en'}
-        response = requests.get(u'%s/solr/main/select' % args.solr_host, params=params).json()
-        for result in response[u'response'][u'docs']:
+        queries.append((u'main', args.solr_host, params))
+    pool = ThreadPool(processes=args.solr_threads)
+    for response in pool.imap_unordered(solr_select, queries):
+        for result in response[u'docs']:
             wikis[str(result[u'wid'])][u'main_page_text'] = result[u'html_en']
+    pool.close()
 
     return wikis
 
@@ -114,33 +141,106 @@ def wiki_to_feature(wiki):
         raise e
 
 
+def content_hash(wiki):
+    """
+    Hashes the fields a wiki's features are extracted from
+    :param wiki: dict for wiki fields
+    :type wiki: dict
+    :return: a hex digest
+    :rtype: str
+    """
+    return hashlib.sha1(json.dumps([wiki.get(field) for field in FEATURE_FIELDS])).hexdigest()
+
+
+def cache_path(args, wid):
+    return os.path.join(args.cache_dir, u'%s.json' % wid)
+
+
+def cached_features(args, wiki):
+    """
+    :return: the wiki's features from a previous run if its fields haven't changed since, otherwise None
+    :rtype: list
+    """
+    try:
+        with open(cache_path(args, wiki[u'id'])) as fl:
+            cached = json.load(fl)
+    except (IOError, ValueError):
+        return None
+    if cached[u'hash'] != content_hash(wiki):
+        return None
+    return cached[u'features']
+
+
+def cache_features(args, wid, hsh, features):
+    tmp_path = cache_path(args, wid) + u'.tmp'
+    with open(tmp_path, u'w') as fl:
+        json.dump({u'hash': hsh, u'features': features}, fl)
+    os.rename(tmp_path, cache_path(args, wid))
+
+
+def hash_and_feature(wiki):
+    wid, features = wiki_to_feature(wiki)
+    return wid, content_hash(wiki), features
+
+
 def wikis_to_features(args, wikis):
     """
-    Turns wikis into a set of features
+    Turns wikis into features, running noun phrase extraction only on wikis that changed since the last run
     :param args:argparse namespace
     :type args:class:`argparse.Namespace`
     :param wikis: our wiki data set
     :type wikis:class:`collections.OrderedDict`
-    :return: OrderedDict of features, id to featureset
-    :rtype:class:`collections.OrderedDict`
+    :return: (wiki id, features) tuples, cached ones first and the rest as they're extracted
+    :rtype: generator
     """
+    if not os.path.exists(args.cache_dir):
+        os.makedirs(args.cache_dir)
+    misses = []
+    for wiki in wikis.values():
+        features = cached_features(args, wiki)
+        if features is None:
+            misses.append(wiki)
+        else:
+            yield wiki[u'id'], features
+    print u"%d of %d wikis cached; extracting features for the rest" % (len(wikis) - len(misses), len(wikis))
+
     p = Pool(processes=args.num_processes)
-    return OrderedDict(p.map_async(wiki_to_feature, wikis.values()).get())
+    for wid, hsh, features in p.imap_unordered(hash_and_feature, misses, chunksize=10):
+        cache_features(args, wid, hsh, features)
+        yield wid, features
+    p.close()
 
 
 def main():
     args = get_args()
-    features = wikis_to_features(args, get_mainpage_text(args, get_wiki_data(args)))
+    timings = OrderedDict()
+
+    start = time.time()
+    wikis = get_wiki_data(args)
+    timings[u'wiki data'] = time.time() - start
+
+    start = time.time()
+    wikis = get_mainpage_text(args, wikis)
+    timings[u'main pages'] = time.time() - start
+
+    start = time.time()
     flname = args.s3dest if args.s3dest else args.outfile
     with codecs.open(flname, u'w', encoding=u'utf8') as fl:
-        for wid, features in features.items():
+        for wid, features in wikis_to_features(args, wikis):
             line_for_writing = u",".join([wid, u",".join(features)]) + u"\n"
             fl.write(line_for_writing)
+    timings[u'features'] = time.time() - start
+
     if args.s3dest:
+        start = time.time()
         b = connect_s3().get_bucket(u'nlp-data')
         k = b.get_key(args.s3dest)
         k.set_contents_from_filename(args.s3dest)
+        timings[u'upload'] = time.time() - start
+
+    for stage, seconds in timings.items():
+        print u"%s: %.2f seconds" % (stage, seconds)
 
 
 if __name__ == u'__main__':
-    main()
\ No newline at end of file
+    main()
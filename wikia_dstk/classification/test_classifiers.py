@@ -1,9 +1,8 @@
-import traceback
-import time
+import numpy as np
 from . import vertical_labels, Classifiers
+from .cross_validation import cross_validate, MODES
 from collections import OrderedDict, defaultdict
 from sklearn.feature_extraction.text import TfidfVectorizer
-from multiprocessing import Pool
 from argparse import ArgumentParser, FileType
 
 
@@ -11,6 +10,14 @@ def get_args():
     ap = ArgumentParser()
     ap.add_argument('--class-file', type=FileType('r'), dest='class_file')
     ap.add_argument('--features-file', type=FileType('r'), dest='features_file')
+    ap.add_argument('--classifiers', dest='classifiers', default=[], action='append',
+                    help="The classifiers to test; defaults to all of them")
+    ap.add_argument('--mode', dest='mode', default='stratified', choices=MODES)
+    ap.add_argument('--folds', dest='folds', type=int, default=10)
+    ap.add_argument('--processes', dest='processes', type=int, default=8)
+    ap.add_argument('--svd-components', dest='svd_components', type=int, default=300,
+                    help="Dimensions to project features to for classifiers that can't take sparse input")
+    ap.add_argument('--seed', dest='seed', type=int, default=0)
     return ap.parse_args()
 
 
@@ -24,62 +31,28 @@ def main():
             groups[splt[1]].append(int(splt[0]))
     else:
         groups = vertical_labels
+    wid_to_class = dict([(wid, i) for i, (key, wids) in enumerate(groups.items()) for wid in wids])
+
     print u"Loading CSV..."
-    wid_to_features = OrderedDict([(splt[0], u" ".join(splt[1:])) for splt in
+    wid_to_features = OrderedDict([(int(splt[0]), u" ".join(splt[1:])) for splt in
                                    [line.decode(u'utf8').strip().split(u',') for line in args.features_file]
-                                   if int(splt[0]) in [v for g in groups.values() for v in g]  # only in group for now
+                                   if int(splt[0]) in wid_to_class  # only in group for now
                                    ])
 
     print u"Vectorizing..."
-    vectorizer = TfidfVectorizer()
-    feature_rows = wid_to_features.values()
-    feature_keys = wid_to_features.keys()
-    vectorizer.fit_transform(feature_rows)
-
-    loo_args = []
-
-    print u"Prepping leave-one-out data set..."
-    data = [(str(wid), i) for i, (key, wids) in enumerate(groups.items()) for wid in wids]
-    wid_to_class = dict(data)
-    for i in range(0, len(feature_rows)):
-        feature_keys_loo = [k for k in feature_keys]
-        feature_rows_loo = [f for f in feature_rows]
-        loo_row = feature_rows[i]
-        loo_class = wid_to_class[str(feature_keys[i])]
-        del feature_rows_loo[i]
-        del feature_keys_loo[i]
-        loo_args.append(
-            (vectorizer.transform(feature_rows),                # train
-             [wid_to_class[str(wid)] for wid in feature_keys],  # classes for training set
-             vectorizer.transform([loo_row]),                   # predict
-             [loo_class]                                        # expected class
-             )
-        )
-
-    print u"Running leave-one-out cross-validation..."
-
-    p = Pool(processes=8)
-    print p.map_async(classify, [((name, clf), loo_args) for name, clf in Classifiers.each_with_name()]).get()
+    matrix = TfidfVectorizer().fit_transform(wid_to_features.values())
+    labels = np.array([wid_to_class[wid] for wid in wid_to_features.keys()])
 
+    classifier_strings = args.classifiers or Classifiers.classifier_keys_to_names.keys()
+    results = cross_validate(matrix, labels, classifier_strings, mode=args.mode, k=args.folds,
+                             processes=args.processes, n_components=args.svd_components, seed=args.seed)
 
-def classify(arg_tup):
-    start = time.time()
-    try:
-        (name, clf), loo = arg_tup
-        predictions = []
-        expectations = []
-        for i, (training, classes, predict, expected) in enumerate(loo):
-            print name, i
-            clf.fit(training.toarray(), classes)
-            predictions.append(clf.predict(predict.toarray()))
-            expectations.append(expected)
-        score = len([i for i in range(0, len(predictions)) if predictions[i] == expectations[i]])
-        print name, score, time.time() - start
-        return name, score, time.time() - start
-    except Exception as e:
-            print e
-            print traceback.format_exc()
+    print u"%-20s %9s %9s %9s %11s" % (u"classifier", u"accuracy", u"macro-F1", u"fit s", u"predict s")
+    for classifier_string, result in sorted(results.items(), key=lambda x: -x[1]['accuracy']):
+        print u"%-20s %9.4f %9.4f %9.2f %11.2f" % (Classifiers.classifier_keys_to_names[classifier_string],
+                                                   result['accuracy'], result['macro_f1'],
+                                                   result['fit_seconds'], result['predict_seconds'])
 
 
 if __name__ == u'__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,338 @@
+"""
+Writes nodes and relationships to Neo4j in batches, through the
+transactional Cypher endpoint instead of one REST call per node, label,
+index entry and relationship.
+
+Builders queue up nodes with merge_node and relationships with
+merge_relationship. Once batch_size of them are pending, they go to Neo4j
+as one request to /db/data/transaction/commit, holding one parameterised
+statement per kind of node or relationship:
+
+    UNWIND {rows} AS row
+    MERGE (n:Page {wid: row.ident.wid, name: row.ident.name})
+    SET n += row.props
+
+Nodes are written before the relationships between them, in the same
+transaction, so a relationship can refer to a node queued in its own batch.
+A batch that fails is retried, since each one is a single transaction, unless
+Neo4j rejected the statements themselves with a client error; if it still
+fails, its rows are dropped and counted, and the writer carries on.
+Given a NodeIdentityMap, the writer skips nodes it already knows and matches
+relationships between known nodes by node ID.
+
+run_partitioned spreads documents over several writer processes by a key,
+such as the wiki ID, so everything for one wiki goes through one writer and
+concurrent transactions don't MERGE the same nodes.
+"""
+
+import json
+import re
+import requests
+import time
+import zlib
+from collections import OrderedDict
+from multiprocessing import Process, Queue
+
+SAFE_NAME = re.compile(r'^\w+$')
+
+
+class GraphWriteError(Exception):
+    pass
+
+
+def is_client_error(error):
+    """
+    Whether Neo4j rejected a transaction's statements, so sending them again would fail again
+    """
+    errors = error.args[0] if isinstance(error, GraphWriteError) and error.args else None
+    return isinstance(errors, list) and any([err.get(u'code', u'').startswith(u'Neo.ClientError.')
+                                             for err in errors])
+
+
+def quote(name):
+    """
+    Backtick-quote a label, relationship type or property name for Cypher
+    """
+    return u'`%s`' % name.replace(u'`', u'')
+
+
+def key_pattern(prefix, key_names):
+    return u', '.join([u'%s: row.%s.%s' % (quote(name), prefix, quote(name)) for name in key_names])
+
+
+class GraphBatchWriter(object):
+    """Accumulates MERGEs and sends them in transactional batches."""
+
+    def __init__(self, graph_db, batch_size=1000, identities=None, retries=3):
+        """
+        :type graph_db: string
+        :param graph_db: The Neo4j server, e.g. http://nlp-s3:7474/
+
+        :type batch_size: int
+        :param batch_size: How many nodes and relationships to send at once
+
+        :type identities: class:`wikia_dstk.knowledge_graph.identity.NodeIdentityMap`
+        :param identities: Node IDs already known, and where to record new ones
+
+        :type retries: int
+        :param retries: How many more times to send a batch that fails
+        """
+        self.url = u'%s/db/data/transaction/commit' % graph_db.rstrip(u'/')
+        self.batch_size = batch_size
+        self.identities = identities
+        self.retries = retries
+        self.session = requests.Session()
+        self.nodes = OrderedDict()
+        self.relationships = OrderedDict()
+        self.pending = 0
+        self.counts = dict(nodes=0, relationships=0, statements=0, requests=0, known=0,
+                           dropped_nodes=0, dropped_relationships=0)
+        self.seconds = 0.0
+
+    def merge_node(self, label, keys, props=None, labels=None, append=None):
+        """
+        Queue a node, identified by its label and key properties
+
+        :type label: string
+        :param label: The label the node is merged on
+
+        :type keys: dict
+        :param keys: The properties that identify the node
+
+        :type props: dict
+        :param props: Other properties to set
+
+        :type labels: list
+        :param labels: Other labels to add
+
+        :type append: dict
+        :param append: Property name to values to add to a list property
+        """
+        if (self.identities is not None and not (props or labels or append)
+                and self.identities.get(label, keys) is not None):
+            self.counts[u'known'] += 1
+            return
+        append = append or {}
+        for name in append:
+            if not SAFE_NAME.match(name):
+                raise ValueError(u"Can't append to property %s" % name)
+        group = (label, tuple(sorted(keys)), tuple(sorted(labels or [])), tuple(sorted(append)))
+        rows = self.nodes.setdefault(group, OrderedDict())
+        identity = tuple([keys[name] for name in group[1]])
+        row = rows.get(identity)
+        if row is None:
+            rows[identity] = dict(ident=keys, props=dict(props or {}), append=dict(append))
+            self.pending += 1
+        else:
+            # the same node twice in a batch becomes one row
+            row[u'props'].update(props or {})
+            for name, values in append.items():
+                row[u'append'][name] = row[u'append'][name] + values
+        self.maybe_flush()
+
+    def merge_relationship(self, rel_type, start, end, props=None):
+        """
+        Queue a relationship between two nodes, each given as a
+        (label, key properties) tuple as passed to merge_node
+
+        :type rel_type: string
+        :param rel_type: The relationship type
+        """
+        (start_label, start_keys), (end_label, end_keys) = start, end
+        start_id = end_id = None
+        if self.identities is not None:
+            start_id, end_id = self.identities.get(*start), self.identities.get(*end)
+        if start_id is not None and end_id is not None:
+            group = (rel_type,)
+            row = dict(src=start_id, dst=end_id, props=props or {})
+        else:
+            group = (rel_type, start_label, tuple(sorted(start_keys)), end_label, tuple(sorted(end_keys)))
+            row = dict(src=start_keys, dst=end_keys, props=props or {})
+        self.relationships.setdefault(group, []).append(row)
+        self.pending += 1
+        self.maybe_flush()
+
+    def node_statement(self, group, rows):
+        label, key_names, labels, append = group
+        statement = u'UNWIND {rows} AS row MERGE (n:%s {%s}) SET n += row.props' % (
+            quote(label), key_pattern(u'ident', key_names))
+        for extra_label in labels:
+            statement += u' SET n:%s' % quote(extra_label)
+        for name in append:
+            # values already on the node aren't added again, so a retried or re-run batch doesn't repeat them
+            statement += (u' SET n.%s = coalesce(n.%s, []) + [value IN row.append.%s WHERE NOT value IN coalesce(n.%s, [])]'
+                          % (name, name, name, name))
+        statement += u' RETURN id(n)'
+        return {u'statement': statement, u'parameters': {u'rows': rows}}
+
+    def relationship_statement(self, group, rows):
+        if len(group) == 1:
+            # both ends came from the identity map
+            statement = (u'UNWIND {rows} AS row MATCH (a) WHERE id(a) = row.src MATCH (b) WHERE id(b) = row.dst '
+                         u'MERGE (a)-[r:%s]->(b) SET r += row.props') % quote(group[0])
+            return {u'statement': statement, u'parameters': {u'rows': rows}}
+        rel_type, start_label, start_keys, end_label, end_keys = group
+        statement = (u'UNWIND {rows} AS row MATCH (a:%s {%s}) MATCH (b:%s {%s}) MERGE (a)-[r:%s]->(b) '
+                     u'SET r += row.props') % (quote(start_label), key_pattern(u'src', start_keys),
+                                               quote(end_label), key_pattern(u'dst', end_keys), quote(rel_type))
+        return {u'statement': statement, u'parameters': {u'rows': rows}}
+
+    def maybe_flush(self):
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def execute(self, statements):
+        """
+        Run statements in one transaction
+
+        :rtype: list
+        :return: Each statement's results
+        """
+        start = time.time()
+        response = self.session.post(self.url, data=json.dumps({u'statements': statements}),
+                                     headers={u'Content-Type': u'application/json',
+                                              u'Accept': u'application/json; charset=UTF-8'})
+        response.raise_for_status()
+        body = response.json()
+        self.seconds += time.time() - start
+        self.counts[u'requests'] += 1
+        self.counts[u'statements'] += len(statements)
+        if body.get(u'errors'):
+            raise GraphWriteError(body[u'errors'])
+        return body.get(u'results', [])
+
+    def flush(self):
+        """
+        Send everything pending, retrying a failed batch with backoff. A batch
+        that fails every time, or that Neo4j rejects with a client error, is
+        dropped and counted in dropped_nodes and dropped_relationships.
+        """
+        if not self.pending:
+            return
+        nodes, relationships = self.nodes, self.relationships
+        # start the next batch even if this one fails, rather than retrying it forever
+        self.nodes = OrderedDict()
+        self.relationships = OrderedDict()
+        self.pending = 0
+        statements = ([self.node_statement(group, rows.values()) for group, rows in nodes.items()]
+                      + [self.relationship_statement(group, rows) for group, rows in relationships.items()])
+        results = None
+        for attempt in range(self.retries + 1):
+            try:
+                results = self.execute(statements)
+                break
+            except (requests.RequestException, ValueError, GraphWriteError) as e:
+                print u"Couldn't write a batch (attempt %d of %d):" % (attempt + 1, self.retries + 1), e
+                if is_client_error(e):
+                    break
+                if attempt < self.retries:
+                    time.sleep(2 ** attempt)
+        if results is None:
+            self.counts[u'dropped_nodes'] += sum([len(rows) for rows in nodes.values()])
+            self.counts[u'dropped_relationships'] += sum([len(rows) for rows in relationships.values()])
+            return
+        if self.identities is not None:
+            # UNWIND keeps row order, so each returned ID lines up with its row
+            self.identities.put_many([(group[0], row[u'ident'], data[u'row'][0])
+                                      for (group, rows), result in zip(nodes.items(), results)
+                                      for row, data in zip(rows.values(), result.get(u'data', []))])
+            self.identities.commit()
+        self.counts[u'nodes'] += sum([len(rows) for rows in nodes.values()])
+        self.counts[u'relationships'] += sum([len(rows) for rows in relationships.values()])
+
+    def ensure_indexes(self, label_properties):
+        """
+        :type label_properties: list
+        :param label_properties: (label, property) tuples to index, so MERGE and MATCH don't scan
+        """
+        self.execute([{u'statement': u'CREATE INDEX ON :%s(%s)' % (quote(label), quote(prop))}
+                      for label, prop in label_properties])
+
+    def stats(self):
+        stats = dict(self.counts)
+        stats[u'seconds'] = self.seconds
+        return stats
+
+
+def partition(key, workers):
+    # crc32 rather than hash(), so a key lands on the same worker in any process
+    return (zlib.crc32(unicode(key).encode(u'utf8')) & 0xffffffff) % workers
+
+
+def writer_worker(graph_db, batch_size, handle, docs, results, identities, retries):
+    writer = GraphBatchWriter(graph_db, batch_size, identities, retries)
+    count = 0
+    for doc in iter(docs.get, None):
+        try:
+            handle(writer, doc)
+            count += 1
+        except Exception as e:
+            print u"Couldn't handle doc:", e
+    try:
+        writer.flush()
+    except Exception as e:
+        print u"Couldn't write the last batch:", e
+    stats = writer.stats()
+    stats[u'docs'] = count
+    results.put(stats)
+
+
+def run_partitioned(graph_db, docs, handle, key, workers=8, batch_size=1000, identities=None, retries=3):
+    """
+    Feed documents to writer processes, partitioned by key
+
+    :type graph_db: string
+    :param graph_db: The Neo4j server
+
+    :type docs: iterator
+    :param docs: Documents to write
+
+    :type handle: function
+    :param handle: Takes a GraphBatchWriter and a document, and queues the
+                   document's nodes and relationships
+
+    :type key: function
+    :param key: Takes a document and returns what to partition it on
+
+    :type identities: class:`wikia_dstk.knowledge_graph.identity.NodeIdentityMap`
+    :param identities: Known node IDs; each writer gets its own copy
+
+    :type retries: int
+    :param retries: How many more times to send a batch that fails
+
+    :rtype: dict
+    :return: Totals across workers, with throughput
+    """
+    start = time.time()
+    queues = [Queue(maxsize=batch_size) for _ in range(workers)]
+    results = Queue()
+    processes = [Process(target=writer_worker,
+                         args=(graph_db, batch_size, handle, queue, results, identities, retries))
+                 for queue in queues]
+    for process in processes:
+        process.start()
+    for doc in docs:
+        queues[partition(key(doc), workers)].put(doc)
+    for queue in queues:
+        queue.put(None)
+    totals = dict(docs=0, nodes=0, relationships=0, statements=0, requests=0, known=0,
+                  dropped_nodes=0, dropped_relationships=0, seconds=0.0)
+    for _ in processes:
+        for name, value in results.get().items():
+            totals[name] += value
+    for process in processes:
+        process.join()
+    totals[u'elapsed'] = time.time() - start
+    return totals
+
+
+def report(totals):
+    elapsed = max(totals[u'elapsed'], 1e-6)
+    print u"Wrote %d docs: %d nodes (%d more already known) and %d relationships in %d requests over %.1f seconds" % (
+        totals[u'docs'], totals[u'nodes'], totals[u'known'], totals[u'relationships'], totals[u'requests'], elapsed)
+    print u"%.1f docs/s, %.1f nodes/s, %.1f relationships/s; %.1f seconds waiting on Neo4j across writers" % (
+        totals[u'docs'] / elapsed, totals[u'nodes'] / elapsed, totals[u'relationships'] / elapsed,
+        totals[u'seconds'])
+    if totals[u'dropped_nodes'] or totals[u'dropped_relationships']:
+        print u"Dropped %d nodes and %d relationships from batches that failed every retry" % (
+            totals[u'dropped_nodes'], totals[u'dropped_relationships'])
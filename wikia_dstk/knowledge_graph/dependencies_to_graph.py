@@ -2,9 +2,9 @@ from .. import argstring_from_namespace
 import requests
 import traceback
 from lxml import etree
-from neo4jrestclient.client import GraphDatabase
-from neo4jrestclient.request import NotFoundError
 from argparse import ArgumentParser, Namespace
+from .batch_writer import GraphBatchWriter
+from .identity import NodeIdentityMap, add_identity_args
 from subprocess import Popen
 
 
@@ -14,6 +14,9 @@ def get_args():
     ap.add_argument(u'-j', u'--neo4j', dest=u'neo4j', default=u'http://nlp-s3:7474')
     ap.add_argument(u'-w', u'--wiki-id', dest=u'wiki_id', required=True)
     ap.add_argument(u'-n', u'--num-processes', dest=u'num_processes', default=6, type=int)
+    ap.add_argument(u'-b', u'--batch-size', dest=u'batch_size', default=1000, type=int)
+    add_identity_args(ap)
+    ap.set_defaults(identity_db=u'/mnt/node_identities.db')  # shared by the worker processes
     return ap.parse_args()
 
 
@@ -30,22 +33,11 @@ def main():
     args = get_args()
     offset = 1
     limit = 500
-    db = GraphDatabase(args.neo4j)
-
-    try:
-        db.labels.create('Word')
-    except:
-        pass
-
-    try:
-        db.nodes.indexes.get(u'sentence')
-    except NotFoundError:
-        db.nodes.indexes.create(u'sentence')
-
-    try:
-        db.nodes.indexes.get(u'wiki_word')
-    except NotFoundError:
-        db.nodes.indexes.create(u'wiki_word')
+    writer = GraphBatchWriter(args.neo4j)
+    writer.ensure_indexes([(u'Word', u'doc')])
+    identities = NodeIdentityMap(args.identity_cache_size, args.identity_db)
+    print u"Loaded", identities.warm(writer, {u'Word': [u'wiki_id', u'doc', u'sentence', u'word_id']},
+                                     wiki=args.wiki_id), u"known words"
 
     while True:
         r = requests.post(u'%s/exist/rest/db/' % args.exist_db,
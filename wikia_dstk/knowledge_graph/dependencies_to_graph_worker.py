@@ -1,6 +1,7 @@
 from argparse import ArgumentParser
-from neo4jrestclient.client import GraphDatabase
 from lxml import etree
+from .batch_writer import GraphBatchWriter, GraphWriteError
+from .identity import NodeIdentityMap, add_identity_args
 import traceback
 import requests
 
@@ -10,23 +11,23 @@ def get_args():
     ap.add_argument(u'-d', u'--exist-db', dest=u'exist_db', default=u'http://nlp-s3:8080')
     ap.add_argument(u'-j', u'--neo4j', dest=u'neo4j', default=u'http://nlp-s3:7474')
     ap.add_argument(u'-u', u'--base-uri', dest=u'base_uri', required=True)
+    ap.add_argument(u'-b', u'--batch-size', dest=u'batch_size', default=1000, type=int)
+    add_identity_args(ap)
+    ap.set_defaults(identity_db=u'/mnt/node_identities.db')
     return ap.parse_known_args()
 
 
-def node_from_index(db, wiki_id, doc, sentence, sentence_index, word_xml):
+def word_node(writer, wiki_id, doc, sentence, word_xml):
+    """
+    Queues a word node unless it's already known
+    :return: the node as a (label, keys) tuple for merge_relationship
+    :rtype: tuple
+    """
     try:
-        doc_sent_id = u"_".join([wiki_id, doc, sentence])
-        word_id = int(word_xml.get(u'idx'))
-        word = word_xml.text.encode(u'utf8')
-        word_nodes = [node for node in sentence_index[doc_sent_id][word_id]]
-        if not word_nodes:
-            params = dict(word=word, doc=doc, sentence=sentence, word_id=word_id, wiki_id=wiki_id)
-            word_node = db.nodes.create(**params)
-            word_node.labels.add(u'Word')
-            sentence_index[doc_sent_id][word_id] = word_node
-        else:
-            word_node = word_nodes[0]
-        return word_node
+        keys = dict(wiki_id=wiki_id, doc=doc, sentence=sentence, word_id=int(word_xml.get(u'idx')))
+        if writer.identities.get(u'Word', keys) is None:
+            writer.merge_node(u'Word', keys, props=dict(word=word_xml.text))
+        return u'Word', keys
     except (Exception, KeyError) as e:
         print e, traceback.format_exc()
         raise e
@@ -49,8 +50,8 @@ for $dependencies in $document//dependencies[@type='collapsed-ccprocessed-depend
 def main():
     args, _ = get_args()
     try:
-        db = GraphDatabase(args.neo4j)
-        sentence_index = db.nodes.indexes.get(u'sentence')
+        writer = GraphBatchWriter(args.neo4j, args.batch_size,
+                                  NodeIdentityMap(args.identity_cache_size, args.identity_db))
 
         r = requests.post(u'%s/exist/rest/db/' % args.exist_db,
                           data=get_query(args.base_uri),
@@ -63,11 +64,17 @@ def main():
             sentence = wrapper.get(u'sentence')
             for dependency in wrapper[0]:
                 try:
-                    governor = node_from_index(db, wiki_id, doc_id, sentence, sentence_index, dependency[0])
-                    dependent = node_from_index(db, wiki_id, doc_id, sentence, sentence_index, dependency[1])
-                    db.relationships.create(governor, dependency.get(u'type'), dependent)
+                    governor = word_node(writer, wiki_id, doc_id, sentence, dependency[0])
+                    dependent = word_node(writer, wiki_id, doc_id, sentence, dependency[1])
+                    writer.merge_relationship(dependency.get(u'type'), governor, dependent)
                 except IndexError:
                     continue
+        writer.flush()
+        stats = writer.stats()
+        if stats[u'dropped_nodes'] or stats[u'dropped_relationships']:
+            # fail the task, so the parent knows this document is incomplete
+            raise GraphWriteError(u"Dropped %d nodes and %d relationships for %s" % (
+                stats[u'dropped_nodes'], stats[u'dropped_relationships'], args.base_uri))
     except Exception as e:
         print e, traceback.format_exc()
         raise e
@@ -0,0 +1,213 @@
+"""
+A client-side map from node identity to Neo4j node ID, so graph builders
+don't look a node up in Neo4j before every write.
+
+A node's identity is its label, its wiki and its name. For keys with a wid
+or wiki_id, that property is the wiki; the other key properties, joined in
+name order, are the name. Recently used identities are kept in memory, up to
+max_size. Given a path, the map also keeps every identity it sees in a
+SQLite file, so a later process (or an evicted entry) picks them up without
+asking Neo4j.
+
+warm fills the map with one bulk export query per run:
+
+    MATCH (n:Page) WHERE n.wid = {wiki} RETURN id(n), n.name, n.wid
+
+and replaces whatever the map held for those labels (and that wiki), so IDs
+of nodes that have since been deleted, or of a rebuilt database, aren't used.
+Neo4j reuses node IDs, so a stale one could point at some other node. Builders
+warm every label they write, so nothing they look up outlives the export.
+
+GraphBatchWriter takes a map: nodes it already knows are not MERGEd again,
+relationships between known nodes are matched by node ID, and the IDs of
+newly merged nodes are added to the map.
+"""
+
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+WIKI_KEYS = [u'wid', u'wiki_id']
+
+
+def add_identity_args(ap):
+    """
+    Add the options builders use to set up a NodeIdentityMap
+    """
+    ap.add_argument(u'--identity-db', dest=u'identity_db', default=None,
+                    help=u"A SQLite file to keep node IDs in between runs")
+    ap.add_argument(u'--identity-cache-size', dest=u'identity_cache_size', type=int, default=1000000,
+                    help=u"Node IDs to keep in memory")
+    return ap
+
+
+def identity_of(label, keys):
+    """
+    :type label: string
+    :param label: The node's label
+
+    :type keys: dict
+    :param keys: The properties that identify the node
+
+    :rtype: tuple
+    :return: (label, wiki, name)
+    """
+    wiki = u''
+    names = []
+    for name in sorted(keys):
+        if name in WIKI_KEYS:
+            wiki = unicode(keys[name])
+        else:
+            names.append(unicode(keys[name]))
+    return label, wiki, u'|'.join(names)
+
+
+class NodeIdentityMap(object):
+    """An LRU map of (label, wiki, name) to node ID, optionally on disk."""
+
+    def __init__(self, max_size=1000000, path=None, commit_every=1000):
+        """
+        :type max_size: int
+        :param max_size: Identities to keep in memory
+
+        :type path: string
+        :param path: A SQLite file to keep every identity in
+
+        :type commit_every: int
+        :param commit_every: How many new identities to write per commit
+        """
+        self.max_size = max_size
+        self.path = path
+        self.commit_every = commit_every
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.uncommitted = 0
+        self.lock = threading.Lock()
+        self.db = None
+        self.db_pid = None
+
+    def connection(self):
+        # SQLite connections don't survive a fork, so each process opens its own
+        if self.path is None:
+            return None
+        if self.db is None or self.db_pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            self.db = sqlite3.connect(self.path, timeout=60)
+            self.db.execute(u'CREATE TABLE IF NOT EXISTS nodes (label TEXT, wiki TEXT, name TEXT, node_id INTEGER, '
+                            u'PRIMARY KEY (label, wiki, name))')
+            self.db_pid = os.getpid()
+            self.uncommitted = 0
+        return self.db
+
+    def remember(self, identity, node_id):
+        self.entries.pop(identity, None)
+        self.entries[identity] = node_id
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def get(self, label, keys):
+        """
+        :rtype: int
+        :return: The node's ID, or None if it isn't known
+        """
+        identity = identity_of(label, keys)
+        with self.lock:
+            node_id = self.entries.pop(identity, None)
+            if node_id is None and self.path is not None:
+                row = self.connection().execute(u'SELECT node_id FROM nodes WHERE label = ? AND wiki = ? AND name = ?',
+                                                identity).fetchone()
+                node_id = row[0] if row else None
+            if node_id is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.remember(identity, node_id)
+            return node_id
+
+    def put(self, label, keys, node_id):
+        self.put_many([(label, keys, node_id)])
+
+    def put_many(self, nodes):
+        """
+        :type nodes: list
+        :param nodes: (label, keys, node ID) tuples
+        """
+        rows = [identity_of(label, keys) + (node_id,) for label, keys, node_id in nodes]
+        with self.lock:
+            for row in rows:
+                self.remember(row[:3], row[3])
+            if self.path is not None and rows:
+                db = self.connection()
+                db.executemany(u'INSERT OR REPLACE INTO nodes VALUES (?, ?, ?, ?)', rows)
+                self.uncommitted += len(rows)
+                if self.uncommitted >= self.commit_every:
+                    db.commit()
+                    self.uncommitted = 0
+
+    def commit(self):
+        with self.lock:
+            if self.db is not None and self.db_pid == os.getpid():
+                self.db.commit()
+                self.uncommitted = 0
+
+    def forget(self, label, wiki=None):
+        """
+        Drop the identities of a label's nodes, or only of those on one wiki
+        """
+        with self.lock:
+            for identity in [i for i in self.entries if i[0] == label and (wiki is None or i[1] == wiki)]:
+                del self.entries[identity]
+            if self.path is not None:
+                if wiki is None:
+                    self.connection().execute(u'DELETE FROM nodes WHERE label = ?', (label,))
+                else:
+                    self.connection().execute(u'DELETE FROM nodes WHERE label = ? AND wiki = ?', (label, wiki))
+
+    def warm(self, writer, label_keys, wiki=None):
+        """
+        Load existing nodes with one bulk export request, replacing the
+        identities already held for those labels and that wiki
+
+        :type writer: class:`wikia_dstk.knowledge_graph.batch_writer.GraphBatchWriter`
+        :param writer: Runs the export query
+
+        :type label_keys: dict
+        :param label_keys: Label to the names of the properties that identify
+                           its nodes
+
+        :type wiki: string
+        :param wiki: Only export nodes for this wiki
+
+        :rtype: int
+        :return: How many nodes were loaded
+        """
+        labels = label_keys.keys()
+        statements = []
+        for label in labels:
+            key_names = list(label_keys[label])
+            statement = u'MATCH (n:`%s`)' % label
+            wiki_keys = [name for name in key_names if name in WIKI_KEYS]
+            parameters = {}
+            if wiki is not None and wiki_keys:
+                statement += u' WHERE n.`%s` = {wiki}' % wiki_keys[0]
+                parameters[u'wiki'] = wiki
+            statement += u' RETURN id(n), %s' % u', '.join([u'n.`%s`' % name for name in key_names])
+            statements.append({u'statement': statement, u'parameters': parameters})
+        nodes = []
+        for label, result in zip(labels, writer.execute(statements)):
+            key_names = list(label_keys[label])
+            for data in result.get(u'data', []):
+                row = data[u'row']
+                nodes.append((label, dict(zip(key_names, row[1:])), row[0]))
+            filtered = wiki is not None and [name for name in key_names if name in WIKI_KEYS]
+            self.forget(label, unicode(wiki) if filtered else None)
+        self.put_many(nodes)
+        self.commit()
+        return len(nodes)
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, cached=len(self.entries))
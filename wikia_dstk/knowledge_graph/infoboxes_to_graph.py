@@ -1,15 +1,33 @@
-from neo4jrestclient.client import GraphDatabase
+"""
+Writes each page's infobox values to the graph.
+
+Schema: every (:Wiki {wiki_id}) involves its (:Page {wid, name}) and
+(:Object {wid, name}) nodes, and each infobox key becomes a relationship from
+the value's Object to its Page. Pages with an infobox are also Subjects, and
+keep the Solr IDs they came from as a list in ids.
+
+Graphs written before this schema stored a Page's or Object's wiki only in
+the legacy "name" index, and a Page's ids as a comma-separated string.
+migrate_legacy_nodes copies the wid over from the Wiki that involves each
+such node and turns ids into a list; main runs it before writing, so MERGE on
+{wid, name} finds the existing nodes instead of duplicating them.
+"""
+
 from argparse import ArgumentParser
-from multiprocessing import Pool
+from .batch_writer import GraphBatchWriter, run_partitioned, report
+from .identity import NodeIdentityMap, add_identity_args
 import requests
-import traceback
 
 
 def get_args():
     ap = ArgumentParser()
     ap.add_argument(u'--graph-db', dest=u'graph_db', default=u'http://nlp-s3:7474/')
     ap.add_argument(u'--solr', dest=u'solr', default=u'http://search-s10:8983/solr/main')
-    ap.add_argument(u'--num-processes', dest=u'num_processes', type=int, default=8)
+    ap.add_argument(u'--num-processes', dest=u'num_processes', type=int, default=8,
+                    help=u"Writer processes; docs are split between them by wiki")
+    ap.add_argument(u'--batch-size', dest=u'batch_size', type=int, default=1000,
+                    help=u"Nodes and relationships to write per transaction")
+    add_identity_args(ap)
     return ap.parse_args()
 
 
@@ -21,111 +39,108 @@ def escape_key(string):
     return escape_value(string.replace(u" ", u"_"))
 
 
-def handle_doc(tup):
-    try:
-        args, doc = tup
-        db = GraphDatabase(args.graph_db)
-        name = doc[u'title_en'].replace(u'"', u'').lower()
-        print name.encode(u'utf8')
-        name_index = db.nodes.indexes.get(u'name')
-        wiki_index = db.nodes.indexes.get(u'wiki_ids')
-        wid = doc[u'wid']
-        name_nodes = [node for node in name_index[wid][name.encode(u'utf8')]]
-        page_ids = [doc[u'id']]
-        if not name_nodes:
-            page_node = db.nodes.create(ids=page_ids, name=name.encode(u'utf8'))
-            page_node.labels.add(u'Page')
-            name_index[wid][name.encode('utf8')] = page_node
-        else:
-            page_node = name_nodes[0]
-            try:
-                if u'ids' in page_node:
-                    page_node[u'ids'] += ','+doc[u'id']
-                else:
-                    page_node[u'ids'] = ','+doc[u'id']
-            except Exception as e:
-                print e, page_node
-
-        box_nodes = []
-        for line in doc[u'infoboxes_txt']:
-            splt = line.split(u'|')
-            if len(splt) > 2:
-                key = splt[1].lower().replace(u':', '').strip()
-                value = u'|'.join(splt[2:]).strip().lower().encode(u'utf8')
-                props = [node for node in name_index[wid][value]]
-                if not props:
-                    box_node = db.nodes.create(name=value)
-                    if u"Object" not in box_node.labels:
-                        box_node.labels.add(u'Object')
-                    name_index[doc[u'wid']][value] = box_node
-                else:
-                    box_node = props[0]
-                try:
-                    db.relationships.create(box_node, escape_key(key).encode(u'utf8'), page_node)
-                except Exception as e:
-                    print e
-                if u"Subject" not in page_node.labels:
-                    page_node.labels.add(u'Subject')
-                box_nodes.append(box_node)
-                try:
-                    print u"\t(%s)-[:%s]->(%s)".encode(u'utf8') % (
-                        name.encode(u'utf8'), escape_key(key).encode(u'utf8'), value.encode(u'utf8')
-                    )
-                except UnicodeDecodeError:
-                    pass
-
-        wiki_nodes = [node for node in wiki_index[u'wiki_id'][doc[u'wid']]]
-        if not wiki_nodes:
-            wiki_node = db.nodes.create(wiki_id=doc[u'wid'])
-            wiki_node.labels.add(u'Wiki')
-            wiki_index[u'wiki_id'][doc[u'wid']] = wiki_node
-        else:
-            wiki_node = wiki_nodes[0]
-        try:
-            db.relationships.create(wiki_node, u'involves', page_node)
-        except Exception as e:
-            print e
-        for infobox_node in box_nodes:
-            try:
-                db.relationships.create(wiki_node, u'involves', infobox_node)
-            except Exception as e:
-                print e
-    except (Exception, ValueError, KeyError) as e:
-        print e
-        print traceback.format_exc()
-        raise e
-
-
-def run_queries(args, pool, start=0):
+def handle_doc(writer, doc):
+    """
+    Queues a page, its infobox values, and its wiki
+    :param writer: the writer to queue nodes and relationships on
+    :type writer: class:`wikia_dstk.knowledge_graph.batch_writer.GraphBatchWriter`
+    :param doc: a Solr doc with an id, wid, title_en and infoboxes_txt
+    :type doc: dict
+    """
+    wid = doc[u'wid']
+    name = doc[u'title_en'].replace(u'"', u'').lower()
+    page = (u'Page', dict(wid=wid, name=name))
+    wiki = (u'Wiki', dict(wiki_id=wid))
+    writer.merge_node(*page, append=dict(ids=[doc[u'id']]))
+    writer.merge_node(*wiki)
+
+    box_nodes = []
+    for line in doc[u'infoboxes_txt']:
+        splt = line.split(u'|')
+        if len(splt) > 2:
+            key = splt[1].lower().replace(u':', '').strip()
+            if not key:
+                # an empty relationship type fails the whole transaction
+                continue
+            value = u'|'.join(splt[2:]).strip().lower()
+            box_node = (u'Object', dict(wid=wid, name=value))
+            writer.merge_node(*box_node)
+            box_nodes.append(box_node)
+            writer.merge_relationship(escape_key(key), box_node, page)
+
+    if box_nodes:
+        writer.merge_node(*page, labels=[u'Subject'])
+    writer.merge_relationship(u'involves', wiki, page)
+    for box_node in box_nodes:
+        writer.merge_relationship(u'involves', wiki, box_node)
+
+
+def legacy_ids(ids):
+    """
+    :param ids: a legacy Page's ids
+    :type ids: str|list
+    :return: the Solr IDs as a list
+    :rtype: list
+    """
+    if ids is None:
+        return None
+    if not isinstance(ids, basestring):
+        # the old client created ids as a list, then appended ',<id>' to it a character at a time
+        ids = u','.join([ids[0], u''.join(ids[1:])])
+    return [doc_id for doc_id in ids.split(u',') if doc_id]
+
+
+def migrate_legacy_nodes(writer, batch_size=10000):
+    """
+    Gives Page and Object nodes written before the {wid, name} schema their wid,
+    and turns Page ids into lists
+    :param writer: runs the migration queries
+    :type writer: class:`wikia_dstk.knowledge_graph.batch_writer.GraphBatchWriter`
+    :param batch_size: how many nodes to migrate per transaction
+    :type batch_size: int
+    :return: how many nodes were migrated
+    :rtype: int
+    """
+    find = {u'statement': u'MATCH (w:Wiki)-[:involves]->(n) WHERE (n:Page OR n:Object) AND n.wid IS NULL '
+                          u'AND w.wiki_id IS NOT NULL '
+                          u'RETURN id(n), w.wiki_id, n.ids LIMIT {limit}',
+            u'parameters': {u'limit': batch_size}}
+    update = u'UNWIND {rows} AS row MATCH (n) WHERE id(n) = row.node SET n.wid = row.wid, n.ids = row.ids'
+    migrated = 0
+    while True:
+        data = writer.execute([find])[0].get(u'data', [])
+        rows = [dict(node=node_id, wid=wid, ids=legacy_ids(ids)) for node_id, wid, ids in [d[u'row'] for d in data]]
+        if rows:
+            writer.execute([{u'statement': update, u'parameters': {u'rows': rows}}])
+            migrated += len(rows)
+        if len(rows) < batch_size:
+            return migrated
+
+
+def get_docs(args, start=0):
     query_params = dict(q=u'iscontent:true AND lang:en AND infoboxes_txt:*', fl=u'id,title_en,infoboxes_txt,wid',
                         wt=u'json', start=start, rows=500)
+    session = requests.Session()
     while True:
-        response = requests.get(u'%s/select' % args.solr, params=query_params).json()
-        map(handle_doc, [(args, doc) for doc in response[u'response'][u'docs']])
-        if response[u'response'][u'numFound'] <= query_params[u'start']:
-            return True
+        response = session.get(u'%s/select' % args.solr, params=query_params).json()
+        for doc in response[u'response'][u'docs']:
+            yield doc
+        if response[u'response'][u'numFound'] <= query_params[u'start'] + query_params[u'rows']:
+            return
         query_params['start'] += query_params['rows']
 
 
 def main():
     args = get_args()
-    db = GraphDatabase(args.graph_db)
-    try:
-        name_index = db.nodes.indexes.create(u'name')
-    except:
-        pass
-    try:
-        wiki_index = db.nodes.indexes.create(u'wiki_ids')
-    except:
-        pass
-    for label in [u'Page', u'Object', u'Subject', u'Wiki']:
-        try:
-            db.labels.create(label)
-        except:
-            continue
-    pool = False  # Pool(processes=args.num_processes)
-    run_queries(args, pool)
+    writer = GraphBatchWriter(args.graph_db)
+    writer.ensure_indexes([(u'Page', u'name'), (u'Object', u'name'), (u'Wiki', u'wiki_id')])
+    print u"Migrated", migrate_legacy_nodes(writer), u"legacy nodes"
+    identities = NodeIdentityMap(args.identity_cache_size, args.identity_db)
+    print u"Loaded", identities.warm(writer, {u'Page': [u'wid', u'name'], u'Object': [u'wid', u'name'],
+                                              u'Wiki': [u'wiki_id']}), u"known nodes"
+    report(run_partitioned(args.graph_db, get_docs(args), handle_doc, key=lambda doc: doc[u'wid'],
+                           workers=args.num_processes, batch_size=args.batch_size, identities=identities))
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,78 @@
+"""
+A stand-in for Neo4j's transactional Cypher endpoint, for trying out the
+graph builders without a database.
+
+It accepts POSTs to /db/data/transaction/commit and counts statements and
+parameter rows. Statements that return node IDs get a new ID per row; the
+rest get an empty result. Like Neo4j, it rejects the whole transaction if a
+statement uses an empty name, such as a relationship type of ``. GET /stats returns the counts, and the statements
+it has seen with their row counts.
+
+python -m wikia_dstk.knowledge_graph.stub_neo4j --port 7474
+python -m wikia_dstk.knowledge_graph.infoboxes_to_graph --graph-db http://localhost:7474/
+"""
+
+import json
+import threading
+import time
+from argparse import ArgumentParser
+from flask import Flask, request, Response
+
+app = Flask(__name__)
+lock = threading.Lock()
+counts = dict(requests=0, statements=0, rows=0, node_ids=0)
+statements_seen = dict()
+latency = dict(seconds=0.0)
+
+
+def json_response(data, status=200):
+    return Response(json.dumps(data), status=status, mimetype=u'application/json')
+
+
+@app.route(u'/db/data/transaction/commit', methods=[u'POST'])
+def commit():
+    try:
+        statements = json.loads(request.get_data())[u'statements']
+    except (ValueError, KeyError, TypeError):
+        return json_response({u'results': [], u'errors': [{u'code': u'Neo.ClientError.Request.InvalidFormat',
+                                                           u'message': u'Expected a list of statements'}]})
+    if any([u'``' in statement[u'statement'] for statement in statements]):
+        return json_response({u'results': [], u'errors': [{u'code': u'Neo.ClientError.Statement.SyntaxError',
+                                                           u'message': u'Empty name'}]})
+    if latency[u'seconds']:
+        time.sleep(latency[u'seconds'])
+    results = []
+    with lock:
+        counts[u'requests'] += 1
+        for statement in statements:
+            rows = len(statement.get(u'parameters', {}).get(u'rows', []))
+            counts[u'statements'] += 1
+            counts[u'rows'] += rows
+            statements_seen[statement[u'statement']] = statements_seen.get(statement[u'statement'], 0) + rows
+            data = []
+            if statement[u'statement'].endswith(u'RETURN id(n)'):
+                data = [{u'row': [counts[u'node_ids'] + n]} for n in range(rows)]
+                counts[u'node_ids'] += rows
+            results.append({u'columns': [], u'data': data})
+    return json_response({u'results': results, u'errors': []})
+
+
+@app.route(u'/stats')
+def stats():
+    with lock:
+        return json_response(dict(counts, statements_seen=statements_seen))
+
+
+def main():
+    ap = ArgumentParser(description=u"Stub Neo4j transactional endpoint")
+    ap.add_argument(u'--host', dest=u'host', default=u'127.0.0.1')
+    ap.add_argument(u'--port', dest=u'port', type=int, default=7474)
+    ap.add_argument(u'--latency-ms', dest=u'latency_ms', type=float, default=0,
+                    help=u"How long to take over each request, to mimic a real server")
+    args = ap.parse_args()
+    latency[u'seconds'] = args.latency_ms / 1000.0
+    app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == u'__main__':
+    main()
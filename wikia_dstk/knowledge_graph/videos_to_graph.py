@@ -1,7 +1,6 @@
-from neo4jrestclient.client import GraphDatabase
 from argparse import ArgumentParser
-from multiprocessing import Pool
-import traceback
+from .batch_writer import GraphBatchWriter, run_partitioned, report
+from .identity import NodeIdentityMap, add_identity_args
 import requests
 
 
@@ -9,7 +8,11 @@ def get_args():
     ap = ArgumentParser()
     ap.add_argument(u'--graph-db', dest=u'graph_db', default=u'http://nlp-s3:7474/')
     ap.add_argument(u'--solr', dest=u'solr', default=u'http://search-s10:8983/solr/main')
-    ap.add_argument(u'--num-processes', dest=u'num_processes', type=int, default=8)
+    ap.add_argument(u'--num-processes', dest=u'num_processes', type=int, default=8,
+                    help=u"Writer processes; videos are split between them by wiki")
+    ap.add_argument(u'--batch-size', dest=u'batch_size', type=int, default=1000,
+                    help=u"Nodes and relationships to write per transaction")
+    add_identity_args(ap)
     return ap.parse_args()
 
 
@@ -26,56 +29,59 @@ def get_all_actors(args):
         print query_params[u'start'], u"/", response[u'response'][u'numFound']
 
 
-def main():
-    args = get_args()
-    db = GraphDatabase(args.graph_db)
-    for label in [u'Video', u'Actor']:
-        try:
-            db.labels.create(label)
-        except:
-            continue
-
-    print u"Getting all actors..."
-    actors = get_all_actors(args)
-
-    print u"Creating", len(actors), u"actor nodes"
-    actor_nodes = []
-    for i in range(0, len(actors), 500):
-        print i
-        actor_nodes += map(lambda x: db.nodes.create(name=x), actors[i:i+500])
-
-    print u"Labeling actor nodes"
-    map(lambda y: y.labels.add(u'Actor'), actor_nodes)
-    actors_to_node = dict(zip(actors, actor_nodes))
-
-    print u"Assigning videos to actors"
+def get_videos(args):
     query_params = dict(q=u'is_video:true AND video_actors_txt:*', fl=u'id,title_en,video_actors_txt,wid',
                         wt=u'json', start=0, rows=500)
+    session = requests.Session()
     while True:
-        response = requests.get(u'%s/select' % args.solr, params=query_params).json()
+        response = session.get(u'%s/select' % args.solr, params=query_params).json()
         for doc in response[u'response'][u'docs']:
-            if u'title_en' not in doc:
-                continue
-            name = doc[u'title_en'].replace(u'"', u'').lower()
+            if u'title_en' in doc:
+                yield doc
+        if response[u'response'][u'numFound'] <= query_params[u'start'] + query_params[u'rows']:
+            return
+        query_params[u'start'] += query_params[u'rows']
 
-            print name.encode(u'utf8')
-            video_node = db.nodes.create(doc_id=doc[u'id'], name=name.encode(u'utf8'))
-            video_node.labels.add(u'Video')
 
-            for actor in doc.get(u'video_actors_txt', []):
-                actor_node = actors_to_node[actor]
-                try:
-                    db.relationships.create(video_node, u'stars', actor_node)
-                    db.relationships.create(actor_node, u'acts_in', video_node)
-                except Exception as e:
-                    print e
+def handle_video(writer, doc):
+    """
+    Queues a video and its relationships to its actors
+    :param writer: the writer to queue nodes and relationships on
+    :type writer: class:`wikia_dstk.knowledge_graph.batch_writer.GraphBatchWriter`
+    :param doc: a Solr doc with an id, wid, title_en and video_actors_txt
+    :type doc: dict
+    """
+    name = doc[u'title_en'].replace(u'"', u'').lower()
+    video = (u'Video', dict(doc_id=doc[u'id']))
+    writer.merge_node(*video, props=dict(name=name, wid=doc[u'wid']))
+    for actor in doc.get(u'video_actors_txt', []):
+        writer.merge_relationship(u'stars', video, (u'Actor', dict(name=actor)))
+        writer.merge_relationship(u'acts_in', (u'Actor', dict(name=actor)), video)
 
-        if response[u'response'][u'numFound'] <= query_params[u'start']:
-            return True
-        query_params[u'start'] += query_params[u'rows']
 
+def main():
+    args = get_args()
+    writer = GraphBatchWriter(args.graph_db, args.batch_size)
+    writer.ensure_indexes([(u'Video', u'doc_id'), (u'Actor', u'name')])
+    identities = NodeIdentityMap(args.identity_cache_size, args.identity_db)
+    writer.identities = identities
+    print u"Loaded", identities.warm(writer, {u'Actor': [u'name'], u'Video': [u'doc_id']}), u"known nodes"
 
+    print u"Getting all actors..."
+    actors = get_all_actors(args)
+
+    # actors appear on many wikis, so one writer creates them all before videos are split up by wiki
+    print u"Creating", len(actors), u"actor nodes"
+    for actor in actors:
+        writer.merge_node(u'Actor', dict(name=actor))
+    writer.flush()
+    if writer.stats()[u'dropped_nodes']:
+        print u"Dropped", writer.stats()[u'dropped_nodes'], u"actor nodes; their videos will have no actors"
+
+    print u"Assigning videos to actors"
+    report(run_partitioned(args.graph_db, get_videos(args), handle_video, key=lambda doc: doc[u'wid'],
+                           workers=args.num_processes, batch_size=args.batch_size, identities=identities))
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
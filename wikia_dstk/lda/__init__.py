@@ -6,23 +6,24 @@ import logging
 import numpy as np
 import time
 import re
-import random
 import hashlib
 import os
 import codecs
+import threading
 from datetime import datetime
 from multiprocessing import Pool
 from gensim.corpora import Dictionary
 from gensim.matutils import corpus2dense
 from nltk import PorterStemmer, bigrams, trigrams
 from nltk.corpus import stopwords
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from boto import connect_s3
 from boto.utils import get_instance_metadata
 from boto.ec2 import connect_to_region
 from boto.exception import EC2ResponseError
 from boto.ec2 import networkinterface
 from .. import log, logfile
+from .vector_store import write_vector_store, upload_vector_store
 
 ami = u"ami-13156323"
 
@@ -34,11 +35,12 @@ splitter_pattern = ur"[\u200b\s]+"
 dictlogger = logging.getLogger(u'gensim.corpora.dictionary')
 stemmer = PorterStemmer()
 english_stopwords = stopwords.words(u'english')
-instances_launched = []
-instances_requested = []
 connection = None
 video_json_key = u'feature-data/video.json'
 
+# upper bounds, in milliseconds, of latency histogram buckets
+latency_buckets = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
 logfile = u'/var/log/wikia_dstk.lda.log'
 log_level = logging.INFO
 logger = logging.getLogger(u'wikia_dstk.lda')
@@ -134,66 +136,6 @@ def harakiri():
     conn.terminate_instances(instance_ids=[my_id])
 
 
-def check_lda_node(instance_request):
-    conn = get_ec2_connection()
-    fulfilled = False
-    while not fulfilled:
-        time.sleep(random.randint(10, 20))
-        requests = conn.get_all_spot_instance_requests(request_ids=[instance_request.id])
-        if len(filter(lambda x: x.status == u'price-too-low', requests)) > 0:
-            raise StandardError(u"Bid price too low -- try again later")
-        fulfilled = len(filter(lambda x: x.status.code == u'fulfilled', requests)) > 0
-    return requests[0].instance_id
-
-
-def load_instance_ids(instance_ids):
-    global instances_launched
-    c = get_ec2_connection()
-    instances_launched = c.get_all_reservations(instance_ids=instance_ids)
-    c.create_tags(instance_ids, {u"Name": u"LDA Worker Node", u"type": u"lda"})
-
-
-def launch_lda_nodes(instance_count=20, ami=u"ami-f4d0bfc4"):
-    global instances_launched, instances_requested
-    conn = get_ec2_connection()
-    user_data = u"""#!/bin/sh
-
-echo `date` `hostname -i ` "Configuring Environment" >> /var/log/my_startup.log
-export PYRO_SERIALIZERS_ACCEPTED=pickle
-export PYRO_SERIALIZER=pickle
-export PYRO_NS_HOST=%s
-echo `date` `hostname -i ` "Starting Worker" >> /var/log/my_startup.log
-python -m gensim.models.lda_worker > /var/log/lda_worker 2>&1 &
-echo `date` `hostname -i ` "User Data Script Complete" >> /var/log/my_startup.log
-""" % get_my_ip()
-
-    instances_requested = conn.request_spot_instances(0.80, ami,
-                                                      count=instance_count,
-                                                      instance_type=u'm2.4xlarge',
-                                                      subnet_id=u'subnet-e4d087a2',
-                                                      security_group_ids=['sg-72190a10'],
-                                                      user_data=user_data
-                                                      )
-
-    return Pool(processes=instance_count).map_async(check_lda_node, instances_requested, callback=load_instance_ids)
-
-
-def terminate_lda_nodes():
-    global instances_launched, instances_requested
-    conn = get_ec2_connection()
-    try:
-        if len(instances_launched):
-            conn.terminate_instances(instance_ids=[instance.id
-                                                   for reservation in instances_launched
-                                                   for instance in reservation.instances])
-        if len(instances_requested):
-            conn.cancel_spot_instance_requests([r.id for r in instances_requested])
-    except EC2ResponseError as e:
-        log(e)
-        if len(instances_requested):
-            conn.cancel_spot_instance_requests([r.id for r in instances_requested])
-
-
 def log(*args):
     logger.info(u" ".join([unicode(a) for a in args]))
 
@@ -217,13 +159,14 @@ def get_dct_and_bow_from_features(id_to_features):
     return dct, bow_docs
 
 
-def write_csv_and_text_data(args, bucket, modelname, id_to_features, bow_docs, lda_model):
+def write_csv_and_text_data(args, bucket, modelname, id_to_features, bow_docs, lda_model, doc_topics=None):
+    if doc_topics is None:
+        doc_topics = dict([(name, lda_model[bow_docs[name]]) for name in id_to_features])
+
     # counting number of features so that we can filter
     tally = defaultdict(int)
     for name in id_to_features:
-        vec = bow_docs[name]
-        sparse = lda_model[vec]
-        for (feature, frequency) in sparse:
+        for (feature, frequency) in doc_topics[name]:
             tally[feature] += 1
 
     # Write to sparse_csv here, excluding anything exceding our max frequency
@@ -232,18 +175,23 @@ def write_csv_and_text_data(args, bucket, modelname, id_to_features, bow_docs, l
     text_filename = modelname.replace(u'.model', u'-topic-features.csv')
     csv_key = bucket.new_key(u'%s%s/%s/%s' % (args.s3_prefix, args.git_ref, args.model_prefix, sparse_csv_filename))
     text_key = bucket.new_key(u'%s%s/%s/%s' % (args.s3_prefix, args.git_ref, args.model_prefix, text_filename))
+    filtered = {}
     with open(args.path_prefix+sparse_csv_filename, 'w') as sparse_csv:
         for name in id_to_features:
-            vec = bow_docs[name]
-            sparse = dict(lda_model[vec])
-            sparse_csv.write(",".join([str(name)]
-                                      + ['%d-%.8f' % (n, sparse.get(n, 0))
-                                         for n in range(args.num_topics)
-                                         if sparse.get(n, 0) and tally[n] <= args.max_topic_frequency])
+            sparse = dict(doc_topics[name])
+            filtered[name] = [(n, sparse[n]) for n in range(args.num_topics)
+                              if sparse.get(n, 0) and tally[n] <= args.max_topic_frequency]
+            sparse_csv.write(",".join([str(name)] + ['%d-%.8f' % pair for pair in filtered[name]])
                              + "\n")
 
     csv_key.set_contents_from_file(open(args.path_prefix+sparse_csv_filename, u'r'))
 
+    log(u"Writing topic vector store")
+    vectors_name = modelname.replace(u'.model', u'-topic-vectors')
+    write_vector_store(args.path_prefix+vectors_name, filtered, args.num_topics, modelname)
+    upload_vector_store(bucket, args.path_prefix+vectors_name,
+                        u'%s%s/%s/%s' % (args.s3_prefix, args.git_ref, args.model_prefix, vectors_name))
+
     with codecs.open(args.path_prefix+text_filename, u'w', encoding=u'utf8') as text_output:
         text_output.write(u"\n".join(
             map(lambda x: x.encode(u'utf8', lda_model.show_topics(topics=args.num_topics, topn=15, formatted=True))))
@@ -408,3 +356,44 @@ class WikiaDSTKDictionary(Dictionary):
         retval = parent.filter_extremes(no_below=no_below, no_above=no_above, keep_n=keep_n)
         self.d2bmemo = {}
         return retval
+
+
+class LatencyHistogram(object):
+    """Counts of observed latencies in fixed buckets."""
+
+    def __init__(self, buckets=latency_buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, ms):
+        with self.lock:
+            self.counts[np.searchsorted(self.buckets, ms)] += 1
+            self.total += ms
+
+    def percentile(self, fraction):
+        """
+        :rtype: float
+        :return: The upper bound of the bucket the percentile falls in
+        """
+        seen = sum(self.counts)
+        if not seen:
+            return None
+        running = 0
+        for bound, count in zip(self.buckets + [float('inf')], self.counts):
+            running += count
+            if running >= fraction * seen:
+                return bound
+
+    def as_dict(self):
+        with self.lock:
+            seen = sum(self.counts)
+            labels = [u'<=%d' % bound for bound in self.buckets] + [
+                u'>%d' % self.buckets[-1]]
+            return {u'count': seen,
+                    u'mean_ms': self.total / seen if seen else None,
+                    u'p50_ms': self.percentile(0.5),
+                    u'p90_ms': self.percentile(0.9),
+                    u'p99_ms': self.percentile(0.99),
+                    u'buckets': OrderedDict(zip(labels, self.counts))}
@@ -0,0 +1,275 @@
+"""
+Training backends for the LDA servers.
+
+`local` runs online LDA on this machine: each mini-batch is split across a
+process pool, every worker runs the E-step on its share against a shared,
+read-only copy of exp(E[log beta]) and writes its sufficient statistics into
+its own shared buffer, and the parent sums the buffers and does the M-step.
+Nothing is pickled per batch except the documents themselves.
+
+`pyro` is the gensim distributed model, on worker nodes from LdaNodePool.
+
+`auto` picks local unless the corpus is big enough to be worth a fleet.
+"""
+
+import numpy as np
+import os
+import time
+from multiprocessing import Pool, RawArray, cpu_count
+from gensim.models import LdaModel
+from gensim.models.ldamodel import LdaState
+from scipy.special import psi
+from . import log
+from .node_pool import LdaNodePool
+
+# nonzero (document, term) entries times topics; above this, use the fleet
+AUTO_LOCAL_MAX_WORK = 2e10
+
+# shared state, inherited by the pool's workers when they're forked
+shared = {}
+
+
+def dirichlet_expectation(alpha):
+    return psi(alpha) - psi(np.sum(alpha))
+
+
+def init_worker(expElogbeta, sstats, shape, alpha, iterations,
+                gamma_threshold):
+    np.random.seed()  # otherwise every worker draws the same initial gammas
+    shared['expElogbeta'] = np.frombuffer(expElogbeta).reshape(shape)
+    shared['sstats'] = [np.frombuffer(buf).reshape(shape) for buf in sstats]
+    shared['alpha'] = alpha
+    shared['iterations'] = iterations
+    shared['gamma_threshold'] = gamma_threshold
+
+
+def estep(task):
+    """
+    Run variational inference over a share of a mini-batch, the same way
+    LdaModel.inference does, accumulating sufficient statistics into this
+    task's slot
+
+    :type task: tuple
+    :param task: The slot to write to, and a list of bag-of-words documents
+
+    :rtype: int
+    :return: The number of documents processed
+    """
+    slot, chunk = task
+    expElogbeta = shared['expElogbeta']
+    sstats = shared['sstats'][slot]
+    alpha = shared['alpha']
+    num_topics = expElogbeta.shape[0]
+    sstats.fill(0)
+    for doc in chunk:
+        if not doc:
+            continue
+        ids = [token_id for token_id, _ in doc]
+        cts = np.array([count for _, count in doc], dtype=np.float64)
+        gammad = np.random.gamma(100., 1. / 100., num_topics)
+        expElogthetad = np.exp(dirichlet_expectation(gammad))
+        expElogbetad = expElogbeta[:, ids]
+        phinorm = np.dot(expElogthetad, expElogbetad) + 1e-100
+        for _ in range(shared['iterations']):
+            lastgamma = gammad
+            gammad = alpha + expElogthetad * np.dot(cts / phinorm,
+                                                    expElogbetad.T)
+            expElogthetad = np.exp(dirichlet_expectation(gammad))
+            phinorm = np.dot(expElogthetad, expElogbetad) + 1e-100
+            if np.mean(np.abs(gammad - lastgamma)) < shared['gamma_threshold']:
+                break
+        sstats[:, ids] += np.outer(expElogthetad.T, cts / phinorm)
+    sstats *= expElogbeta
+    return len(chunk)
+
+
+def train_local(corpus, num_topics, id2word, processes=None, passes=1,
+                chunksize=2000, decay=0.5, iterations=50,
+                gamma_threshold=0.001):
+    """
+    Train an LdaModel with the E-step spread over a local process pool
+
+    :type corpus: list
+    :param corpus: Bag-of-words documents
+
+    :type num_topics: int
+    :param num_topics: The number of topics
+
+    :type id2word: dict
+    :param id2word: Token ID to token
+
+    :type processes: int
+    :param processes: Worker processes; defaults to one per CPU
+
+    :type passes: int
+    :param passes: Passes over the corpus
+
+    :type chunksize: int
+    :param chunksize: Documents per worker per update
+
+    :type decay: float
+    :param decay: How quickly old mini-batches are forgotten (kappa)
+
+    :type iterations: int
+    :param iterations: The most variational iterations per document
+
+    :type gamma_threshold: float
+    :param gamma_threshold: Per-document convergence threshold
+
+    :rtype: class:`gensim.models.LdaModel`
+    :return: The trained model
+    """
+    processes = processes or cpu_count()
+    model = LdaModel(None, num_topics=num_topics, id2word=id2word,
+                     chunksize=chunksize, decay=decay, iterations=iterations)
+    shape = model.expElogbeta.shape
+    size = shape[0] * shape[1]
+    expElogbeta = RawArray('d', size)
+    sstats = [RawArray('d', size) for _ in range(processes)]
+    pool = Pool(processes=processes, initializer=init_worker,
+                initargs=(expElogbeta, sstats, shape,
+                          np.asarray(model.alpha, dtype=np.float64),
+                          iterations, gamma_threshold))
+    shared_beta = np.frombuffer(expElogbeta).reshape(shape)
+    slots = [np.frombuffer(buf).reshape(shape) for buf in sstats]
+
+    corpus = list(corpus)
+    model.state.numdocs += len(corpus)
+    batch = chunksize * processes
+    updates = 0
+    try:
+        for pass_ in range(passes):
+            for start in range(0, len(corpus), batch):
+                docs = corpus[start:start+batch]
+                shared_beta[:] = model.expElogbeta
+                shares = [docs[i:i+chunksize]
+                          for i in range(0, len(docs), chunksize)]
+                numdocs = sum(pool.map(estep, enumerate(shares)))
+                other = LdaState(model.eta, shape)
+                merged = slots[0].copy()
+                for slot in slots[1:len(shares)]:
+                    merged += slot
+                other.sstats = merged.astype(model.state.sstats.dtype)
+                other.numdocs = numdocs
+                model.do_mstep(pow(1.0 + updates, -decay), other)
+                updates += 1
+            log(u"Finished pass %d of %d" % (pass_ + 1, passes))
+    finally:
+        pool.close()
+        pool.join()
+    return model
+
+
+def corpus_work(corpus, num_topics):
+    """
+    :rtype: float
+    :return: Roughly how much work an E-step pass is: nonzero entries times
+             topics
+    """
+    return float(sum([len(doc) for doc in corpus])) * num_topics
+
+
+def choose_backend(backend, corpus, num_topics):
+    """
+    Resolve 'auto' to a concrete backend for this corpus
+
+    :rtype: string
+    :return: 'local' or 'pyro'
+    """
+    if backend != u'auto':
+        return backend
+    if corpus_work(corpus, num_topics) <= AUTO_LOCAL_MAX_WORK:
+        return u'local'
+    return u'pyro'
+
+
+def add_backend_args(ap):
+    """
+    Add the training backend options to a server's argument parser
+    """
+    ap.add_argument(u'--backend', dest=u'backend',
+                    default=os.getenv(u'LDA_BACKEND', u'auto'),
+                    choices=[u'auto', u'local', u'pyro'],
+                    help=u"Where to train: this machine, Pyro worker nodes, "
+                         u"or whichever suits the corpus size")
+    ap.add_argument(u'--local-processes', dest=u'local_processes', type=int,
+                    default=os.getenv(u'LOCAL_PROCESSES', cpu_count()),
+                    help=u"Processes for the local backend")
+    ap.add_argument(u'--passes', dest=u'passes', type=int,
+                    default=os.getenv(u'PASSES', 1),
+                    help=u"Passes over the corpus")
+    return ap
+
+
+class LdaTrainer(object):
+    """
+    Trains a server's model on the backend its arguments ask for, managing
+    worker nodes when that's the Pyro backend.
+    """
+
+    def __init__(self, args, node_ami):
+        """
+        :type args: class:`argparse.Namespace`
+        :param args: Server arguments, including the backend and node pool
+                     options
+
+        :type node_ami: string
+        :param node_ami: The AMI for Pyro worker nodes
+        """
+        self.args = args
+        self.node_ami = node_ami
+        self.node_pool = None
+
+    def acquire_nodes(self):
+        if self.node_pool is None:
+            self.node_pool = LdaNodePool(self.node_ami,
+                                         ttl=self.args.node_ttl)
+            if self.args.auto_launch:
+                self.node_pool.reclaim()
+                self.node_pool.acquire(self.args.instance_count)
+
+    def prepare(self):
+        """
+        Start worker nodes early, while features are being gathered, if
+        we already know they'll be needed
+        """
+        if self.args.backend == u'pyro':
+            self.acquire_nodes()
+
+    def train(self, corpus, id2word):
+        """
+        :type corpus: list
+        :param corpus: Bag-of-words documents
+
+        :type id2word: dict
+        :param id2word: Token ID to token
+
+        :rtype: class:`gensim.models.LdaModel`
+        :return: The trained model
+        """
+        corpus = list(corpus)
+        backend = choose_backend(self.args.backend, corpus,
+                                 self.args.num_topics)
+        log(u"Training on the %s backend" % backend)
+        start = time.time()
+        if backend == u'local':
+            model = train_local(corpus, self.args.num_topics, id2word,
+                                processes=self.args.local_processes,
+                                passes=self.args.passes)
+        else:
+            self.acquire_nodes()
+            if self.args.auto_launch:
+                log(u"Waiting for workers to register")
+                self.node_pool.wait_until_ready(self.args.instance_count)
+            model = LdaModel(corpus, num_topics=self.args.num_topics,
+                             id2word=id2word, distributed=True,
+                             passes=self.args.passes)
+        log(u"Trained in %.1f seconds" % (time.time() - start))
+        return model
+
+    def finish(self):
+        """
+        Release any worker nodes, keeping them warm if asked to
+        """
+        if self.node_pool is not None:
+            self.node_pool.release(keep_warm=self.args.keep_warm)
@@ -0,0 +1,95 @@
+"""
+Benchmarks LDA training backends on synthetic corpora drawn from LDA's own
+generative process, so the numbers don't depend on S3 or Solr.
+
+Compares gensim's single-process LdaModel with the local multi-process
+backend at a few corpus sizes, reporting training time and held-out
+per-word likelihood bound (higher is better) on documents drawn from the
+same topics as the training corpora. Both use the same mini-batch
+size, chunksize times processes, so they make the same number of updates.
+
+python -m wikia_dstk.lda.benchmark_backends --docs 2000,10000 --processes 4
+"""
+
+import argparse
+import numpy as np
+import time
+from gensim.models import LdaModel
+from .backends import train_local, corpus_work
+from .incremental import per_word_bound
+
+
+def get_args():
+    ap = argparse.ArgumentParser(description="Benchmark LDA training backends")
+    ap.add_argument('--docs', dest='docs', default='2000,10000',
+                    help="Comma-separated corpus sizes to try")
+    ap.add_argument('--vocab', dest='vocab', type=int, default=5000)
+    ap.add_argument('--true-topics', dest='true_topics', type=int, default=50)
+    ap.add_argument('--num-topics', dest='num_topics', type=int, default=50)
+    ap.add_argument('--doc-length', dest='doc_length', type=int, default=200)
+    ap.add_argument('--processes', dest='processes', type=int, default=4)
+    ap.add_argument('--chunksize', dest='chunksize', type=int, default=500,
+                    help="Documents per worker per update")
+    ap.add_argument('--passes', dest='passes', type=int, default=1)
+    ap.add_argument('--seed', dest='seed', type=int, default=0)
+    return ap.parse_args()
+
+
+def synthetic_topics(vocab, num_topics, rng):
+    """
+    Draw topic-word distributions from a sparse Dirichlet prior
+
+    :rtype: class:`numpy.ndarray`
+    :return: A num_topics x vocab array, each row a topic
+    """
+    return rng.dirichlet([0.05] * vocab, num_topics)
+
+
+def synthetic_corpus(num_docs, topics, doc_length, rng):
+    """
+    Draw documents from an LDA model with the given topics
+
+    :type topics: class:`numpy.ndarray`
+    :param topics: Topic-word distributions, from synthetic_topics; draw
+                   them once so every corpus shares them
+
+    :rtype: list
+    :return: Bag-of-words documents
+    """
+    corpus = []
+    for _ in range(num_docs):
+        theta = rng.dirichlet([0.1] * len(topics))
+        words = rng.multinomial(doc_length, np.dot(theta, topics))
+        corpus.append([(int(i), int(words[i])) for i in np.nonzero(words)[0]])
+    return corpus
+
+
+def main():
+    args = get_args()
+    rng = np.random.RandomState(args.seed)
+    id2word = dict([(i, 'w%d' % i) for i in range(args.vocab)])
+    topics = synthetic_topics(args.vocab, args.true_topics, rng)
+    heldout = synthetic_corpus(500, topics, args.doc_length, rng)
+    print '%-8s %8s %12s %10s %12s' % (
+        'backend', 'docs', 'work', 'seconds', 'bound/word')
+    for num_docs in [int(n) for n in args.docs.split(',')]:
+        corpus = synthetic_corpus(num_docs, topics, args.doc_length, rng)
+        work = corpus_work(corpus, args.num_topics)
+        for name, train in [
+                ('serial', lambda: LdaModel(
+                    corpus, num_topics=args.num_topics, id2word=id2word,
+                    chunksize=args.chunksize * args.processes,
+                    passes=args.passes)),
+                ('local', lambda: train_local(
+                    corpus, args.num_topics, id2word,
+                    processes=args.processes, chunksize=args.chunksize,
+                    passes=args.passes))]:
+            start = time.time()
+            model = train()
+            elapsed = time.time() - start
+            print '%-8s %8d %12.3g %10.2f %12.4f' % (
+                name, num_docs, work, elapsed, per_word_bound(model, heldout))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+Benchmarks request coalescing for topic inference, in process.
+
+At each concurrency level, that many threads send single documents back to
+back for a while, either straight to the model or through the coalescer
+with a few max_wait settings. Reports throughput and latency percentiles,
+and for the coalescer the mean batch size it achieved. The result cache is
+off so every request is inferred.
+
+python -m wikia_dstk.lda.benchmark_coalescer --concurrency 1,4,16,64
+"""
+
+import argparse
+import numpy as np
+import threading
+import time
+from gensim.models import LdaModel
+from .benchmark_backends import synthetic_corpus, synthetic_topics
+from .inference_server import TopicInferrer
+
+
+def get_args():
+    ap = argparse.ArgumentParser(description="Benchmark inference coalescing")
+    ap.add_argument('--concurrency', dest='concurrency', default='1,4,16,64',
+                    help="Comma-separated numbers of concurrent callers")
+    ap.add_argument('--max-waits-ms', dest='max_waits_ms', default='1,5,20',
+                    help="Comma-separated coalescer max waits to try")
+    ap.add_argument('--max-batch', dest='max_batch', type=int, default=64)
+    ap.add_argument('--seconds', dest='seconds', type=float, default=5.0,
+                    help="How long to run each configuration")
+    ap.add_argument('--vocab', dest='vocab', type=int, default=5000)
+    ap.add_argument('--num-topics', dest='num_topics', type=int, default=200)
+    ap.add_argument('--doc-length', dest='doc_length', type=int, default=100)
+    ap.add_argument('--seed', dest='seed', type=int, default=0)
+    return ap.parse_args()
+
+
+def caller(infer, docs, offset, deadline, latencies):
+    n = offset
+    while time.time() < deadline:
+        start = time.time()
+        infer(docs[n % len(docs)])
+        latencies.append(1000.0 * (time.time() - start))
+        n += 1
+
+
+def run(infer, docs, concurrency, seconds):
+    """
+    :rtype: tuple
+    :return: Requests per second, and p50 and p99 latency in milliseconds
+    """
+    latencies = [[] for _ in range(concurrency)]
+    deadline = time.time() + seconds
+    threads = [threading.Thread(target=caller,
+                                args=(infer, docs, n * 997, deadline,
+                                      latencies[n]))
+               for n in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    everything = [ms for thread_latencies in latencies
+                  for ms in thread_latencies]
+    return (len(everything) / seconds, np.percentile(everything, 50),
+            np.percentile(everything, 99))
+
+
+def main():
+    args = get_args()
+    rng = np.random.RandomState(args.seed)
+    id2word = dict([(i, 'w%d' % i) for i in range(args.vocab)])
+    topics = synthetic_topics(args.vocab, args.num_topics, rng)
+    corpus = synthetic_corpus(2000, topics, args.doc_length, rng)
+    model = LdaModel(corpus, num_topics=args.num_topics, id2word=id2word)
+    docs = [[id2word[token_id] for token_id, count in doc
+             for _ in range(count)]
+            for doc in synthetic_corpus(5000, topics, args.doc_length, rng)]
+
+    modes = [('direct', 0)] + [('wait %sms' % ms, float(ms) / 1000)
+                               for ms in args.max_waits_ms.split(',')]
+    print '%-11s %6s %10s %9s %9s %7s' % (
+        'mode', 'conc', 'req/s', 'p50 ms', 'p99 ms', 'batch')
+    for concurrency in [int(c) for c in args.concurrency.split(',')]:
+        for name, max_wait in modes:
+            inferrer = TopicInferrer(model, cache_size=0,
+                                     max_batch=args.max_batch,
+                                     max_wait=max_wait)
+            if inferrer.coalescer:
+                infer = inferrer.coalescer.infer
+            else:
+                infer = lambda tokens: inferrer.infer_tokens([tokens])[0]
+            throughput, p50, p99 = run(infer, docs, concurrency, args.seconds)
+            batch = 1.0
+            if inferrer.coalescer:
+                batch = inferrer.coalescer.stats()['mean_batch_size']
+            print '%-11s %6d %10.1f %9.2f %9.2f %7.1f' % (
+                name, concurrency, throughput, p50, p99, batch)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Groups concurrent single-document inference requests into batches.
+
+Callers submit one item at a time and block on a future. A single thread
+takes the first waiting item, keeps collecting until it has max_batch items
+or the first has waited max_wait seconds, runs one batch call, and hands
+each caller its own result. Under load this trades a few milliseconds of
+queueing for one matrix inference instead of many small ones; when idle an
+item waits at most max_wait.
+
+Achieved batch sizes and queueing delays are counted for /metrics.
+"""
+
+import threading
+from Queue import Queue, Empty
+from time import time
+from .. import Future
+from . import LatencyHistogram, log
+
+
+class InferenceCoalescer(object):
+    """Batches items submitted from many threads into one call."""
+
+    def __init__(self, infer_batch, max_batch=64, max_wait=0.005):
+        """
+        :type infer_batch: function
+        :param infer_batch: Takes a list of items and returns a list of
+                            results in the same order
+
+        :type max_batch: int
+        :param max_batch: The most items to run at once
+
+        :type max_wait: float
+        :param max_wait: The most seconds an item waits for others to join it
+        """
+        self.infer_batch = infer_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = Queue()
+        self.batch_sizes = {}
+        self.queue_delay = LatencyHistogram()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, item):
+        """
+        :rtype: class:`wikia_dstk.Future`
+        :return: Resolves to the item's result
+        """
+        future = Future()
+        self.queue.put((item, future, time()))
+        return future
+
+    def infer(self, item, timeout=None):
+        return self.submit(item).get(timeout)
+
+    def next_batch(self):
+        """
+        Block for an item, then gather more until the batch is full or the
+        first item has waited long enough
+
+        :rtype: list
+        :return: (item, future, submitted time) tuples
+        """
+        batch = [self.queue.get()]
+        deadline = batch[0][2] + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time()
+            try:
+                if remaining > 0:
+                    batch.append(self.queue.get(timeout=remaining))
+                else:
+                    # don't leave anything already queued for the next batch
+                    batch.append(self.queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            started = time()
+            for _, _, submitted in batch:
+                self.queue_delay.observe(1000.0 * (started - submitted))
+            self.batch_sizes[len(batch)] = (
+                self.batch_sizes.get(len(batch), 0) + 1)
+            try:
+                results = self.infer_batch([item for item, _, _ in batch])
+            except Exception as e:
+                log(u"Batch of", len(batch), u"failed:", e)
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
+
+    def stats(self):
+        """
+        :rtype: dict
+        :return: How many batches of each size were run, their mean size,
+                 and the queueing delay histogram
+        """
+        sizes = dict(self.batch_sizes)
+        batches = sum(sizes.values())
+        items = sum([size * count for size, count in sizes.items()])
+        return {u'batches': batches,
+                u'mean_batch_size': (float(items) / batches if batches
+                                     else None),
+                u'batch_sizes': sizes,
+                u'queue_delay': self.queue_delay.as_dict()}
@@ -1,4 +1,3 @@
-import time
 import warnings
 import os
 import argparse
@@ -9,8 +8,11 @@ import traceback
 from boto import connect_s3
 from collections import OrderedDict
 from datetime import datetime
-from . import launch_lda_nodes, terminate_lda_nodes, harakiri, ami
-from . import log, get_dct_and_bow_from_features, write_csv_and_text_data
+from . import harakiri, ami
+from . import log, write_csv_and_text_data
+from .backends import LdaTrainer, add_backend_args
+from .model_cache import ModelCache
+from .incremental import build_model, save_build_records, add_incremental_args
 
 
 def get_args():
@@ -50,6 +52,14 @@ def get_args():
                     help=u"A DSTK repo ref (tag, branch, commit hash) to check out")
     ap.add_argument(u'--s3file', dest=u's3file', default=os.getenv(U'S3FILE', None),
                     help=u'The location of the data file on S3')
+    ap.add_argument(u'--keep-warm', dest=u'keep_warm', action=u'store_true',
+                    default=bool(os.getenv(u'KEEP_WARM', u'')),
+                    help=u"Leave LDA worker nodes running for the next build")
+    ap.add_argument(u'--node-ttl', dest=u'node_ttl', type=int,
+                    default=os.getenv(u'NODE_TTL', 3600),
+                    help=u"Seconds an idle LDA worker node is kept before it's reclaimed")
+    add_backend_args(ap)
+    add_incremental_args(ap)
     return ap.parse_args()
 
 
@@ -76,38 +86,29 @@ def get_model_from_args(args):
         key = bucket.get_key(args.s3_prefix+modelname)
         if key is not None:
             log(u"(loading from s3)")
-            with open(u'/tmp/%s' % modelname, u'w') as fl:
-                key.get_contents_to_file(fl)
-            lda_model = gensim.models.LdaModel.load(u'/tmp/%s' % modelname)
+            lda_model = ModelCache().get_key(key)
         else:
             log(u"(building... this will take a while)")
+            trainer = LdaTrainer(args, args.ami)
             try:
-                if args.auto_launch:
-                    launching = launch_lda_nodes(args.instance_count, args.ami)
+                trainer.prepare()
                 log(u"Getting Data...")
                 id_to_features = get_feature_data(args)
-                log(u"Turning Data into Vectors")
-                dct, bow_docs = get_dct_and_bow_from_features(id_to_features)
-                log(u"Waiting for workers to get sorted out")
-                launching.wait()
-                log(u"Waiting an extra five minutes for workers to get their shit together")
-                time.sleep(300)
-                log(u"Finally building model from features")
-                lda_model = gensim.models.LdaModel(bow_docs.values(),
-                                                   num_topics=args.num_topics,
-                                                   id2word=dict([(x[1], x[0]) for x in dct.token2id.items()]),
-                                                   distributed=True)
+                log(u"Building model from features")
+                lda_model, bow_docs, doc_topics, provenance = build_model(
+                    args, trainer, bucket, modelname, id_to_features)
                 log(u"Done, saving model.")
                 lda_model.save(args.path_prefix+modelname)
                 log(u"uploading model to s3")
                 key = bucket.new_key(u'%s%s/%s/%s' % (args.s3_prefix, args.git_ref, args.model_prefix, modelname))
                 key.set_contents_from_file(open(args.path_prefix+modelname, u'r'))
-                write_csv_and_text_data(args, bucket, modelname, id_to_features, bow_docs, lda_model)
-                terminate_lda_nodes()
+                save_build_records(bucket, args.path_prefix+modelname, key.name, doc_topics, provenance)
+                write_csv_and_text_data(args, bucket, modelname, id_to_features, bow_docs, lda_model, doc_topics)
+                trainer.finish()
             except Exception as e:
                 log(str(e))
                 log(str(traceback.format_exc()))
-                terminate_lda_nodes()
+                trainer.finish()
                 return harakiri()
     return lda_model
 
@@ -0,0 +1,364 @@
+"""
+Warm-starts a server's model from an earlier build instead of training from
+scratch.
+
+Every build records, next to the model, a provenance file (the base model
+it was derived from, a hash of each document's features, and held-out
+likelihood) and the topics inferred for each document. Given
+--base-model-prefix, a build loads that model and its records from the local
+path or S3, grows its vocabulary with any new tokens, runs online update()
+passes over only the new or changed documents, and re-infers topics for
+only those documents, reusing the base model's topics for the rest.
+
+A deterministic sample of documents is held out of every build, scratch or
+incremental, so the per-word likelihood bound is checked on documents no
+model in the chain has trained on; a base built with a different held-out
+fraction isn't updated. With --compare-full-retrain a model is also trained
+from scratch on the same documents; if the incremental model falls too far
+behind it, the retrained model is used instead.
+"""
+
+import gensim
+import hashlib
+import json
+import numpy as np
+import os
+import time
+from collections import defaultdict
+from datetime import datetime
+from . import log, get_dct_and_bow_from_features
+
+PROVENANCE_SUFFIX = u'.provenance.json'
+DOC_TOPICS_SUFFIX = u'.doc-topics.json'
+STATE_SUFFIX = u'.state'
+
+
+def add_incremental_args(ap):
+    """
+    Add the warm-start options to a server's argument parser
+    """
+    ap.add_argument(u'--base-model-prefix', dest=u'base_model_prefix',
+                    default=os.getenv(u'BASE_MODEL_PREFIX', u''),
+                    help=u"Update the model built with this model prefix "
+                         u"rather than training from scratch")
+    ap.add_argument(u'--heldout-fraction', dest=u'heldout_fraction',
+                    type=float, default=os.getenv(u'HELDOUT_FRACTION', 0.05),
+                    help=u"Share of documents kept out of training "
+                         u"to check the model against")
+    ap.add_argument(u'--compare-full-retrain', dest=u'compare_full_retrain',
+                    action=u'store_true',
+                    default=bool(os.getenv(u'COMPARE_FULL_RETRAIN', u'')),
+                    help=u"Also train from scratch and keep whichever model "
+                         u"does better on held-out documents")
+    ap.add_argument(u'--retrain-tolerance', dest=u'retrain_tolerance',
+                    type=float, default=os.getenv(u'RETRAIN_TOLERANCE', 0.02),
+                    help=u"How much worse, relatively, the incremental "
+                         u"held-out bound may be than a full retrain's")
+    return ap
+
+
+def features_hash(features):
+    """
+    :rtype: string
+    :return: A hash of a document's features, ignoring their order
+    """
+    return hashlib.sha1(u' '.join(sorted(features)).encode(u'utf-8')
+                        ).hexdigest()
+
+
+def is_heldout(name, fraction):
+    """
+    Whether a document is in the held-out sample; the same documents are
+    held out on every build
+    """
+    digest = hashlib.sha1(unicode(name).encode(u'utf-8')).hexdigest()
+    return int(digest[:8], 16) % 10000 < fraction * 10000
+
+
+def doc2bow(features, token2id):
+    counts = defaultdict(int)
+    for feature in features:
+        token_id = token2id.get(feature)
+        if token_id is not None:
+            counts[token_id] += 1
+    return sorted(counts.items())
+
+
+def per_word_bound(model, corpus):
+    """
+    :rtype: float
+    :return: The model's likelihood bound per word of the corpus, or None
+             if it's empty
+    """
+    words = sum([count for doc in corpus for _, count in doc])
+    if not words:
+        return None
+    return model.bound(corpus) / words
+
+
+def infer(model, bow_docs, names):
+    """
+    :rtype: dict
+    :return: Document name to sparse topic vector
+    """
+    return dict([(name, model[bow_docs[name]]) for name in names])
+
+
+def fetch(bucket, key_names, local_path):
+    """
+    Download the first of a list of keys that exists
+
+    :rtype: bool
+    :return: Whether anything was downloaded
+    """
+    for key_name in key_names:
+        key = bucket.get_key(key_name)
+        if key is not None:
+            key.get_contents_to_filename(local_path)
+            return True
+    return False
+
+
+def base_key_names(args, basename):
+    """
+    :rtype: list
+    :return: The S3 keys a base model may have been uploaded to
+    """
+    return [u'%s%s/%s/%s' % (args.s3_prefix, args.git_ref,
+                             args.base_model_prefix, basename),
+            args.s3_prefix + basename]
+
+
+def load_base(args, bucket, modelname):
+    """
+    Load the base model for a build, along with its records
+
+    :rtype: tuple
+    :return: The base model's name, the model, its provenance and its doc
+             topics; the model is None if it can't be warm-started from
+    """
+    basename = modelname.replace(args.model_prefix, args.base_model_prefix, 1)
+    local_path = os.path.join(args.path_prefix, basename)
+    if not os.path.exists(local_path):
+        log(u"Fetching base model", basename, u"from s3")
+        local_path = u'/tmp/%s' % basename
+        key_names = base_key_names(args, basename)
+        if not fetch(bucket, key_names, local_path):
+            log(u"Base model", basename, u"not found")
+            return basename, None, {}, {}
+        for suffix in (STATE_SUFFIX, PROVENANCE_SUFFIX, DOC_TOPICS_SUFFIX):
+            fetch(bucket, [k + suffix for k in key_names], local_path + suffix)
+
+    model = gensim.models.LdaModel.load(local_path)
+    if getattr(model, u'state', None) is None:
+        log(u"Base model", basename, u"has no saved state to update")
+        return basename, None, {}, {}
+    if model.num_topics != args.num_topics:
+        log(u"Base model", basename, u"has", model.num_topics, u"topics, not",
+            args.num_topics)
+        return basename, None, {}, {}
+    # it was trained elsewhere; updates are small enough to do here
+    model.distributed = False
+    model.dispatcher = None
+    model.numworkers = 1
+
+    records = []
+    for suffix in (PROVENANCE_SUFFIX, DOC_TOPICS_SUFFIX):
+        try:
+            with open(local_path + suffix) as fl:
+                records.append(json.load(fl))
+        except (IOError, ValueError):
+            log(u"No usable", suffix, u"for", basename)
+            records.append({})
+    provenance, doc_topics = records
+    return basename, model, provenance, doc_topics
+
+
+def extend_vocabulary(model, tokens):
+    """
+    Add tokens the model hasn't seen, with empty sufficient statistics, so
+    that updates can learn them
+
+    :type model: class:`gensim.models.LdaModel`
+    :param model: The model to grow, in place
+
+    :type tokens: list
+    :param tokens: Tokens to make sure the model knows
+
+    :rtype: dict
+    :return: Token to token ID for the grown vocabulary
+    """
+    id2word = dict([(token_id, model.id2word[token_id])
+                    for token_id in range(model.num_terms)])
+    token2id = dict([(token, token_id) for token_id, token in id2word.items()])
+    added = 0
+    for token in tokens:
+        if token not in token2id:
+            token2id[token] = len(id2word)
+            id2word[token2id[token]] = token
+            added += 1
+    if added:
+        state = model.state
+        state.sstats = np.hstack([
+            state.sstats,
+            np.zeros((model.num_topics, added), dtype=state.sstats.dtype)])
+        if np.ndim(model.eta):
+            model.eta = np.concatenate(
+                [model.eta, np.repeat(np.mean(model.eta), added)]
+            ).astype(model.eta.dtype)
+            state.eta = model.eta
+        model.num_terms += added
+        model.sync_state()
+    model.id2word = id2word
+    log(u"Added", added, u"tokens to the base model's", len(id2word) - added)
+    return token2id
+
+
+def build_model(args, trainer, bucket, modelname, id_to_features):
+    """
+    Build a server's model, incrementally from --base-model-prefix if it's
+    given and usable, otherwise from scratch
+
+    :type args: class:`argparse.Namespace`
+    :param args: Server arguments
+
+    :type trainer: class:`wikia_dstk.lda.backends.LdaTrainer`
+    :param trainer: Trains models from scratch
+
+    :type bucket: class:`boto.s3.bucket.Bucket`
+    :param bucket: Where base models live
+
+    :type modelname: string
+    :param modelname: The name of the model being built
+
+    :type id_to_features: dict
+    :param id_to_features: Document name to its features
+
+    :rtype: tuple
+    :return: The model, document name to bag of words, document name to
+             topics, and the build's provenance
+    """
+    provenance = {u'model': modelname, u'base_model': None,
+                  u'built': datetime.now().isoformat(),
+                  u'git_ref': args.git_ref, u'num_docs': len(id_to_features),
+                  u'heldout_fraction': args.heldout_fraction,
+                  u'doc_hashes': dict([(unicode(name), features_hash(features))
+                                       for name, features
+                                       in id_to_features.items()])}
+    dct, bow_docs = get_dct_and_bow_from_features(id_to_features)
+
+    base = None
+    if args.base_model_prefix:
+        basename, base, base_provenance, base_topics = load_base(
+            args, bucket, modelname)
+        if (base is not None and base_provenance.get(u'heldout_fraction')
+                != args.heldout_fraction):
+            # it may have trained on what this build holds out
+            log(u"Base model", basename, u"wasn't built with a held-out "
+                u"fraction of", args.heldout_fraction)
+            base = None
+    if base is None:
+        if args.base_model_prefix:
+            log(u"Training from scratch instead")
+        # held-out docs stay out of the base, so later builds can score
+        # updates on documents neither model has seen
+        heldout = [name for name in bow_docs
+                   if is_heldout(name, args.heldout_fraction)]
+        kept_out = set(heldout)
+        lda_model = trainer.train(
+            [bow for name, bow in bow_docs.items() if name not in kept_out],
+            dict([(token_id, token)
+                  for token, token_id in dct.token2id.items()]))
+        provenance[u'num_terms'] = lda_model.num_terms
+        provenance[u'heldout_docs'] = len(heldout)
+        return (lda_model, bow_docs,
+                infer(lda_model, bow_docs, bow_docs.keys()), provenance)
+
+    provenance[u'base_model'] = basename
+    base_hashes = base_provenance.get(u'doc_hashes', {})
+    num_terms = base.num_terms
+    token2id = extend_vocabulary(base, dct.token2id.keys())
+    bow_docs = dict([(name, doc2bow(features, token2id))
+                     for name, features in id_to_features.items()])
+
+    changed, heldout = [], []
+    for name in bow_docs:
+        if is_heldout(name, args.heldout_fraction):
+            heldout.append(name)
+        elif (base_hashes.get(unicode(name))
+              != provenance[u'doc_hashes'][unicode(name)]):
+            changed.append(name)
+    heldout_corpus = [bow_docs[name] for name in heldout]
+    provenance.update({
+        u'num_terms': base.num_terms, u'new_terms': base.num_terms - num_terms,
+        u'changed_docs': len(changed),
+        u'new_docs': len([name for name in changed
+                          if unicode(name) not in base_hashes]),
+        u'removed_docs': len([name for name in base_hashes
+                              if name not in provenance[u'doc_hashes']]),
+        u'heldout_docs': len(heldout),
+        u'base_heldout_bound': per_word_bound(base, heldout_corpus)})
+    log(u"Updating", basename, u"with", len(changed), u"new or changed of",
+        len(bow_docs), u"documents,", len(heldout), u"held out")
+
+    start = time.time()
+    if changed:
+        base.update([bow_docs[name] for name in changed], passes=args.passes)
+    provenance[u'update_seconds'] = time.time() - start
+    provenance[u'heldout_bound'] = per_word_bound(base, heldout_corpus)
+    log(u"Held-out bound per word went from",
+        provenance[u'base_heldout_bound'], u"to", provenance[u'heldout_bound'])
+
+    if args.compare_full_retrain:
+        log(u"Training from scratch to compare")
+        start = time.time()
+        kept_out = set(heldout)
+        retrained = trainer.train(
+            [bow_docs[name] for name in bow_docs if name not in kept_out],
+            base.id2word)
+        provenance[u'retrain_seconds'] = time.time() - start
+        full_bound = per_word_bound(retrained, heldout_corpus)
+        provenance[u'full_retrain_heldout_bound'] = full_bound
+        log(u"Full retrain held-out bound per word", full_bound)
+        bound = provenance[u'heldout_bound']
+        if (full_bound is not None and bound is not None and
+                full_bound - bound > args.retrain_tolerance * abs(full_bound)):
+            log(u"Incremental model is too far behind; using the retrain")
+            provenance[u'base_model'] = None
+            provenance[u'rejected_base_model'] = basename
+            return (retrained, bow_docs,
+                    infer(retrained, bow_docs, bow_docs.keys()), provenance)
+
+    unchanged = set(bow_docs) - set(changed) - set(heldout)
+    stale = [name for name in bow_docs
+             if name not in unchanged or unicode(name) not in base_topics]
+    doc_topics = infer(base, bow_docs, stale)
+    for name in bow_docs:
+        if name not in doc_topics:
+            doc_topics[name] = [tuple(pair)
+                                for pair in base_topics[unicode(name)]]
+    log(u"Re-inferred topics for", len(stale), u"documents")
+    return base, bow_docs, doc_topics, provenance
+
+
+def save_build_records(bucket, model_path, key_name, doc_topics, provenance):
+    """
+    Write a build's doc topics and provenance next to its saved model, and
+    upload them, with the model's state, next to its S3 key
+
+    :type model_path: string
+    :param model_path: Where the model was saved locally
+
+    :type key_name: string
+    :param key_name: The S3 key the model was uploaded to
+    """
+    with open(model_path + DOC_TOPICS_SUFFIX, u'w') as fl:
+        json.dump(dict([(name, [(int(topic), float(weight))
+                                for topic, weight in topics])
+                        for name, topics in doc_topics.items()]), fl)
+    with open(model_path + PROVENANCE_SUFFIX, u'w') as fl:
+        json.dump(provenance, fl, indent=1, sort_keys=True)
+    for suffix in (STATE_SUFFIX, DOC_TOPICS_SUFFIX, PROVENANCE_SUFFIX):
+        if os.path.exists(model_path + suffix):
+            bucket.new_key(key_name + suffix).set_contents_from_filename(
+                model_path + suffix)
@@ -0,0 +1,274 @@
+"""
+Serves topic inference for any trained LDA model.
+
+POST /infer with a batch of documents, each either raw terms (titles,
+heads, entities; normalized the way the servers build features) or tokens
+that are already normalized:
+
+    {"docs": [{"id": "1", "terms": ["Star Wars", "Luke Skywalker"]},
+              {"id": "2", "tokens": ["star_war", "luke_skywalk"]}]}
+
+and get back sparse topic vectors, one per document:
+
+    {"status": 200, "results": {"1": [[4, 0.61], ...], "2": [...]}}
+
+Every document in a batch that isn't already cached is inferred in one call
+to the model. Requests smaller than --max-batch go through a coalescer, so
+single documents posted concurrently are inferred together too. Results are
+cached by a hash of the document's tokens. GET /metrics reports request
+counts, cache hit rates, latency, and achieved batch sizes and queueing
+delay.
+
+python -m wikia_dstk.lda.inference_server --s3-key models/wiki/some.model
+"""
+
+import argparse
+import json
+import numpy as np
+import threading
+import time
+from collections import OrderedDict
+from boto import connect_s3
+from flask import Flask, request, Response
+from . import normalize, log, LatencyHistogram
+from .coalescer import InferenceCoalescer
+from .incremental import features_hash
+from .model_cache import ModelCache
+
+app = Flask(__name__)
+inferrer = None
+
+
+class LruCache(object):
+    """A bounded mapping that forgets the least recently used entries."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+
+class TopicInferrer(object):
+    """Batched, cached inference against one model."""
+
+    def __init__(self, model, cache_size=100000, minimum_probability=0.01,
+                 max_batch=64, max_wait=0.005):
+        """
+        :type model: class:`gensim.models.LdaModel`
+        :param model: The model to infer topics with
+
+        :type cache_size: int
+        :param cache_size: Documents to keep results for
+
+        :type minimum_probability: float
+        :param minimum_probability: Leave out topics less likely than this
+
+        :type max_batch: int
+        :param max_batch: The most documents to coalesce into one call;
+                          bigger requests are inferred as they are
+
+        :type max_wait: float
+        :param max_wait: The most seconds a document waits to be coalesced
+                         with others; 0 turns coalescing off
+        """
+        self.model = model
+        self.token2id = dict([(model.id2word[token_id], token_id)
+                              for token_id in range(model.num_terms)])
+        self.cache = LruCache(cache_size)
+        self.minimum_probability = minimum_probability
+        self.latency = LatencyHistogram()
+        self.requests = 0
+        self.docs = 0
+        self.lock = threading.Lock()
+        self.coalescer = None
+        if max_wait > 0:
+            self.coalescer = InferenceCoalescer(self.infer_tokens, max_batch,
+                                                max_wait)
+
+    def tokens(self, doc):
+        """
+        :type doc: dict
+        :param doc: A document with either `terms` or `tokens`
+
+        :rtype: list
+        :return: The document's normalized tokens
+        """
+        if u'tokens' in doc:
+            return doc[u'tokens']
+        return filter(lambda x: x, map(normalize, doc.get(u'terms', [])))
+
+    def bow(self, tokens):
+        counts = {}
+        for token in tokens:
+            token_id = self.token2id.get(token)
+            if token_id is not None:
+                counts[token_id] = counts.get(token_id, 0) + 1
+        return sorted(counts.items())
+
+    def infer_tokens(self, token_lists):
+        """
+        Infer topics for many documents, with a single call to the model for
+        every document not already cached
+
+        :type token_lists: list
+        :param token_lists: Each document's normalized tokens
+
+        :rtype: list
+        :return: A sparse topic vector per document
+        """
+        hashes = [features_hash(tokens) for tokens in token_lists]
+        results = [self.cache.get(hsh) for hsh in hashes]
+        todo = [n for n, result in enumerate(results) if result is None]
+        bows = [self.bow(token_lists[n]) for n in todo]
+        nonempty = [(n, bow) for n, bow in zip(todo, bows) if bow]
+        if nonempty:
+            gamma, _ = self.model.inference([bow for _, bow in nonempty])
+            gamma /= gamma.sum(axis=1)[:, np.newaxis]
+            for (n, _), row in zip(nonempty, gamma):
+                topics = np.nonzero(row >= self.minimum_probability)[0]
+                results[n] = [(int(topic), float(row[topic]))
+                              for topic in topics]
+        for n in todo:
+            if results[n] is None:
+                results[n] = []  # nothing the model knows
+            self.cache.put(hashes[n], results[n])
+        return results
+
+    def infer(self, docs):
+        """
+        :type docs: list
+        :param docs: Documents as posted to /infer
+
+        :rtype: dict
+        :return: Document ID to sparse topic vector
+        """
+        start = time.time()
+        token_lists = [self.tokens(doc) for doc in docs]
+        if self.coalescer and len(docs) < self.coalescer.max_batch:
+            futures = map(self.coalescer.submit, token_lists)
+            results = [future.get() for future in futures]
+        else:
+            results = self.infer_tokens(token_lists)
+        self.latency.observe(1000.0 * (time.time() - start))
+        with self.lock:
+            self.requests += 1
+            self.docs += len(docs)
+        return dict([(doc.get(u'id', n), result)
+                     for n, (doc, result) in enumerate(zip(docs, results))])
+
+    def metrics(self):
+        metrics = {u'requests': self.requests, u'docs': self.docs,
+                   u'cache_hits': self.cache.hits,
+                   u'cache_misses': self.cache.misses,
+                   u'cached': len(self.cache.entries),
+                   u'latency': self.latency.as_dict()}
+        if self.coalescer:
+            metrics[u'coalescer'] = self.coalescer.stats()
+        return metrics
+
+
+def valid_docs(docs):
+    """
+    :rtype: bool
+    :return: Whether docs is a list of objects whose terms and tokens are
+             lists of strings
+    """
+    if not isinstance(docs, list):
+        return False
+    for doc in docs:
+        if not isinstance(doc, dict):
+            return False
+        for field in (u'terms', u'tokens'):
+            values = doc.get(field, [])
+            if not isinstance(values, list) or \
+                    not all([isinstance(v, basestring) for v in values]):
+                return False
+    return True
+
+
+def json_response(data, status=200):
+    return Response(json.dumps(data), status=status,
+                    mimetype=u'application/json')
+
+
+@app.route(u'/infer', methods=[u'POST'])
+def infer():
+    try:
+        docs = json.loads(request.get_data())[u'docs']
+        if not valid_docs(docs):
+            raise ValueError(docs)
+    except (ValueError, KeyError, TypeError):
+        return json_response({u'status': 400, u'message': u'Expected JSON '
+                              u'with a list of docs'}, 400)
+    try:
+        return json_response({u'status': 200,
+                              u'results': inferrer.infer(docs)})
+    except Exception as e:
+        log(u"Inference failed:", e)
+        return json_response({u'status': 500, u'message': unicode(e)}, 500)
+
+
+@app.route(u'/metrics')
+def metrics():
+    return json_response(inferrer.metrics())
+
+
+def get_args():
+    ap = argparse.ArgumentParser(description=u"Serve LDA topic inference")
+    ap.add_argument(u'--model', dest=u'model', default=u'',
+                    help=u"A model saved on this box")
+    ap.add_argument(u'--s3-key', dest=u's3_key', default=u'',
+                    help=u"The key in nlp-data of a model to serve otherwise")
+    ap.add_argument(u'--cache-size', dest=u'cache_size', type=int,
+                    default=100000, help=u"Documents to cache results for")
+    ap.add_argument(u'--minimum-probability', dest=u'minimum_probability',
+                    type=float, default=0.01)
+    ap.add_argument(u'--max-batch', dest=u'max_batch', type=int, default=64,
+                    help=u"The most documents to coalesce into one call")
+    ap.add_argument(u'--max-wait-ms', dest=u'max_wait_ms', type=float,
+                    default=5,
+                    help=u"The most milliseconds a document waits to be "
+                         u"coalesced with others; 0 turns coalescing off")
+    ap.add_argument(u'--host', dest=u'host', default=u'0.0.0.0')
+    ap.add_argument(u'--port', dest=u'port', type=int, default=5000)
+    return ap.parse_args()
+
+
+def main():
+    global inferrer
+    args = get_args()
+    cache = ModelCache()
+    if args.model:
+        model = cache.get_file(args.model)
+    else:
+        model = cache.get(connect_s3().get_bucket(u'nlp-data'), args.s3_key)
+        if model is None:
+            raise StandardError(u"%s does not exist" % args.s3_key)
+    inferrer = TopicInferrer(model, cache_size=args.cache_size,
+                             minimum_probability=args.minimum_probability,
+                             max_batch=args.max_batch,
+                             max_wait=args.max_wait_ms / 1000.0)
+    app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
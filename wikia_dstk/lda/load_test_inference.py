@@ -0,0 +1,115 @@
+"""
+Drives the inference server with concurrent clients and reports throughput
+and latency, as seen by the clients and by the server's /metrics.
+
+Documents are drawn from a JSON file of document ID to features, the same
+format the video server reads; --repeat-fraction of them are sent again so
+the server's result cache gets exercised.
+
+python -m wikia_dstk.lda.load_test_inference --features video.json \
+    --clients 8 --requests 500 --batch-size 20
+"""
+
+import argparse
+import json
+import numpy as np
+import random
+import requests
+import threading
+import time
+
+
+class InferenceClient(object):
+    """Talks to an inference server over a keep-alive session."""
+
+    def __init__(self, url):
+        self.url = url.rstrip(u'/')
+        self.session = requests.Session()
+
+    def infer(self, docs):
+        """
+        :type docs: list
+        :param docs: Documents, each a dict with an `id` and `tokens` or
+                     `terms`
+
+        :rtype: dict
+        :return: Document ID to sparse topic vector
+        """
+        response = self.session.post(self.url + u'/infer',
+                                     data=json.dumps({u'docs': docs}))
+        response.raise_for_status()
+        return response.json()[u'results']
+
+    def metrics(self):
+        return self.session.get(self.url + u'/metrics').json()
+
+
+def get_args():
+    ap = argparse.ArgumentParser(description=u"Load test the inference server")
+    ap.add_argument(u'--url', dest=u'url', default=u'http://localhost:5000')
+    ap.add_argument(u'--features', dest=u'features', required=True,
+                    help=u"A JSON file of document ID to tokens")
+    ap.add_argument(u'--clients', dest=u'clients', type=int, default=8)
+    ap.add_argument(u'--requests', dest=u'requests', type=int, default=500,
+                    help=u"Requests per client")
+    ap.add_argument(u'--batch-size', dest=u'batch_size', type=int, default=20)
+    ap.add_argument(u'--repeat-fraction', dest=u'repeat_fraction', type=float,
+                    default=0.2,
+                    help=u"Share of documents that were already sent")
+    ap.add_argument(u'--seed', dest=u'seed', type=int, default=0)
+    return ap.parse_args()
+
+
+def client_loop(args, docs, seed, latencies, errors):
+    client = InferenceClient(args.url)
+    rng = random.Random(seed)
+    sent = []
+    for _ in range(args.requests):
+        batch = []
+        for _ in range(args.batch_size):
+            if sent and rng.random() < args.repeat_fraction:
+                batch.append(rng.choice(sent))
+            else:
+                batch.append(rng.choice(docs))
+                sent.append(batch[-1])
+        start = time.time()
+        try:
+            client.infer(batch)
+        except Exception as e:
+            errors.append(e)
+            continue
+        latencies.append(1000.0 * (time.time() - start))
+
+
+def main():
+    args = get_args()
+    with open(args.features) as fl:
+        docs = [{u'id': doc_id, u'tokens': tokens}
+                for doc_id, tokens in json.load(fl).items()]
+    latencies, errors = [], []
+    threads = [threading.Thread(target=client_loop,
+                                args=(args, docs, args.seed + n, latencies,
+                                      errors))
+               for n in range(args.clients)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    print u"%d requests of %d docs from %d clients in %.1f seconds" % (
+        len(latencies), args.batch_size, args.clients, elapsed)
+    print u"%.1f requests/s, %.1f docs/s, %d errors" % (
+        len(latencies) / elapsed, len(latencies) * args.batch_size / elapsed,
+        len(errors))
+    if latencies:
+        print u"client latency ms: p50 %.1f, p90 %.1f, p99 %.1f, max %.1f" % (
+            np.percentile(latencies, 50), np.percentile(latencies, 90),
+            np.percentile(latencies, 99), max(latencies))
+    print u"server metrics:"
+    print json.dumps(InferenceClient(args.url).metrics(), indent=2)
+
+
+if __name__ == '__main__':
+    main()
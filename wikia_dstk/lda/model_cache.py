@@ -0,0 +1,299 @@
+"""
+A local cache of LDA models, stored so they load memory-mapped.
+
+Entries are keyed by model name and ETag, so a model that's been rebuilt
+under the same name is fetched again. A download is checked against its
+ETag, which is the MD5 of anything uploaded in one part; for multipart
+uploads, a `<key>.sha1` sidecar is used if there is one. The model is then
+unpickled once and re-saved with its large arrays (the topic-word matrix and
+sufficient statistics) in .npy files beside a pickle of everything else.
+Loading reads the pickle and maps the arrays read-only, so every process on
+a box shares one copy of them through the page cache.
+
+Entries are filled in a temporary directory and renamed into place, so
+processes sharing the cache never see half a model. The least recently used
+entries are evicted once the cache is bigger than its limit.
+
+Prefetch models at boot with:
+
+python -m wikia_dstk.lda.model_cache models/wiki/some.model
+"""
+
+import argparse
+import cPickle
+import gensim
+import hashlib
+import json
+import numpy as np
+import os
+import shutil
+import tempfile
+import time
+from boto import connect_s3
+from . import log
+
+CACHE_DIR = os.getenv(u'MODEL_CACHE_DIR', u'/mnt/model_cache/')
+CACHE_BYTES = int(os.getenv(u'MODEL_CACHE_BYTES', 20 * 1024 ** 3))
+
+# arrays big enough to be worth mapping rather than unpickling
+MMAP_ATTRIBUTES = [u'expElogbeta', u'state.sstats']
+
+MANIFEST = u'manifest.json'
+PICKLE = u'model.pkl'
+
+
+class ChecksumError(Exception):
+    pass
+
+
+def file_digest(path, algorithm):
+    digest = hashlib.new(algorithm)
+    with open(path, u'rb') as fl:
+        for block in iter(lambda: fl.read(1024 * 1024), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def get_attribute(obj, dotted):
+    for name in dotted.split(u'.'):
+        obj = getattr(obj, name, None)
+    return obj
+
+
+def set_attribute(obj, dotted, value):
+    names = dotted.split(u'.')
+    for name in names[:-1]:
+        obj = getattr(obj, name)
+    setattr(obj, names[-1], value)
+
+
+def directory_size(path):
+    return sum([os.path.getsize(os.path.join(root, name))
+                for root, _, names in os.walk(path) for name in names])
+
+
+def split_model(model, directory):
+    """
+    Save a model as a pickle without its large arrays, plus an .npy file
+    per array
+
+    :type model: class:`gensim.models.LdaModel`
+    :param model: The model to save; it's left as it was
+
+    :type directory: string
+    :param directory: Where to save it
+
+    :rtype: list
+    :return: The attributes saved as arrays
+    """
+    arrays = dict([(attr, get_attribute(model, attr))
+                   for attr in MMAP_ATTRIBUTES])
+    arrays = dict([(attr, array) for attr, array in arrays.items()
+                   if isinstance(array, np.ndarray)])
+    dispatcher = getattr(model, u'dispatcher', None)
+    try:
+        model.dispatcher = None
+        for attr, array in arrays.items():
+            np.save(os.path.join(directory, attr + u'.npy'), array)
+            set_attribute(model, attr, None)
+        with open(os.path.join(directory, PICKLE), u'wb') as fl:
+            cPickle.dump(model, fl, protocol=2)
+    finally:
+        model.dispatcher = dispatcher
+        for attr, array in arrays.items():
+            set_attribute(model, attr, array)
+    return arrays.keys()
+
+
+def load_split_model(directory):
+    """
+    :rtype: class:`gensim.models.LdaModel`
+    :return: A model saved by split_model, its arrays mapped read-only
+    """
+    with open(os.path.join(directory, MANIFEST)) as fl:
+        manifest = json.load(fl)
+    with open(os.path.join(directory, PICKLE), u'rb') as fl:
+        model = cPickle.load(fl)
+    for attr in manifest[u'arrays']:
+        set_attribute(model, attr, np.load(
+            os.path.join(directory, attr + u'.npy'), mmap_mode=u'r'))
+    return model
+
+
+class ModelCache(object):
+    """LDA models from S3 or disk, cached locally for memory-mapped loads."""
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=CACHE_BYTES):
+        """
+        :type directory: string
+        :param directory: Where to keep cached models
+
+        :type max_bytes: int
+        :param max_bytes: How big the cache may get before entries are
+                          evicted
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass  # another process made it first
+
+    def entry_path(self, name, version):
+        return os.path.join(self.directory, u'%s.%s' % (
+            os.path.basename(name), version))
+
+    def entries(self):
+        """
+        :rtype: list
+        :return: Paths of complete entries, least recently used first
+        """
+        paths = [os.path.join(self.directory, entry)
+                 for entry in os.listdir(self.directory)
+                 if not entry.startswith(u'tmp')]
+        paths = [path for path in paths
+                 if os.path.exists(os.path.join(path, MANIFEST))]
+        return sorted(paths, key=os.path.getmtime)
+
+    def load(self, path):
+        os.utime(path, None)  # for LRU eviction
+        start = time.time()
+        model = load_split_model(path)
+        log(u"Loaded", os.path.basename(path), u"in %.2f seconds" % (
+            time.time() - start))
+        return model
+
+    def fill(self, path, name, version, load_model):
+        """
+        Build an entry in a temporary directory and move it into place
+
+        :type load_model: function
+        :param load_model: Called with the temporary directory, to get the
+                           model; anything it leaves there is removed
+        """
+        tmp = tempfile.mkdtemp(prefix=u'tmp', dir=self.directory)
+        os.chmod(tmp, 0o755)
+        try:
+            model = load_model(tmp)
+            for filename in os.listdir(tmp):
+                os.remove(os.path.join(tmp, filename))
+            arrays = split_model(model, tmp)
+            with open(os.path.join(tmp, MANIFEST), u'w') as fl:
+                json.dump({u'name': name, u'version': version,
+                           u'arrays': arrays, u'created': time.time()}, fl)
+            try:
+                os.rename(tmp, path)
+            except OSError:
+                log(u"Another process cached", name, u"first")
+        finally:
+            if os.path.exists(tmp):
+                shutil.rmtree(tmp)
+        for stale in self.entries():
+            if (stale != path and os.path.basename(stale).startswith(
+                    os.path.basename(name) + u'.')):
+                shutil.rmtree(stale, ignore_errors=True)
+        self.evict(keep=path)
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used entries until the cache fits
+
+        :type keep: string
+        :param keep: An entry not to remove
+        """
+        entries = [(path, directory_size(path)) for path in self.entries()]
+        total = sum([size for _, size in entries])
+        for path, size in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            log(u"Evicting", os.path.basename(path), u"from the model cache")
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def get_key(self, key):
+        """
+        :type key: class:`boto.s3.key.Key`
+        :param key: An S3 key for a saved model, as returned by
+                    bucket.get_key so that its ETag is known
+
+        :rtype: class:`gensim.models.LdaModel`
+        :return: The model, with its large arrays memory-mapped
+        """
+        etag = key.etag.strip(u'"')
+        path = self.entry_path(key.name, etag)
+        if not os.path.exists(os.path.join(path, MANIFEST)):
+            log(u"Caching", key.name)
+            self.fill(path, key.name, etag,
+                      lambda tmp: self.download(key, etag, tmp))
+        return self.load(path)
+
+    def get(self, bucket, key_name):
+        """
+        :rtype: class:`gensim.models.LdaModel`
+        :return: The model at a key, or None if there isn't one
+        """
+        key = bucket.get_key(key_name)
+        if key is None:
+            return None
+        return self.get_key(key)
+
+    def get_file(self, filename):
+        """
+        :rtype: class:`gensim.models.LdaModel`
+        :return: A model saved on this box, cached until the file changes
+        """
+        stat = os.stat(filename)
+        version = u'%d-%d' % (stat.st_size, stat.st_mtime)
+        path = self.entry_path(filename, version)
+        if not os.path.exists(os.path.join(path, MANIFEST)):
+            self.fill(path, filename, version,
+                      lambda tmp: gensim.models.LdaModel.load(filename))
+        return self.load(path)
+
+    def download(self, key, etag, directory):
+        """
+        Download a key, check it against its ETag, or its sha1 sidecar if it
+        was a multipart upload, and load it
+
+        :rtype: class:`gensim.models.LdaModel`
+        :return: The downloaded model
+        """
+        filename = os.path.join(directory, os.path.basename(key.name))
+        key.get_contents_to_filename(filename)
+        if u'-' not in etag:
+            if file_digest(filename, u'md5') != etag:
+                raise ChecksumError(u"%s doesn't match its ETag" % key.name)
+        else:
+            sidecar = key.bucket.get_key(key.name + u'.sha1')
+            if sidecar is None:
+                log(u"Can't validate multipart upload", key.name)
+            elif (file_digest(filename, u'sha1')
+                  != sidecar.get_contents_as_string().strip()):
+                raise ChecksumError(u"%s doesn't match its sha1" % key.name)
+        return gensim.models.LdaModel.load(filename)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=u"Prefetch LDA models into the "
+                                             u"local model cache")
+    ap.add_argument(u'keys', nargs=u'*', help=u"S3 keys of models to cache")
+    ap.add_argument(u'--bucket', dest=u'bucket', default=u'nlp-data')
+    ap.add_argument(u'--cache-dir', dest=u'cache_dir', default=CACHE_DIR)
+    ap.add_argument(u'--max-bytes', dest=u'max_bytes', type=int,
+                    default=CACHE_BYTES)
+    args = ap.parse_args()
+
+    cache = ModelCache(args.cache_dir, args.max_bytes)
+    bucket = connect_s3().get_bucket(args.bucket)
+    for key_name in args.keys:
+        if cache.get(bucket, key_name) is None:
+            print key_name, u"does not exist"
+    for path in cache.entries():
+        print os.path.basename(path), directory_size(path)
+
+
+if __name__ == '__main__':
+    main()
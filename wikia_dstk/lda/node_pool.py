@@ -0,0 +1,335 @@
+"""
+Keeps a warm pool of Pyro lda_worker nodes across model builds.
+
+Worker nodes are tagged with the IP of the master they serve. A build on a
+master with the same (assigned) IP reuses whatever tagged nodes are still
+running, and only requests spot instances for the shortfall. Each node runs a
+small watchdog that restarts its lda_worker whenever the master announces a
+new pool generation in the Pyro nameserver, so workers register with the
+nameserver of the current build. Readiness is judged by counting registered
+workers that answer a ping rather than by sleeping; registrations left behind
+by workers the watchdog killed are removed.
+
+Nodes are stamped with the time they were last used; anything idle longer
+than the TTL is terminated by reclaim(). The servers call it before each
+build for their own nodes; nodes left by other masters are only reclaimed
+from the command line, which without --master-ip covers every master:
+
+python -m wikia_dstk.lda.node_pool --reclaim --ttl 3600
+"""
+
+import argparse
+import threading
+import time
+from uuid import uuid4
+from . import get_ec2_connection, get_my_ip, log
+from ..loadbalancing.spot import SpotRequestTracker
+
+WORKER_PREFIX = u'gensim.lda_worker'
+GENERATION_PREFIX = u'wikia.lda_pool.generation'
+NODE_TYPE = u'lda'
+ACTIVE_STATES = (u'pending', u'running')
+
+worker_user_data = u"""#!/bin/sh
+
+echo `date` `hostname -i ` "Configuring Environment" >> /var/log/my_startup.log
+export PYRO_SERIALIZERS_ACCEPTED=pickle
+export PYRO_SERIALIZER=pickle
+export PYRO_NS_HOST=%s
+echo `date` `hostname -i ` "Starting Worker Watchdog" >> /var/log/my_startup.log
+cat > /usr/local/bin/lda_worker_watchdog <<'EOF'
+#!/bin/sh
+# (re)start the worker whenever the master starts a new pool generation, or
+# the worker dies, so it's always registered with the current nameserver
+CURRENT=none
+PID=
+while true; do
+    GEN=`python -m Pyro4.nsc list %s 2>/dev/null | grep -o '%s\.[0-9a-f]*' | head -1`
+    if [ -n "$PID" ] && ! kill -0 $PID 2>/dev/null; then
+        CURRENT=none
+    fi
+    if [ -n "$GEN" ] && [ "$GEN" != "$CURRENT" ]; then
+        [ -n "$PID" ] && kill $PID
+        python -m gensim.models.lda_worker >> /var/log/lda_worker 2>&1 &
+        PID=$!
+        CURRENT=$GEN
+    fi
+    sleep 15
+done
+EOF
+chmod +x /usr/local/bin/lda_worker_watchdog
+/usr/local/bin/lda_worker_watchdog > /dev/null 2>&1 &
+echo `date` `hostname -i ` "User Data Script Complete" >> /var/log/my_startup.log
+"""
+
+
+def locate_nameserver(host=None):
+    import Pyro4
+    return Pyro4.locateNS(host=host)
+
+
+def is_alive(uri, timeout=5):
+    """
+    :type uri: string
+    :param uri: A registered Pyro object's URI
+
+    :type timeout: float
+    :param timeout: Seconds to wait for it to answer
+
+    :rtype: bool
+    :return: Whether something is serving the URI
+    """
+    import Pyro4
+    import Pyro4.errors
+    proxy = Pyro4.Proxy(uri)
+    proxy._pyroTimeout = timeout
+    try:
+        proxy._pyroBind()
+        return True
+    except Pyro4.errors.CommunicationError:
+        return False
+    finally:
+        proxy._pyroRelease()
+
+
+class LdaNodePool(object):
+    """Tagged lda_worker nodes serving one master IP."""
+
+    def __init__(self, ami, master_ip=None, ttl=3600,
+                 instance_type=u'm2.4xlarge', price=0.80, conn=None):
+        """
+        :type ami: string
+        :param ami: The AMI to launch worker nodes from
+
+        :type master_ip: string
+        :param master_ip: The IP of the master running the nameserver and
+                          dispatcher; defaults to this instance's
+
+        :type ttl: int
+        :param ttl: Seconds a node may sit unused before reclaim() takes it
+
+        :type instance_type: string
+        :param instance_type: The instance type of worker nodes
+
+        :type price: float
+        :param price: The spot bid for new nodes
+
+        :type conn: class:`boto.ec2.connection.EC2Connection`
+        :param conn: The EC2 connection to use
+        """
+        self.ami = ami
+        self.master_ip = master_ip or get_my_ip()
+        self.ttl = ttl
+        self.instance_type = instance_type
+        self.price = price
+        self.conn = conn or get_ec2_connection()
+        self.tracker = SpotRequestTracker(self.conn)
+        self.requested = []
+        self.launched = []
+
+    def members(self, include_others=False):
+        """
+        :type include_others: bool
+        :param include_others: Include nodes tagged for other masters
+
+        :rtype: list
+        :return: Pending or running worker instances in this pool
+        """
+        filters = {u'tag:type': NODE_TYPE}
+        if not include_others:
+            filters[u'tag:lda_master'] = self.master_ip
+        return [instance for reservation in
+                self.conn.get_all_instances(filters=filters)
+                for instance in reservation.instances
+                if instance.state in ACTIVE_STATES]
+
+    def stamp(self, instance_ids):
+        """
+        Tag nodes as belonging to this pool and used just now
+        """
+        if instance_ids:
+            self.conn.create_tags(instance_ids, {
+                u'Name': u'LDA Worker Node', u'type': NODE_TYPE,
+                u'lda_master': self.master_ip,
+                u'last_used': unicode(int(time.time()))})
+
+    def start_generation(self):
+        """
+        Announce a new generation in the nameserver, so every warm node
+        restarts its worker against it
+        """
+        ns = locate_nameserver(self.master_ip)
+        for name in ns.list(prefix=GENERATION_PREFIX):
+            ns.remove(name)
+        ns.register(u'%s.%s' % (GENERATION_PREFIX, uuid4().hex),
+                    u'PYRO:generation@%s:0' % self.master_ip)
+
+    def acquire(self, count):
+        """
+        Make sure `count` nodes are serving this master, reusing warm ones.
+        Doesn't block; call wait_until_ready before training.
+
+        :type count: int
+        :param count: The number of worker nodes wanted
+
+        :rtype: int
+        :return: The number of nodes reused
+        """
+        self.start_generation()
+        warm = [instance.id for instance in self.members()]
+        self.stamp(warm)
+        shortfall = count - len(warm)
+        log(u"Reusing %d warm LDA nodes, requesting %d more" % (
+            len(warm), max(0, shortfall)))
+        if shortfall > 0:
+            self.requested = self.conn.request_spot_instances(
+                self.price, self.ami, count=shortfall,
+                instance_type=self.instance_type,
+                subnet_id=u'subnet-e4d087a2',
+                security_group_ids=['sg-72190a10'],
+                user_data=worker_user_data % (
+                    self.master_ip, GENERATION_PREFIX, GENERATION_PREFIX))
+            futures = self.tracker.track([r.id for r in self.requested])
+            tagger = threading.Thread(target=self.tag_when_fulfilled,
+                                      args=(futures,))
+            tagger.daemon = True
+            tagger.start()
+        return len(warm)
+
+    def tag_when_fulfilled(self, futures):
+        for future in futures:
+            try:
+                instance_id = future.get()
+            except Exception as e:
+                log(u"Spot request failed:", e)
+                continue
+            self.launched.append(instance_id)
+            self.stamp([instance_id])
+
+    def registered_workers(self):
+        """
+        Count the live workers registered with the nameserver, removing
+        registrations nothing answers on
+
+        :rtype: int
+        :return: How many live workers the nameserver knows about
+        """
+        try:
+            ns = locate_nameserver(self.master_ip)
+            live = 0
+            for name, uri in ns.list(prefix=WORKER_PREFIX).items():
+                if is_alive(uri):
+                    live += 1
+                else:
+                    log(u"Removing stale worker registration", name)
+                    ns.remove(name)
+            return live
+        except Exception as e:
+            log(u"Couldn't reach the nameserver:", e)
+            return 0
+
+    def wait_until_ready(self, count, timeout=1800, interval=10):
+        """
+        Block until `count` workers have registered, or the timeout passes
+
+        :type count: int
+        :param count: The number of workers to wait for
+
+        :type timeout: int
+        :param timeout: Seconds to wait before going ahead with whatever has
+                        registered
+
+        :type interval: int
+        :param interval: Seconds between checks
+
+        :rtype: int
+        :return: The number of registered workers
+        """
+        deadline = time.time() + timeout
+        while True:
+            registered = self.registered_workers()
+            if registered >= count:
+                break
+            if time.time() > deadline:
+                if not registered:
+                    raise StandardError(u"No LDA workers registered after "
+                                        u"%d seconds" % timeout)
+                log(u"Going ahead with %d of %d workers" % (registered, count))
+                break
+            log(u"%d of %d LDA workers registered" % (registered, count))
+            time.sleep(interval)
+        log(u"%d LDA workers ready" % registered)
+        return registered
+
+    def release(self, keep_warm=True):
+        """
+        Finish with the pool's nodes for this build
+
+        :type keep_warm: bool
+        :param keep_warm: Leave them running for the next build, rather than
+                          terminating them now
+        """
+        if keep_warm:
+            self.stamp([instance.id for instance in self.members()])
+        else:
+            self.terminate(self.members())
+            if self.requested:
+                self.conn.cancel_spot_instance_requests(
+                    [r.id for r in self.requested])
+
+    def reclaim(self, ttl=None, include_others=False):
+        """
+        Terminate nodes that haven't been used for `ttl` seconds
+
+        :type ttl: int
+        :param ttl: Idle seconds allowed; defaults to the pool's TTL
+
+        :type include_others: bool
+        :param include_others: Also reclaim nodes tagged for other masters
+
+        :rtype: list
+        :return: The IDs of the terminated instances
+        """
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+        idle = [instance for instance in self.members(include_others)
+                if now - int(instance.tags.get(u'last_used', 0)) > ttl]
+        self.terminate(idle)
+        return [instance.id for instance in idle]
+
+    def terminate(self, instances):
+        if not instances:
+            return
+        instance_ids = [instance.id for instance in instances]
+        log(u"Terminating LDA nodes", u','.join(instance_ids))
+        request_ids = [instance.spot_instance_request_id
+                       for instance in instances
+                       if instance.spot_instance_request_id]
+        if request_ids:
+            self.conn.cancel_spot_instance_requests(request_ids)
+        self.conn.terminate_instances(instance_ids=instance_ids)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=u"Manage warm LDA worker nodes")
+    ap.add_argument(u'--reclaim', dest=u'reclaim', action=u'store_true',
+                    default=False,
+                    help=u"Terminate nodes idle for longer than the TTL")
+    ap.add_argument(u'--ttl', dest=u'ttl', type=int, default=3600,
+                    help=u"Seconds a node may sit unused")
+    ap.add_argument(u'--master-ip', dest=u'master_ip', default=u'',
+                    help=u"Only consider nodes serving this master")
+    args = ap.parse_args()
+
+    pool = LdaNodePool(None, master_ip=args.master_ip or u'*', ttl=args.ttl)
+    include_others = not args.master_ip
+    for instance in pool.members(include_others):
+        print instance.id, instance.tags.get(u'lda_master'), \
+            instance.tags.get(u'last_used')
+    if args.reclaim:
+        reclaimed = pool.reclaim(include_others=include_others)
+        print u"Reclaimed %d nodes" % len(reclaimed)
+
+
+if __name__ == '__main__':
+    main()
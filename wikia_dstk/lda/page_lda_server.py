@@ -14,8 +14,12 @@ from nlp_services.discourse.entities import WikiPageToEntitiesService
 from boto import connect_s3
 from boto.exception import EC2ResponseError
 from datetime import datetime
-from . import normalize, launch_lda_nodes, terminate_lda_nodes, harakiri
-from . import get_dct_and_bow_from_features, write_csv_and_text_data
+from . import normalize, harakiri
+from . import write_csv_and_text_data
+from .backends import LdaTrainer, add_backend_args
+from .model_cache import ModelCache
+from .incremental import (build_model, save_build_records,
+                          add_incremental_args)
 from .. import log
 
 bucket = connect_s3().get_bucket('nlp-data')
@@ -67,6 +71,14 @@ def get_args():
     ap.add_argument('--git-ref', dest='git_ref',
                     default=os.getenv('GIT_REF', 'master'),
                     help="A DSTK repo ref (tag, branch, commit hash) to check out")
+    ap.add_argument('--keep-warm', dest='keep_warm', action='store_true',
+                    default=bool(os.getenv('KEEP_WARM', '')),
+                    help="Leave LDA worker nodes running for the next build")
+    ap.add_argument('--node-ttl', dest='node_ttl', type=int,
+                    default=os.getenv('NODE_TTL', 3600),
+                    help="Seconds an idle LDA worker node is kept before it's reclaimed")
+    add_backend_args(ap)
+    add_incremental_args(ap)
     return ap.parse_args()
 
 
@@ -121,46 +133,38 @@ def get_model_from_args(args):
         key = bucket.get_key(args.s3_prefix+modelname)
         if not args.overwrite and key is not None:
             log("(loading from s3)")
-            with open('/tmp/%s' % modelname, 'w') as fl:
-                key.get_contents_to_file(fl)
-            lda_model = gensim.models.LdaModel.load('/tmp/%s' % modelname)
+            lda_model = ModelCache().get_key(key)
         else:
             log("(building... this will take a while)")
+            trainer = LdaTrainer(args, args.ami)
             try:
-                if args.auto_launch:
-                    launching = launch_lda_nodes(args.instance_count, args.ami)
+                trainer.prepare()
                 log("Getting Data...")
                 doc_id_to_terms = get_feature_data(args)
-                log("Turning Data into Vectors")
-                dct, bow_docs = get_dct_and_bow_from_features(doc_id_to_terms)
-                log("Waiting for workers to get sorted out")
-                launching.wait()
-                log("Waiting an extra five minutes for workers to get their " +
-                    "shit together")
-                time.sleep(300)
-                log("Finally building model from features")
-                lda_model = gensim.models.LdaModel(
-                    bow_docs.values(), num_topics=args.num_topics,
-                    id2word=dict([(x[1], x[0]) for x in dct.token2id.items()]),
-                    distributed=True)
+                log("Building model from features")
+                lda_model, bow_docs, doc_topics, provenance = build_model(
+                    args, trainer, bucket, modelname, doc_id_to_terms)
                 log("Done, saving model.")
                 lda_model.save(args.path_prefix+modelname)
                 write_csv_and_text_data(args, bucket, modelname,
-                                        doc_id_to_terms, bow_docs, lda_model)
+                                        doc_id_to_terms, bow_docs, lda_model,
+                                        doc_topics)
                 log("uploading model to s3")
                 key = bucket.new_key(
                     '%s%s/%s/%s' % (args.s3_prefix, args.git_ref,
                                     args.model_prefix, modelname))
                 key.set_contents_from_file(
                     open(args.path_prefix+modelname, 'r'))
-                terminate_lda_nodes()
+                save_build_records(bucket, args.path_prefix+modelname,
+                                   key.name, doc_topics, provenance)
+                trainer.finish()
             #except EC2ResponseError:
-            #    terminate_lda_nodes()
+            #    trainer.finish()
             #    return harakiri()
             except Exception as e:
                 log(e)
                 log(traceback.format_exc())
-                #terminate_lda_nodes()  # keep commented out
+                #trainer.finish()  # keep commented out
                 return
                 #return harakiri()  # keep commented out
     return lda_model
@@ -0,0 +1,263 @@
+"""
+Sweeps LDA hyperparameters on a sample of a feature set, to see where
+quality stops improving relative to cost.
+
+Trains a model for every combination of topic count and passes over the
+sampled training documents, either several at once on local processes or
+one after another on the Pyro worker pool, and measures each on the
+held-out documents:
+
+- perplexity, exp(-bound per word), with the topic-word part of the bound
+  scaled to the held-out share of the corpus as gensim's log_perplexity does,
+  so models with more topics aren't penalised for their size; lower is better
+- UMass coherence of each topic's top words over the training documents,
+  averaged over topics; higher is better
+- training time, and inference latency per document
+
+Writes the table as CSV and recommends the cheapest configuration whose
+perplexity is within the tolerance of the best.
+
+python -m wikia_dstk.lda.sweep --features video.json --num-topics 50,250,999
+"""
+
+import argparse
+import csv
+import gensim
+import json
+import numpy as np
+import random
+import time
+from collections import defaultdict
+from multiprocessing import Pool, cpu_count
+from boto import connect_s3
+from . import log, get_dct_and_bow_from_features, video_json_key, ami
+from .incremental import is_heldout
+from .node_pool import LdaNodePool
+
+FIELDS = [u'num_topics', u'passes', u'train_seconds', u'perplexity',
+          u'coherence', u'ms_per_doc']
+
+# the sampled corpus, inherited by the pool's workers when they're forked
+shared = {}
+
+
+def get_args():
+    ap = argparse.ArgumentParser(description=u"Sweep LDA hyperparameters")
+    ap.add_argument(u'--features', dest=u'features', default=u'',
+                    help=u"A local JSON file of document ID to features")
+    ap.add_argument(u'--s3-features', dest=u's3_features',
+                    default=video_json_key,
+                    help=u"The key in nlp-data to read features from "
+                         u"otherwise")
+    ap.add_argument(u'--sample', dest=u'sample', type=int, default=5000,
+                    help=u"Documents to sample from the feature set")
+    ap.add_argument(u'--heldout-fraction', dest=u'heldout_fraction',
+                    type=float, default=0.1)
+    ap.add_argument(u'--num-topics', dest=u'num_topics',
+                    default=u'50,100,250,500,999',
+                    help=u"Comma-separated topic counts to try")
+    ap.add_argument(u'--passes', dest=u'passes', default=u'1,2',
+                    help=u"Comma-separated numbers of passes to try")
+    ap.add_argument(u'--top-words', dest=u'top_words', type=int, default=10,
+                    help=u"Words per topic to measure coherence over")
+    ap.add_argument(u'--tolerance', dest=u'tolerance', type=float,
+                    default=0.05,
+                    help=u"How much worse than the best perplexity, "
+                         u"relatively, a cheaper configuration may be")
+    ap.add_argument(u'--backend', dest=u'backend', default=u'local',
+                    choices=[u'local', u'pyro'],
+                    help=u"Train configurations in parallel on local "
+                         u"processes, or in turn on Pyro worker nodes")
+    ap.add_argument(u'--processes', dest=u'processes', type=int,
+                    default=cpu_count(),
+                    help=u"Configurations to train at once locally")
+    ap.add_argument(u'--instance-count', dest=u'instance_count', type=int,
+                    default=20, help=u"Worker nodes for the Pyro backend")
+    ap.add_argument(u'--node-ami', dest=u'ami', default=ami)
+    ap.add_argument(u'--output', dest=u'output', default=u'lda-sweep.csv')
+    ap.add_argument(u'--seed', dest=u'seed', type=int, default=0)
+    return ap.parse_args()
+
+
+def load_features(args):
+    if args.features:
+        with open(args.features) as fl:
+            id_to_features = json.load(fl)
+    else:
+        bucket = connect_s3().get_bucket(u'nlp-data')
+        id_to_features = json.loads(
+            bucket.get_key(args.s3_features).get_contents_as_string())
+    names = sorted(id_to_features.keys())
+    if len(names) > args.sample:
+        names = random.Random(args.seed).sample(names, args.sample)
+    return dict([(name, id_to_features[name]) for name in names])
+
+
+def umass_coherence(model, corpus, top_words):
+    """
+    Mean UMass coherence over topics: for each topic's top words w_1..w_n,
+    in order, the sum over i > j of log((D(w_i, w_j) + 1) / D(w_j)), where D
+    counts the documents containing the words
+
+    :type model: class:`gensim.models.LdaModel`
+    :param model: The model whose topics to measure
+
+    :type corpus: list
+    :param corpus: Bag-of-words documents to count co-occurrences in
+
+    :type top_words: int
+    :param top_words: Words per topic
+
+    :rtype: float
+    :return: Mean coherence; closer to zero is better
+    """
+    topics = []
+    for topic in range(model.num_topics):
+        topic_beta = model.expElogbeta[topic]
+        topics.append(list(np.argsort(topic_beta)[::-1][:top_words]))
+    wanted = set([token_id for topic in topics for token_id in topic])
+    docs_with = defaultdict(set)
+    for n, doc in enumerate(corpus):
+        for token_id, _ in doc:
+            if token_id in wanted:
+                docs_with[token_id].add(n)
+    scores = []
+    for topic in topics:
+        score = 0.0
+        for i in range(1, len(topic)):
+            for j in range(i):
+                d_j = len(docs_with[topic[j]])
+                if d_j:
+                    d_ij = len(docs_with[topic[i]] & docs_with[topic[j]])
+                    score += np.log((d_ij + 1.0) / d_j)
+        scores.append(score)
+    return float(np.mean(scores))
+
+
+def evaluate(model, train, heldout, top_words):
+    """
+    :rtype: dict
+    :return: Perplexity, coherence and inference latency for a model
+    """
+    start = time.time()
+    for doc in heldout:
+        model[doc]
+    ms_per_doc = 1000.0 * (time.time() - start) / max(1, len(heldout))
+    # without total_docs, bound() adds the whole topic-word term to the
+    # held-out docs' bound, which grows with topics x vocabulary
+    bound = model.log_perplexity(heldout, total_docs=len(train) + len(heldout))
+    return {u'perplexity': float(np.exp(-bound)),
+            u'coherence': umass_coherence(model, train, top_words),
+            u'ms_per_doc': ms_per_doc}
+
+
+def train_and_evaluate(config):
+    """
+    Train and measure one configuration on the shared corpus
+
+    :type config: tuple
+    :param config: The number of topics and passes
+
+    :rtype: dict
+    :return: A row of the comparison table
+    """
+    num_topics, passes = config
+    start = time.time()
+    model = gensim.models.LdaModel(
+        shared[u'train'], num_topics=num_topics, id2word=shared[u'id2word'],
+        passes=passes, distributed=shared[u'distributed'])
+    row = {u'num_topics': num_topics, u'passes': passes,
+           u'train_seconds': time.time() - start}
+    row.update(evaluate(model, shared[u'train'], shared[u'heldout'],
+                        shared[u'top_words']))
+    return row
+
+
+def sweep(args, configs):
+    """
+    :rtype: list
+    :return: A row per configuration
+    """
+    if args.backend == u'local':
+        # longest first, so the pool isn't left waiting on one big model
+        configs = sorted(configs, key=lambda (topics, passes): topics * passes,
+                         reverse=True)
+        pool = Pool(processes=args.processes)
+        try:
+            rows = []
+            for row in pool.imap_unordered(train_and_evaluate, configs):
+                log(u"Finished %(num_topics)d topics, %(passes)d passes "
+                    u"in %(train_seconds).1f seconds" % row)
+                rows.append(row)
+            return rows
+        finally:
+            pool.close()
+            pool.join()
+
+    node_pool = LdaNodePool(args.ami)
+    node_pool.acquire(args.instance_count)
+    try:
+        node_pool.wait_until_ready(args.instance_count)
+        return map(train_and_evaluate, configs)
+    finally:
+        node_pool.release(keep_warm=True)
+
+
+def cheapest_within_tolerance(rows, tolerance):
+    """
+    :rtype: dict
+    :return: The quickest row to train whose perplexity is within
+             `tolerance` of the best, relatively
+    """
+    best = min([row[u'perplexity'] for row in rows])
+    good = [row for row in rows
+            if row[u'perplexity'] <= best * (1 + tolerance)]
+    return min(good, key=lambda row: (row[u'train_seconds'],
+                                      row[u'ms_per_doc']))
+
+
+def main():
+    args = get_args()
+    log(u"Loading features")
+    id_to_features = load_features(args)
+    dct, bow_docs = get_dct_and_bow_from_features(id_to_features)
+    shared[u'train'] = [bow for name, bow in bow_docs.items()
+                        if not is_heldout(name, args.heldout_fraction)]
+    shared[u'heldout'] = [bow for name, bow in bow_docs.items()
+                          if is_heldout(name, args.heldout_fraction)]
+    if not shared[u'heldout']:
+        raise ValueError(u"No documents held out with --heldout-fraction %s; "
+                         u"nothing to measure perplexity on"
+                         % args.heldout_fraction)
+    shared[u'id2word'] = dict([(token_id, token) for token, token_id
+                               in dct.token2id.items()])
+    shared[u'top_words'] = args.top_words
+    shared[u'distributed'] = args.backend == u'pyro'
+    log(u"Sweeping over", len(shared[u'train']), u"training and",
+        len(shared[u'heldout']), u"held-out documents")
+
+    configs = [(int(topics), int(passes))
+               for topics in args.num_topics.split(u',')
+               for passes in args.passes.split(u',')]
+    rows = sorted(sweep(args, configs),
+                  key=lambda row: (row[u'num_topics'], row[u'passes']))
+
+    with open(args.output, u'w') as fl:
+        writer = csv.DictWriter(fl, FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    print u'%10s %6s %10s %11s %10s %10s' % (
+        u'topics', u'passes', u'seconds', u'perplexity', u'coherence',
+        u'ms/doc')
+    for row in rows:
+        print u'%(num_topics)10d %(passes)6d %(train_seconds)10.1f ' \
+              u'%(perplexity)11.1f %(coherence)10.2f %(ms_per_doc)10.2f' % row
+    choice = cheapest_within_tolerance(rows, args.tolerance)
+    print u"Cheapest within %.0f%% of the best perplexity: %d topics, " \
+          u"%d passes" % (args.tolerance * 100, choice[u'num_topics'],
+                          choice[u'passes'])
+
+
+if __name__ == '__main__':
+    main()
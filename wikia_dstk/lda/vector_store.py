@@ -0,0 +1,261 @@
+"""
+A compact on-disk store of sparse topic vectors, for looking up a wiki's,
+page's or video's topics without downloading and parsing a sparse topics
+CSV.
+
+A store is a directory of .npy files:
+
+- ids.npy: every document ID as a fixed-width byte string, sorted
+- indptr.npy, indices.npy, data.npy: the vectors as a CSR matrix, row n
+  belonging to ids[n], with float32 weights
+- meta.json: the number of topics and documents, and the source model
+
+Everything is memory-mapped, so opening a store is instant and processes
+share its pages. Lookups binary search the sorted IDs; pass hashed=True to
+build a dict for constant-time lookups instead.
+
+The LDA servers write a store next to each sparse topics CSV. Serve one
+over HTTP with:
+
+python -m wikia_dstk.lda.vector_store --s3-prefix models/wiki/...-topic-vectors
+"""
+
+import argparse
+import json
+import numpy as np
+import os
+from boto import connect_s3
+from scipy.sparse import csr_matrix
+from .. import log
+
+ARRAYS = [u'ids', u'indptr', u'indices', u'data']
+META = u'meta.json'
+
+
+def encode_id(doc_id):
+    if isinstance(doc_id, unicode):
+        return doc_id.encode(u'utf-8')
+    return str(doc_id)
+
+
+def write_vector_store(directory, doc_topics, num_topics, model=None):
+    """
+    :type directory: string
+    :param directory: Where to write the store
+
+    :type doc_topics: dict
+    :param doc_topics: Document ID to sparse topic vector
+
+    :type num_topics: int
+    :param num_topics: The number of topics in the model
+
+    :type model: string
+    :param model: The name of the model the vectors came from
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    ids = sorted([encode_id(doc_id) for doc_id in doc_topics])
+    by_id = dict([(encode_id(doc_id), topics)
+                  for doc_id, topics in doc_topics.items()])
+    indptr = np.zeros(len(ids) + 1, dtype=np.int64)
+    indices, data = [], []
+    for n, doc_id in enumerate(ids):
+        topics = sorted(by_id[doc_id])
+        indices += [topic for topic, _ in topics]
+        data += [weight for _, weight in topics]
+        indptr[n + 1] = len(indices)
+    arrays = {u'ids': np.array(ids, dtype=u'S%d' % max([1] + map(len, ids))),
+              u'indptr': indptr,
+              u'indices': np.array(indices, dtype=np.int32),
+              u'data': np.array(data, dtype=np.float32)}
+    for name, array in arrays.items():
+        np.save(os.path.join(directory, name + u'.npy'), array)
+    with open(os.path.join(directory, META), u'w') as fl:
+        json.dump({u'num_topics': num_topics, u'count': len(ids),
+                   u'model': model}, fl)
+
+
+def upload_vector_store(bucket, directory, key_prefix):
+    for name in [array + u'.npy' for array in ARRAYS] + [META]:
+        key = bucket.new_key(u'%s/%s' % (key_prefix, name))
+        key.set_contents_from_filename(os.path.join(directory, name))
+
+
+def download_vector_store(bucket, key_prefix, directory):
+    """
+    Fetch a store from S3, unless it's already been fetched
+
+    :rtype: string
+    :return: The local directory
+    """
+    if os.path.exists(os.path.join(directory, META)):
+        return directory
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    # meta.json last, since its presence means the store is complete
+    for name in [array + u'.npy' for array in ARRAYS] + [META]:
+        key = bucket.get_key(u'%s/%s' % (key_prefix, name))
+        key.get_contents_to_filename(os.path.join(directory, name))
+    return directory
+
+
+class TopicVectorStore(object):
+    """Read-only, memory-mapped topic vectors keyed by document ID."""
+
+    def __init__(self, directory, hashed=False):
+        """
+        :type directory: string
+        :param directory: A store written by write_vector_store
+
+        :type hashed: bool
+        :param hashed: Index the IDs in a dict, for constant-time lookups at
+                       the cost of loading them all
+        """
+        with open(os.path.join(directory, META)) as fl:
+            self.meta = json.load(fl)
+        self.num_topics = self.meta[u'num_topics']
+        for name in ARRAYS:
+            setattr(self, name, np.load(
+                os.path.join(directory, name + u'.npy'), mmap_mode=u'r'))
+        self.index = None
+        if hashed:
+            self.index = dict([(doc_id, n)
+                               for n, doc_id in enumerate(self.ids)])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def position(self, doc_id):
+        """
+        :rtype: int
+        :return: The row of a document ID, or None if it isn't stored
+        """
+        doc_id = encode_id(doc_id)
+        if self.index is not None:
+            return self.index.get(doc_id)
+        n = int(np.searchsorted(self.ids, doc_id))
+        if n < len(self.ids) and self.ids[n] == doc_id:
+            return n
+        return None
+
+    def get(self, doc_id):
+        """
+        :rtype: list
+        :return: The document's (topic, weight) pairs, or None if it isn't
+                 stored
+        """
+        n = self.position(doc_id)
+        if n is None:
+            return None
+        start, end = self.indptr[n], self.indptr[n + 1]
+        return zip(self.indices[start:end].tolist(),
+                   self.data[start:end].tolist())
+
+    def get_many(self, doc_ids, dense=False):
+        """
+        :type doc_ids: list
+        :param doc_ids: Document IDs; ones that aren't stored get empty rows
+
+        :type dense: bool
+        :param dense: Return a dense array rather than a sparse matrix
+
+        :rtype: class:`scipy.sparse.csr_matrix`
+        :return: A row of topic weights per ID
+        """
+        pieces, lengths = [], []
+        for n in [self.position(doc_id) for doc_id in doc_ids]:
+            if n is None:
+                lengths.append(0)
+            else:
+                pieces.append((self.indptr[n], self.indptr[n + 1]))
+                lengths.append(pieces[-1][1] - pieces[-1][0])
+        indptr = np.concatenate([[0], np.cumsum(lengths)])
+        if pieces:
+            indices = np.concatenate([self.indices[a:b] for a, b in pieces])
+            data = np.concatenate([self.data[a:b] for a, b in pieces])
+        else:
+            indices = np.zeros(0, dtype=np.int32)
+            data = np.zeros(0, dtype=np.float32)
+        matrix = csr_matrix((data, indices, indptr),
+                            shape=(len(doc_ids), self.num_topics))
+        if dense:
+            return matrix.toarray()
+        return matrix
+
+    def items(self, batch_size=10000):
+        """
+        Iterate over every document ID and its dense vector
+        """
+        for start in range(0, len(self.ids), batch_size):
+            end = min(start + batch_size, len(self.ids))
+            first, last = self.indptr[start], self.indptr[end]
+            rows = csr_matrix((self.data[first:last],
+                               self.indices[first:last],
+                               self.indptr[start:end + 1] - first),
+                              shape=(end - start, self.num_topics))
+            for doc_id, row in zip(self.ids[start:end], rows.toarray()):
+                yield doc_id, row
+
+
+def serve(store, host=u'0.0.0.0', port=5001):
+    """
+    Serve lookups over HTTP: GET /vector/<id>, and POST /vectors with
+    {"ids": [...]}
+    """
+    from flask import Flask, request, Response
+
+    app = Flask(__name__)
+
+    def json_response(data, status=200):
+        return Response(json.dumps(data), status=status,
+                        mimetype=u'application/json')
+
+    @app.route(u'/vector/<doc_id>')
+    def vector(doc_id):
+        topics = store.get(doc_id)
+        if topics is None:
+            return json_response({u'status': 404,
+                                  u'message': u'No vector for ' + doc_id}, 404)
+        return json_response({u'status': 200, doc_id: topics})
+
+    @app.route(u'/vectors', methods=[u'POST'])
+    def vectors():
+        try:
+            doc_ids = json.loads(request.get_data())[u'ids']
+        except (ValueError, KeyError, TypeError):
+            return json_response({u'status': 400, u'message':
+                                  u'Expected JSON with a list of ids'}, 400)
+        return json_response({u'status': 200, u'results': dict(
+            [(doc_id, store.get(doc_id)) for doc_id in doc_ids])})
+
+    app.run(host=host, port=port, threaded=True)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=u"Serve a topic vector store")
+    ap.add_argument(u'--path', dest=u'path', default=u'',
+                    help=u"A store on this box")
+    ap.add_argument(u'--s3-prefix', dest=u's3_prefix', default=u'',
+                    help=u"The key prefix in nlp-data of a store to fetch "
+                         u"otherwise")
+    ap.add_argument(u'--local-dir', dest=u'local_dir',
+                    default=u'/mnt/topic_vectors/')
+    ap.add_argument(u'--hashed', dest=u'hashed', action=u'store_true',
+                    default=False, help=u"Index IDs in memory")
+    ap.add_argument(u'--host', dest=u'host', default=u'0.0.0.0')
+    ap.add_argument(u'--port', dest=u'port', type=int, default=5001)
+    args = ap.parse_args()
+
+    path = args.path
+    if not path:
+        name = args.s3_prefix.strip(u'/').split(u'/')[-1]
+        path = download_vector_store(connect_s3().get_bucket(u'nlp-data'),
+                                     args.s3_prefix,
+                                     os.path.join(args.local_dir, name))
+    store = TopicVectorStore(path, hashed=args.hashed)
+    log(u"Serving", len(store), u"topic vectors from", path)
+    serve(store, args.host, args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,8 +5,11 @@ import os
 import gensim
 import time
 import json
-from . import launch_lda_nodes, terminate_lda_nodes, log, harakiri, ami
-from . import video_json_key, get_dct_and_bow_from_features, write_csv_and_text_data
+from . import log, harakiri, ami
+from . import video_json_key, write_csv_and_text_data
+from .backends import LdaTrainer, add_backend_args
+from .model_cache import ModelCache
+from .incremental import build_model, save_build_records, add_incremental_args
 from boto import connect_s3
 
 
@@ -42,6 +45,14 @@ def get_args():
     parser.add_argument('--git-ref', dest='git_ref',
                         default=os.getenv('GIT_REF', 'master'),
                         help="A DSTK repo ref (tag, branch, commit hash) to check out")
+    parser.add_argument('--keep-warm', dest='keep_warm', action='store_true',
+                        default=bool(os.getenv('KEEP_WARM', '')),
+                        help="Leave LDA worker nodes running for the next build")
+    parser.add_argument('--node-ttl', dest='node_ttl', type=int,
+                        default=os.getenv('NODE_TTL', 3600),
+                        help="Seconds an idle LDA worker node is kept before it's reclaimed")
+    add_backend_args(parser)
+    add_incremental_args(parser)
     return parser.parse_args()
 
 
@@ -58,31 +69,24 @@ def get_model_from_args(args):
         key = bucket.get_key(args.s3_prefix+modelname)
         if key is not None:
             log("(loading from s3)")
-            with open('/tmp/%s' % modelname, 'w') as fl:
-                key.get_contents_to_file(fl)
-            lda_model = gensim.models.LdaModel.load('/tmp/%s' % modelname)
+            lda_model = ModelCache().get_key(key)
         else:
             log("(building...)")
-            async_result = launch_lda_nodes(instance_count=args.instance_count, ami=args.node_ami)
+            trainer = LdaTrainer(args, args.node_ami)
+            trainer.prepare()
             log("Getting features while LDA nodes launch")
             doc_id_to_terms = json.loads(bucket.get_key(video_json_key).get_contents_as_string())
-            dct, bow_docs = get_dct_and_bow_from_features(doc_id_to_terms)
             log("Got features, building model")
-            log("Waiting for spot instances to load...")
-            async_result.wait()
-            log("Waiting an extra five minutes for shit to pop off")
-            time.sleep(300)
-            lda_model = gensim.models.LdaModel(bow_docs.values(),
-                                               num_topics=args.num_topics,
-                                               id2word=dict([(x[1], x[0]) for x in dct.token2id.items()]),
-                                               distributed=True)
+            lda_model, bow_docs, doc_topics, provenance = build_model(
+                args, trainer, bucket, modelname, doc_id_to_terms)
             log("Done, saving model.")
             lda_model.save(model_location)
-            write_csv_and_text_data(args, bucket, modelname, doc_id_to_terms, bow_docs, lda_model)
+            write_csv_and_text_data(args, bucket, modelname, doc_id_to_terms, bow_docs, lda_model, doc_topics)
             log("uploading model to s3")
             key = bucket.new_key(args.s3_prefix+modelname)
             key.set_contents_from_filename(model_location)
-            terminate_lda_nodes()
+            save_build_records(bucket, model_location, key.name, doc_topics, provenance)
+            trainer.finish()
     return lda_model
 
 
@@ -1,10 +1,12 @@
 from boto.ec2 import connect_to_region
 from boto.s3.connection import S3Connection
 from boto.s3.key import Key
-from collections import defaultdict
-from multiprocessing import Pool
 from time import sleep
 from uuid import uuid4
+from partition import PARTITIONERS, makespan_imbalance
+from spot import (FULFILMENT_TIMEOUT, InventoryCache, ReservationResult,
+                  SpotRequestTracker, wait_for)
+from worksteal import S3ChunkQueue, make_chunks
 
 INSTANCE_LIMIT = 20
 
@@ -23,19 +25,13 @@ def get_instance_ids_from_reservation(conn, reservation):
     :return: a list of EC2 instance IDs
     """
 
-    # Get instance IDs for the reservation
-    r_ids = [request.id for request in reservation]
-    while True:  # Because the requests are fulfilled independently
-        sleep(15)
-        requests = conn.get_all_spot_instance_requests(request_ids=r_ids)
-        instance_ids = [request.instance_id for request in requests if
-                        request.instance_id]
-        if len(instance_ids) == len(r_ids):
-            return instance_ids
+    futures = SpotRequestTracker(conn).track(
+        [request.id for request in reservation])
+    return wait_for(futures)
 
 
 def run_instances_lb(ids, callback, num_instances, user_data, options=None,
-                     ami="ami-dc0c63ec"):
+                     ami="ami-dc0c63ec", with_weights=False, strategy='lpt'):
     """
     Run a set of instances that evenly distributes the workload between target
     IDs
@@ -62,6 +58,14 @@ def run_instances_lb(ids, callback, num_instances, user_data, options=None,
     :type ami: string
     :param ami: The AMI ID of the image to load
 
+    :type with_weights: bool
+    :param with_weights: Write each ID as '<id>:<callback value>' so the
+                         instance knows how big each unit of work is
+
+    :type strategy: string
+    :param strategy: The name of a partitioner in
+                     wikia_dstk.loadbalancing.partition.PARTITIONERS
+
     :rtype: multiprocessing.pool.AsyncResult
     :return: multiprocessing.pool.AsyncResult
     """
@@ -70,21 +74,22 @@ def run_instances_lb(ids, callback, num_instances, user_data, options=None,
         options = {'ami': ami}
     conn = EC2Connection(options)
 
-    # TODO: Explore diff methods of combinatorial optimization to improve this
     # Split IDs into buckets of approx equal total 'callable' value
-    ids = sorted(ids, key=callback, reverse=True)  # Sort desc
-    parts = defaultdict(list)  # {instance #: list of IDs to pass to instance}
-    for i in range(0, len(ids), num_instances):
-        for n, id_ in enumerate(ids[i:i+num_instances]):
-            parts[n].append(id_)
+    parts = PARTITIONERS[strategy](ids, callback, num_instances)
+    print 'Partitioned %d IDs with %s; predicted makespan imbalance %.3f' % (
+        len(ids), strategy, makespan_imbalance(parts, callback))
 
     # Write event files containing IDs to S3 & populate a list w/ their paths
     scripts = []
     bucket = S3Connection().get_bucket('nlp-data')
     k = Key(bucket)
-    for wids in parts.values():
+    for wids in filter(None, parts):
         k.key = 'lb_events/%s' % str(uuid4())
-        k.set_contents_from_string(','.join([str(wid) for wid in wids]))
+        if with_weights:
+            tokens = ['%s:%d' % (wid, callback(wid)) for wid in wids]
+        else:
+            tokens = [str(wid) for wid in wids]
+        k.set_contents_from_string(','.join(tokens))
         formatted = user_data.format(key=k.key)
         scripts.append(formatted)
 
@@ -92,16 +97,83 @@ def run_instances_lb(ids, callback, num_instances, user_data, options=None,
     return conn.add_instances_async(scripts)
 
 
+def run_instances_ws(ids, callback, num_instances, user_data, options=None,
+                     ami="ami-dc0c63ec", chunks_per_instance=20,
+                     strategy='lpt'):
+    """
+    Run a set of instances that share a work-stealing queue of target IDs.
+    Each instance starts with a balanced share, split into chunks, and
+    claims chunks from its peers once its own run out.
+
+    :type ids: list
+    :param ids: A list of IDs against which to run this process
+
+    :type callback: function
+    :param callback: A function that, given an ID, returns a value that should
+                     be load-balanced
+
+    :type num_instances: int
+    :param num_instances: The number of instances to create
+
+    :type user_data: string
+    :param user_data: The script to run on instantiation. Should contain
+                      '{key}', which is replaced with the instance's home
+                      prefix in the queue, lb_queue/<job>/<node>
+
+    :type options: dict
+    :param options: Launch configuration options with which to instantiate an
+                    EC2Connection object
+
+    :type ami: string
+    :param ami: The AMI ID of the image to load
+
+    :type chunks_per_instance: int
+    :param chunks_per_instance: Roughly how many chunks to split each
+                                instance's share into
+
+    :type strategy: string
+    :param strategy: The partitioner used for the initial shares
+
+    :rtype: multiprocessing.pool.AsyncResult
+    :return: multiprocessing.pool.AsyncResult
+    """
+    if options is None:
+        options = {'ami': ami}
+    conn = EC2Connection(options)
+
+    parts = filter(None, PARTITIONERS[strategy](ids, callback, num_instances))
+    total = sum([callback(id_) for id_ in ids])
+    chunk_weight = max(1, total // (len(parts) * chunks_per_instance))
+
+    job = str(uuid4())
+    queue = S3ChunkQueue(S3Connection().get_bucket('nlp-data'), job)
+    scripts = []
+    for n, part in enumerate(parts):
+        node = 'node%d' % n
+        for chunk, weight in make_chunks(part, callback, chunk_weight):
+            queue.put(node, ','.join(
+                ['%s:%d' % (id_, callback(id_)) for id_ in chunk]), weight)
+        scripts.append(user_data.format(key=queue.prefix + node))
+    print 'Queued job %s for %d instances, chunks of ~%d' % (
+        job, len(parts), chunk_weight)
+
+    return conn.add_instances_async(scripts)
+
+
 class EC2Connection(object):
     """A connection to a specified EC2 region."""
 
-    def __init__(self, options):
+    def __init__(self, options, conn=None):
         """
         Instantiate a boto.ec2.connection.EC2Connection object upon which to
         perform actions.
 
         :type options: dict
         :param options: A dictionary containing the autoscaling options
+
+        :type conn: class:`boto.ec2.connection.EC2Connection`
+        :param conn: A connection to use instead of connecting to the region,
+                     e.g. a fake one for running offline
         """
         self.region = options.get('region', 'us-west-2')
         self.price = options.get('price', '0.300')
@@ -114,7 +186,11 @@ class EC2Connection(object):
         self.tag = options.get('tag', self.ami)
         self.threshold = options.get('threshold', 50)
         self.max_size = options.get('max_size', 5)
-        self.conn = connect_to_region(self.region)
+        self.spot_timeout = options.get('spot_timeout', FULFILMENT_TIMEOUT)
+        self.conn = conn if conn is not None else connect_to_region(
+            self.region)
+        self.tracker = SpotRequestTracker(self.conn)
+        self.inventory = InventoryCache(self.conn)
 
     def get_reservation(self, count, user_data=None):
         """
@@ -148,7 +224,8 @@ class EC2Connection(object):
         :return: A list of IDs corresponding to the instances launched
         """
         reservation = self.get_reservation(count, user_data=user_data)
-        instance_ids = get_instance_ids_from_reservation(self.conn, reservation)
+        instance_ids = wait_for(self.tracker.track(
+            [request.id for request in reservation]), self.spot_timeout)
         self.tag_instances(instance_ids, instance_type=instance_type)
         return instance_ids
 
@@ -161,7 +238,7 @@ class EC2Connection(object):
         self.conn.create_tags(instance_ids, {'Name': self.tag, "type": instance_type})
 
     def add_instances_async(self, user_data_scripts, num_instances=1,
-                            processes=2, wait=True):
+                            wait=True):
         """
         Add a specified number of instances asynchronously, each with unique
         user_data.
@@ -174,27 +251,19 @@ class EC2Connection(object):
         :param num_instances: The number of instances to spawn PER USER DATA
                               SCRIPT
 
-        :type processes: int
-        :param processes: The number of processes to use
-
         :type wait: bool
         :param wait: whether to wait to complete in the event of an error
 
-        :rtype:
-        :return:`multiprocessing.pool.AsyncResult`
+        :rtype: class:`wikia_dstk.loadbalancing.spot.ReservationResult`
+        :return: An AsyncResult-like object whose get() returns a list of
+                 instance IDs per script
         """
         scripts = map(lambda x: x, user_data_scripts)
+        refresh = False
         while True:
-            # Find pending, running, shutting-down, stopping instances
-            active_instances = filter(
-                lambda x: x.state_code in (0, 16, 32, 64),
-                self.conn.get_only_instances())
-            desired_instances = len(active_instances) + len(scripts)
-            # Find spot instance requests with associated instances active
-            active_sirs = filter(
-                lambda x: x.status.code != 'instance-terminated-by-user',
-                self.conn.get_all_spot_instance_requests())
-            desired_sirs = len(active_sirs) + len(scripts)
+            active_instances, active_sirs = self.inventory.counts(refresh)
+            desired_instances = active_instances + len(scripts)
+            desired_sirs = active_sirs + len(scripts)
             if (desired_instances < INSTANCE_LIMIT and
                     desired_sirs < INSTANCE_LIMIT):
                 print 'Intended totals:, %d instances, %d spot requests' % (
@@ -202,21 +271,21 @@ class EC2Connection(object):
                 break
             if wait:
                 print 'Up: %d instances, %d spot requests. Sleeping 30 sec' % (
-                    len(active_instances), len(active_sirs))
+                    active_instances, active_sirs)
                 sleep(30)
+                refresh = True
                 continue
             print 'Limit exceeded: %d instances, %d spot requests' % (
-                len(active_instances), len(active_sirs))
+                active_instances, active_sirs)
             raise Exception('Too many active instances or spot requests')
 
-        reservations = []
+        futures = []
         for script in scripts:
-            reservations.append(self.get_reservation(num_instances, script))
-
-        paramsets = [(self.conn, reservation) for reservation in reservations]
-        async_result = Pool(processes=processes).map_async(
-            get_ids_from_reso_tuple, paramsets)
-        return async_result
+            reservation = self.get_reservation(num_instances, script)
+            self.inventory.add(len(reservation))
+            futures.append(self.tracker.track(
+                [request.id for request in reservation]))
+        return ReservationResult(futures)
 
     def terminate(self, instance_ids):
         """
@@ -261,12 +330,3 @@ class EC2Connection(object):
                           statuses)
         if impaired:
             self.conn.reboot_instances([i.id for i in impaired])
-
-
-def get_ids_from_reso_tuple(args):
-    """
-    Here's a simpler approach than the S.O. one that decouples unnecessary state
-    It's an example of why FP > OOP for concurrent programming in Python
-    """
-    return get_instance_ids_from_reservation(*args)
-
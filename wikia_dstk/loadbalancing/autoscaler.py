@@ -0,0 +1,274 @@
+"""
+Shared scaling logic for the pipeline monitors.
+
+The monitors observe a queue depth and an instance count once per interval.
+AutoscalingController learns how quickly a single instance drains the queue
+from those observations, projects the time until the queue is empty, and
+picks the instance count needed to finish before a target deadline. Both
+policies only add instances; workers shut themselves down once the queue has
+been empty for a while.
+ThresholdPolicy reproduces the original events-per-instance rule so the two
+can be compared offline with the simulator.
+"""
+
+from __future__ import division
+from math import ceil
+
+
+class ThresholdPolicy(object):
+    """The original monitor policy: scale up while inqueue/instances exceeds
+    the threshold, never scale down."""
+
+    def __init__(self, threshold, max_size, min_size=0):
+        """
+        :type threshold: int
+        :param threshold: The number of queued events per instance that
+                          triggers a scale-up
+
+        :type max_size: int
+        :param max_size: The maximum number of instances
+
+        :type min_size: int
+        :param min_size: Unused, kept for a uniform constructor
+        """
+        self.threshold = threshold
+        self.max_size = max_size
+        self.min_size = min_size
+
+    def observe(self, now, inqueue, numinstances):
+        pass
+
+    def decide(self, now, inqueue, numinstances):
+        """
+        Return the number of instances to add for the current observation.
+
+        :type now: float
+        :param now: The current time in seconds
+
+        :type inqueue: int
+        :param inqueue: The current queue depth
+
+        :type numinstances: int
+        :param numinstances: The number of running instances
+
+        :rtype: int
+        :return: The number of instances to add
+        """
+        if not inqueue:
+            return 0
+        if not numinstances or inqueue / numinstances > self.threshold:
+            optimal = int(ceil(inqueue / self.threshold))
+            return max(min(optimal, self.max_size) - numinstances, 0)
+        return 0
+
+    def describe(self, inqueue, numinstances):
+        return ''
+
+
+class AutoscalingController(object):
+    """Picks instance counts from the learned per-instance drain rate."""
+
+    def __init__(self, threshold, max_size, min_size=0, deadline=3600,
+                 up_cooldown=300, smoothing=0.3):
+        """
+        :type threshold: int
+        :param threshold: Events per instance, used until a drain rate has
+                          been observed
+
+        :type max_size: int
+        :param max_size: The maximum number of instances
+
+        :type min_size: int
+        :param min_size: The minimum number of instances while there is work
+
+        :type deadline: int
+        :param deadline: The number of seconds in which the queue should empty
+
+        :type up_cooldown: int
+        :param up_cooldown: Seconds to wait after adding before adding again
+
+        :type smoothing: float
+        :param smoothing: Weight given to the newest rate sample in the
+                          exponentially weighted average
+        """
+        self.threshold = threshold
+        self.max_size = max_size
+        self.min_size = min_size
+        self.deadline = deadline
+        self.up_cooldown = up_cooldown
+        self.smoothing = smoothing
+        self.rate = None  # events per second per instance
+        self.last = None  # (time, inqueue, numinstances)
+        self.last_change = None
+
+    def observe(self, now, inqueue, numinstances):
+        """
+        Update the per-instance drain rate from the previous observation.
+
+        Only intervals where the queue shrank with instances running are
+        used; growth means new work arrived and says nothing about capacity.
+
+        :type now: float
+        :param now: The current time in seconds
+
+        :type inqueue: int
+        :param inqueue: The current queue depth
+
+        :type numinstances: int
+        :param numinstances: The number of running instances
+        """
+        if self.last is not None:
+            then, lastinqueue, lastinstances = self.last
+            elapsed = now - then
+            drained = lastinqueue - inqueue
+            if elapsed > 0 and drained > 0 and lastinstances > 0:
+                sample = drained / elapsed / lastinstances
+                if self.rate is None:
+                    self.rate = sample
+                else:
+                    self.rate = (self.smoothing * sample +
+                                 (1 - self.smoothing) * self.rate)
+        self.last = (now, inqueue, numinstances)
+
+    def time_to_empty(self, inqueue, numinstances):
+        """
+        Project how long the queue takes to drain at the learned rate.
+
+        :rtype: float
+        :return: Seconds until empty, or None if it can't be estimated
+        """
+        if not self.rate or not numinstances:
+            return None
+        return inqueue / (self.rate * numinstances)
+
+    def target(self, inqueue):
+        """
+        The number of instances needed to empty the queue by the deadline.
+
+        :type inqueue: int
+        :param inqueue: The current queue depth
+
+        :rtype: int
+        :return: The desired instance count, bounded by min_size and max_size
+        """
+        if not inqueue:
+            return 0
+        if self.rate:
+            optimal = int(ceil(inqueue / (self.rate * self.deadline)))
+        else:
+            optimal = int(ceil(inqueue / self.threshold))
+        return max(self.min_size, min(optimal, self.max_size))
+
+    def decide(self, now, inqueue, numinstances):
+        """
+        Record an observation and return the number of instances to add,
+        respecting the cooldown.
+
+        Instances are never removed: a worker may be in the middle of a batch
+        it has already claimed off the queue, so the fleet only shrinks as
+        idle workers shut themselves down.
+
+        :type now: float
+        :param now: The current time in seconds
+
+        :type inqueue: int
+        :param inqueue: The current queue depth
+
+        :type numinstances: int
+        :param numinstances: The number of running instances
+
+        :rtype: int
+        :return: The number of instances to add
+        """
+        self.observe(now, inqueue, numinstances)
+        desired = self.target(inqueue)
+        since = None if self.last_change is None else now - self.last_change
+        change = 0
+        if desired > numinstances:
+            # an empty fleet always gets capacity, regardless of cooldown
+            if not numinstances or since is None or since >= self.up_cooldown:
+                change = desired - numinstances
+        if change:
+            self.last_change = now
+        return change
+
+    def describe(self, inqueue, numinstances):
+        """
+        A human-readable summary of the current estimate for monitor logs.
+        """
+        if not self.rate:
+            return ''
+        tte = self.time_to_empty(inqueue, numinstances)
+        return ', %.3f events/sec/instance; empty in %s' % (
+            self.rate, '?' if tte is None else '%d min' % (tte / 60))
+
+
+def get_policy(options):
+    """
+    Build a scaling policy from monitor options.
+
+    :type options: dict
+    :param options: The monitor configuration
+
+    :rtype: object
+    :return: An AutoscalingController, or a ThresholdPolicy if the 'policy'
+             option is 'threshold'
+    """
+    if options.get('policy') == 'threshold':
+        return ThresholdPolicy(options['threshold'], options['max_size'])
+    return AutoscalingController(
+        options['threshold'], options['max_size'],
+        min_size=options.get('min_size', 0),
+        deadline=options.get('deadline', 3600),
+        up_cooldown=options.get('up_cooldown', 300))
+
+
+def scale(ec2_conn, policy, now, inqueue, tag, user_data, instance_type):
+    """
+    Apply a policy decision to the tagged fleet.
+
+    Policies only ever add instances. Parser and extraction workers may be
+    in the middle of a batch they've already claimed off the queue, so the
+    monitor never terminates them; they shut themselves down once the queue
+    has been empty for a while.
+
+    :type ec2_conn: class:`wikia_dstk.loadbalancing.EC2Connection`
+    :param ec2_conn: The connection used to add instances
+
+    :type policy: object
+    :param policy: An AutoscalingController or ThresholdPolicy
+
+    :type now: float
+    :param now: The current time in seconds
+
+    :type inqueue: int
+    :param inqueue: The current queue depth
+
+    :type tag: string
+    :param tag: The Name tag identifying the fleet
+
+    :type user_data: string
+    :param user_data: The script to run on new instances
+
+    :type instance_type: string
+    :param instance_type: The "type" tag for new instances
+
+    :rtype: tuple
+    :return: The change applied and the resulting instance count
+    """
+    instances = ec2_conn.get_tagged_instances(tag)
+    change = policy.decide(now, inqueue, len(instances))
+    if change > 0:
+        ec2_conn.add_instances(change, user_data=user_data,
+                               instance_type=instance_type)
+    return change, len(instances) + change
+
+
+def record_trace(trace_file, now, inqueue, numinstances):
+    """
+    Append an observation to a trace file that the simulator can replay.
+    """
+    if not trace_file:
+        return
+    with open(trace_file, 'a') as fl:
+        fl.write('%d,%d,%d\n' % (now, inqueue, numinstances))
@@ -0,0 +1,61 @@
+"""
+Compares the partitioners in wikia_dstk.loadbalancing.partition on real
+article counts, either pulled from the xwiki core the way
+wiki_data_extraction.launch --all does, or loaded from a JSON dump of
+{wiki ID: article count}.
+
+python -m wikia_dstk.loadbalancing.benchmark_partition --counts counts.json
+"""
+
+import json
+from argparse import ArgumentParser, Namespace
+from time import time
+from partition import PARTITIONERS, makespan_imbalance
+
+
+def get_args():
+    ap = ArgumentParser(description="Benchmark load balancing partitioners")
+    ap.add_argument('--counts', dest='counts',
+                    help="A JSON file of wiki ID to article count")
+    ap.add_argument('--dump', dest='dump',
+                    help="Write the counts fetched from Solr to this file")
+    ap.add_argument('--solr-endpoint', dest='solr_endpoint',
+                    default='http://search-s9:8983/solr')
+    ap.add_argument('--parts', dest='parts', default='5,10,20',
+                    help="Comma-separated numbers of instances to try")
+    return ap.parse_args()
+
+
+def get_counts(args):
+    if args.counts:
+        with open(args.counts) as fl:
+            return json.load(fl)
+    from ..pipeline.wiki_data_extraction.launch import execute_all
+    counts, _ = execute_all(Namespace(solr_endpoint=args.solr_endpoint))
+    if args.dump:
+        with open(args.dump, 'w') as fl:
+            json.dump(counts, fl)
+    return counts
+
+
+def main():
+    args = get_args()
+    counts = get_counts(args)
+    callback = lambda x: counts[x]
+    print '%d wikis, %d articles, largest %d' % (
+        len(counts), sum(counts.values()), max(counts.values()))
+    print '%-12s %6s %10s %12s %10s' % (
+        'strategy', 'parts', 'imbalance', 'max load', 'seconds')
+    for num_parts in [int(n) for n in args.parts.split(',')]:
+        for name in sorted(PARTITIONERS):
+            start = time()
+            parts = PARTITIONERS[name](counts.keys(), callback, num_parts)
+            elapsed = time() - start
+            max_load = max([sum(map(callback, part)) for part in parts])
+            print '%-12s %6d %10.4f %12d %10.3f' % (
+                name, num_parts, makespan_imbalance(parts, callback),
+                max_load, elapsed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""
+Strategies for splitting weighted IDs into a fixed number of parts with
+totals as even as possible, so no one instance is left running long after
+the others have finished.
+"""
+
+import heapq
+from itertools import count
+
+
+def round_robin(ids, callback, num_parts):
+    """
+    Sort IDs by weight and deal them out in turn. This is what
+    run_instances_lb always used to do.
+
+    :type ids: list
+    :param ids: The IDs to partition
+
+    :type callback: function
+    :param callback: Given an ID, returns its weight
+
+    :type num_parts: int
+    :param num_parts: The number of parts to split the IDs into
+
+    :rtype: list
+    :return: A list of num_parts lists of IDs
+    """
+    parts = [[] for _ in range(num_parts)]
+    for n, id_ in enumerate(sorted(ids, key=callback, reverse=True)):
+        parts[n % num_parts].append(id_)
+    return parts
+
+
+def greedy_lpt(ids, callback, num_parts):
+    """
+    Longest processing time first: hand each ID, heaviest first, to the part
+    with the lowest total so far.
+
+    :type ids: list
+    :param ids: The IDs to partition
+
+    :type callback: function
+    :param callback: Given an ID, returns its weight
+
+    :type num_parts: int
+    :param num_parts: The number of parts to split the IDs into
+
+    :rtype: list
+    :return: A list of num_parts lists of IDs
+    """
+    parts = [[] for _ in range(num_parts)]
+    heap = [(0, n) for n in range(num_parts)]
+    for id_ in sorted(ids, key=callback, reverse=True):
+        load, n = heapq.heappop(heap)
+        parts[n].append(id_)
+        heapq.heappush(heap, (load + callback(id_), n))
+    return parts
+
+
+def capped_lpt(ids, callback, num_parts, cap=None):
+    """
+    Greedy LPT, except that a part stops taking IDs once it holds `cap` of
+    them. Useful when per-ID overhead matters as well as weight, so one part
+    doesn't end up with every tiny wiki.
+
+    :type ids: list
+    :param ids: The IDs to partition
+
+    :type callback: function
+    :param callback: Given an ID, returns its weight
+
+    :type num_parts: int
+    :param num_parts: The number of parts to split the IDs into
+
+    :type cap: int
+    :param cap: The most IDs a part may hold; defaults to an even split,
+                rounded up
+
+    :rtype: list
+    :return: A list of num_parts lists of IDs
+    """
+    if cap is None:
+        cap = -(-len(ids) // num_parts)
+    parts = [[] for _ in range(num_parts)]
+    heap = [(0, n) for n in range(num_parts)]
+    for id_ in sorted(ids, key=callback, reverse=True):
+        if not heap:
+            raise ValueError('%d IDs won\'t fit in %d parts of %d' % (
+                len(ids), num_parts, cap))
+        load, n = heapq.heappop(heap)
+        parts[n].append(id_)
+        if len(parts[n]) < cap:
+            heapq.heappush(heap, (load + callback(id_), n))
+    return parts
+
+
+def karmarkar_karp(ids, callback, num_parts):
+    """
+    Multi-way Karmarkar-Karp differencing. Each ID starts as a partial
+    partition of its own; the two partials with the largest spread are
+    repeatedly merged, pairing the heaviest part of one with the lightest of
+    the other, until one partition remains.
+
+    :type ids: list
+    :param ids: The IDs to partition
+
+    :type callback: function
+    :param callback: Given an ID, returns its weight
+
+    :type num_parts: int
+    :param num_parts: The number of parts to split the IDs into
+
+    :rtype: list
+    :return: A list of num_parts lists of IDs
+    """
+    if not ids:
+        return [[] for _ in range(num_parts)]
+    tiebreak = count()
+    heap = []
+    for id_ in ids:
+        weight = callback(id_)
+        sums = [weight] + [0] * (num_parts - 1)
+        parts = [[id_]] + [[] for _ in range(num_parts - 1)]
+        heapq.heappush(heap, (-weight, next(tiebreak), sums, parts))
+    while len(heap) > 1:
+        _, _, sums_a, parts_a = heapq.heappop(heap)
+        _, _, sums_b, parts_b = heapq.heappop(heap)
+        # both are kept sorted heaviest first, so reversing one pairs
+        # heavy with light
+        merged = sorted(zip([a + b for a, b in zip(sums_a, sums_b[::-1])],
+                            [a + b for a, b in zip(parts_a, parts_b[::-1])]),
+                        key=lambda x: x[0], reverse=True)
+        sums = [s for s, _ in merged]
+        parts = [p for _, p in merged]
+        heapq.heappush(heap, (sums[-1] - sums[0], next(tiebreak), sums, parts))
+    return heap[0][3]
+
+
+def makespan_imbalance(parts, callback):
+    """
+    How much longer the heaviest part takes than the average part
+
+    :type parts: list
+    :param parts: Lists of IDs
+
+    :type callback: function
+    :param callback: Given an ID, returns its weight
+
+    :rtype: float
+    :return: The heaviest part's total over the mean total; 1.0 is perfect
+    """
+    loads = [sum([callback(id_) for id_ in part]) for part in parts]
+    mean = float(sum(loads)) / len(loads) if loads else 0
+    if not mean:
+        return 1.0
+    return max(loads) / mean
+
+
+PARTITIONERS = {
+    'round_robin': round_robin,
+    'lpt': greedy_lpt,
+    'capped_lpt': capped_lpt,
+    'kk': karmarkar_karp,
+}
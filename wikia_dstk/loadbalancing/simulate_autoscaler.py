@@ -0,0 +1,176 @@
+"""
+Replays a recorded queue-depth trace against a scaling policy, without EC2.
+
+Traces are the files the monitors write with --trace_file: one
+"timestamp,inqueue,numinstances" line per interval. Increases in the recorded
+depth are treated as arrivals of new work; the simulated fleet drains the
+queue at a fixed per-instance rate, and new instances only start draining
+after a boot delay. Instances shut themselves down once the queue has been
+empty for the idle timeout, as the workers do.
+
+python -m wikia_dstk.loadbalancing.simulate_autoscaler --trace parser.trace \
+    --rate 0.02 --max-size 10 --threshold 10
+"""
+
+from __future__ import division
+from argparse import ArgumentParser, FileType
+from .autoscaler import AutoscalingController, ThresholdPolicy
+
+
+def get_args():
+    ap = ArgumentParser(description="Compare scaling policies on a trace")
+    ap.add_argument('--trace', dest='trace', type=FileType('r'), required=True,
+                    help="A trace file written by a monitor")
+    ap.add_argument('--rate', dest='rate', type=float, default=None,
+                    help="Events per second drained by one instance; " +
+                         "estimated from the trace if omitted")
+    ap.add_argument('--boot-delay', dest='boot_delay', type=int, default=300,
+                    help="Seconds before a new instance starts working")
+    ap.add_argument('--idle-shutdown', dest='idle_shutdown', type=int,
+                    default=900,
+                    help="Seconds of empty queue before workers terminate")
+    ap.add_argument('--threshold', dest='threshold', type=int, default=10)
+    ap.add_argument('--max-size', dest='max_size', type=int, default=10)
+    ap.add_argument('--deadline', dest='deadline', type=int, default=3600)
+    ap.add_argument('--up-cooldown', dest='up_cooldown', type=int,
+                    default=300)
+    return ap.parse_args()
+
+
+def load_trace(fl):
+    """
+    Read a trace file.
+
+    :type fl: file
+    :param fl: An open trace file
+
+    :rtype: list
+    :return: A list of (timestamp, inqueue, numinstances) tuples
+    """
+    trace = []
+    for line in fl:
+        splt = line.strip().split(',')
+        if len(splt) < 2:
+            continue
+        numinstances = int(splt[2]) if len(splt) > 2 else 0
+        trace.append((float(splt[0]), int(splt[1]), numinstances))
+    return trace
+
+
+def estimate_rate(trace):
+    """
+    Estimate per-instance throughput from the drain observed in a trace.
+
+    :type trace: list
+    :param trace: (timestamp, inqueue, numinstances) tuples
+
+    :rtype: float
+    :return: Events per second per instance, or None if the queue never
+             drained with instances running
+    """
+    controller = AutoscalingController(1, 1)
+    for now, inqueue, numinstances in trace:
+        controller.observe(now, inqueue, numinstances)
+    return controller.rate
+
+
+def simulate(trace, policy, rate, boot_delay, idle_shutdown=900):
+    """
+    Run a policy over the arrivals recorded in a trace.
+
+    :type trace: list
+    :param trace: (timestamp, inqueue, numinstances) tuples
+
+    :type policy: object
+    :param policy: An AutoscalingController or ThresholdPolicy
+
+    :type rate: float
+    :param rate: Events per second drained by one running instance
+
+    :type boot_delay: int
+    :param boot_delay: Seconds before a new instance starts draining
+
+    :type idle_shutdown: int
+    :param idle_shutdown: Seconds of empty queue before instances terminate
+
+    :rtype: dict
+    :return: Makespan, instance-hours, scaling actions, and peak values
+    """
+    start = trace[0][0]
+    interval = min([b[0] - a[0] for a, b in zip(trace, trace[1:])] or [60])
+    interval = max(interval, 1)
+    arrivals = []
+    last_depth = 0
+    for now, inqueue, _ in trace:
+        if inqueue > last_depth:
+            arrivals.append((now, inqueue - last_depth))
+        last_depth = inqueue
+    last_arrival = arrivals[-1][0] if arrivals else start
+
+    now = start
+    depth = 0.0
+    ready_at = []  # one boot completion time per instance
+    instance_seconds = 0
+    actions = 0
+    peak_instances = 0
+    peak_depth = 0
+    empty_since = None
+    while True:
+        while arrivals and arrivals[0][0] <= now:
+            depth += arrivals.pop(0)[1]
+        # the fleet only shrinks by idle shutdown, as on EC2
+        change = policy.decide(now, int(round(depth)), len(ready_at))
+        if change > 0:
+            ready_at += [now + boot_delay] * change
+            actions += 1
+        peak_instances = max(peak_instances, len(ready_at))
+        peak_depth = max(peak_depth, depth)
+        working = len([r for r in ready_at if r <= now])
+        depth = max(depth - working * rate * interval, 0)
+        instance_seconds += len(ready_at) * interval
+        if depth >= 0.5:
+            empty_since = None
+        elif empty_since is None:
+            empty_since = now
+        elif now - empty_since >= idle_shutdown:
+            ready_at = []
+        now += interval
+        if now > last_arrival and depth < 0.5:
+            break
+        if now - start > 30 * 24 * 3600:
+            break  # a policy that never drains the queue
+    return dict(makespan=now - start, instance_hours=instance_seconds / 3600,
+                actions=actions, peak_instances=peak_instances,
+                peak_depth=int(peak_depth))
+
+
+def main():
+    args = get_args()
+    trace = load_trace(args.trace)
+    if not trace:
+        print "Empty trace"
+        return
+    rate = args.rate or estimate_rate(trace)
+    if not rate:
+        print "Could not estimate a drain rate from the trace; pass --rate"
+        return
+    print "Per-instance rate: %.4f events/sec" % rate
+    policies = [
+        ('threshold', ThresholdPolicy(args.threshold, args.max_size)),
+        ('predictive', AutoscalingController(
+            args.threshold, args.max_size, deadline=args.deadline,
+            up_cooldown=args.up_cooldown))
+    ]
+    print "%-12s %10s %14s %8s %14s %10s" % (
+        'policy', 'makespan', 'instance-hours', 'actions', 'peak instances',
+        'peak depth')
+    for name, policy in policies:
+        result = simulate(trace, policy, rate, args.boot_delay,
+                          args.idle_shutdown)
+        print "%-12s %9dm %14.2f %8d %14d %10d" % (
+            name, result['makespan'] / 60, result['instance_hours'],
+            result['actions'], result['peak_instances'], result['peak_depth'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""
+Simulates a wiki_data_extraction job on local processes to compare static
+assignment with work stealing.
+
+Each node is a process that "works" on an ID by sleeping for its weight
+times --seconds-per-unit, divided by the node's speed. Some nodes are made
+slower to stand in for noisy neighbours and bad spot instances. Both modes
+start from the same partition; in static mode nodes only take chunks from
+their own home.
+
+python -m wikia_dstk.loadbalancing.simulate_stealing --counts counts.json
+"""
+
+import json
+import random
+import shutil
+import tempfile
+from argparse import ArgumentParser
+from multiprocessing import Process, Queue
+from time import sleep, time
+from partition import PARTITIONERS, makespan_imbalance
+from worksteal import LocalChunkQueue, make_chunks
+
+
+def get_args():
+    ap = ArgumentParser(description="Simulate static vs work-stealing runs")
+    ap.add_argument('--counts', dest='counts',
+                    help="A JSON file of wiki ID to article count; "
+                         "Pareto-distributed counts are generated otherwise")
+    ap.add_argument('--num-ids', dest='num_ids', type=int, default=2000)
+    ap.add_argument('--nodes', dest='nodes', type=int, default=5)
+    ap.add_argument('--chunks-per-node', dest='chunks_per_node', type=int,
+                    default=20)
+    ap.add_argument('--stragglers', dest='stragglers', type=int, default=1,
+                    help="The number of nodes that run slowly")
+    ap.add_argument('--slowdown', dest='slowdown', type=float, default=2.0,
+                    help="How many times slower a straggler is")
+    ap.add_argument('--seconds-per-unit', dest='seconds_per_unit',
+                    type=float, default=None,
+                    help="Simulated work per unit of weight; by default the "
+                         "ideal makespan is about 10 seconds")
+    ap.add_argument('--partitioner', dest='partitioner', default='lpt',
+                    choices=sorted(PARTITIONERS.keys()))
+    ap.add_argument('--seed', dest='seed', type=int, default=0)
+    return ap.parse_args()
+
+
+def get_counts(args):
+    if args.counts:
+        with open(args.counts) as fl:
+            return json.load(fl)
+    return dict([(str(n), int(random.paretovariate(1.2) * 50))
+                 for n in range(args.num_ids)])
+
+
+def node_loop(queue, node, speed, seconds_per_unit, steal, results):
+    """
+    Work through chunks until there are none left to take
+
+    :type steal: bool
+    :param steal: Whether to take chunks from other nodes' homes
+    """
+    start = time()
+    done = 0
+    while True:
+        if steal:
+            contents = queue.next_chunk(node)
+        else:
+            mine = [name for home, name in queue.list() if home == node]
+            contents = queue.claim(node, mine[0], node) if mine else None
+        if contents is None:
+            break
+        for token in contents.split(','):
+            weight = int(token.split(':')[1])
+            sleep(weight * seconds_per_unit / speed)
+            done += weight
+    results.put((node, time() - start, done))
+
+
+def run(args, counts, parts, speeds, seconds_per_unit, steal):
+    """
+    Queue the partition and run one process per node
+
+    :rtype: tuple
+    :return: The makespan and a list of (node, seconds, weight done) tuples
+    """
+    callback = lambda x: counts[x]
+    total = sum(counts.values())
+    chunk_weight = max(1, total // (len(parts) * args.chunks_per_node))
+    directory = tempfile.mkdtemp()
+    try:
+        queue = LocalChunkQueue(directory, 'simulation')
+        for n, part in enumerate(parts):
+            for chunk, weight in make_chunks(part, callback, chunk_weight):
+                queue.put('node%d' % n, ','.join(
+                    ['%s:%d' % (id_, callback(id_)) for id_ in chunk]),
+                    weight)
+        results = Queue()
+        start = time()
+        processes = [Process(target=node_loop,
+                             args=(queue, 'node%d' % n, speeds[n],
+                                   seconds_per_unit, steal, results))
+                     for n in range(len(parts))]
+        for process in processes:
+            process.start()
+        finished = sorted([results.get() for _ in processes])
+        for process in processes:
+            process.join()
+        return time() - start, finished
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    args = get_args()
+    random.seed(args.seed)
+    counts = get_counts(args)
+    callback = lambda x: counts[x]
+    parts = PARTITIONERS[args.partitioner](counts.keys(), callback,
+                                           args.nodes)
+    speeds = [1.0 / args.slowdown if n < args.stragglers else 1.0
+              for n in range(args.nodes)]
+    seconds_per_unit = args.seconds_per_unit
+    if seconds_per_unit is None:
+        seconds_per_unit = 10.0 * sum(speeds) / sum(counts.values())
+    print '%d IDs on %d nodes (%d at 1/%.1f speed), %s imbalance %.3f' % (
+        len(counts), args.nodes, args.stragglers, args.slowdown,
+        args.partitioner, makespan_imbalance(parts, callback))
+
+    for name, steal in [('static', False), ('stealing', True)]:
+        makespan, finished = run(args, counts, parts, speeds,
+                                 seconds_per_unit, steal)
+        print '%-9s makespan %.2fs' % (name, makespan)
+        for node, seconds, done in finished:
+            print '    %-7s finished after %6.2fs, %8d units' % (
+                node, seconds, done)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+"""
+Tracks spot instance requests until they're fulfilled, and caches the
+account's instance and request counts so launching doesn't list everything
+every time.
+
+One background thread per tracker describes every outstanding request in a
+single call, backing off while nothing changes, and resolves a Future per
+request as instances appear. If describing keeps failing, every pending
+Future fails rather than waiting forever, and callers wait at most
+FULFILMENT_TIMEOUT seconds for instances by default.
+"""
+
+import threading
+from boto.exception import EC2ResponseError
+from time import time
+from .. import Future, log
+
+# Requests in these states will never get an instance
+DEAD_STATES = ('cancelled', 'failed', 'closed')
+
+# Seconds to wait for spot requests to get instances
+FULFILMENT_TIMEOUT = 3600
+
+
+class SpotRequestError(Exception):
+    pass
+
+
+def wait_for(futures, timeout=FULFILMENT_TIMEOUT):
+    """
+    Get the results of several futures, waiting at most `timeout` seconds in
+    all
+
+    :type futures: list
+    :param futures: class:`wikia_dstk.Future` objects
+
+    :type timeout: float
+    :param timeout: Seconds to wait for all of them, or None to wait forever
+
+    :rtype: list
+    :return: Their results, in order; raises multiprocessing.TimeoutError if
+             they aren't all ready in time
+    """
+    deadline = None if timeout is None else time() + timeout
+    return [f.get(None if deadline is None else max(0, deadline - time()))
+            for f in futures]
+
+
+class ReservationResult(object):
+    """
+    The instance IDs of several reservations, in the shape add_instances_async
+    has always returned: a list of instance ID lists, one per reservation.
+    """
+
+    def __init__(self, futures):
+        """
+        :type futures: list
+        :param futures: Lists of class:`wikia_dstk.Future`, one list per
+                        reservation
+        """
+        self.futures = futures
+
+    def ready(self):
+        return all([f.ready() for group in self.futures for f in group])
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time() + timeout
+        for group in self.futures:
+            for future in group:
+                future.wait(None if deadline is None
+                            else max(0, deadline - time()))
+
+    def get(self, timeout=FULFILMENT_TIMEOUT):
+        self.wait(timeout)
+        return [[f.get(0) for f in group] for group in self.futures]
+
+
+class SpotRequestTracker(object):
+    """Resolves a future per spot request once it has an instance."""
+
+    def __init__(self, conn, min_interval=5, max_interval=60, max_failures=5):
+        """
+        :type conn: class:`boto.ec2.connection.EC2Connection`
+        :param conn: The connection to describe requests with
+
+        :type min_interval: float
+        :param min_interval: Seconds between polls right after a change
+
+        :type max_interval: float
+        :param max_interval: The most seconds to wait between polls
+
+        :type max_failures: int
+        :param max_failures: Polls in a row that can fail before every pending
+                             request is given up on
+        """
+        self.conn = conn
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_failures = max_failures
+        self.pending = {}  # request ID -> Future
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def track(self, request_ids):
+        """
+        Start tracking spot requests
+
+        :type request_ids: list
+        :param request_ids: Spot instance request IDs
+
+        :rtype: list
+        :return: A class:`wikia_dstk.Future` per request, resolving to its
+                 instance ID
+        """
+        futures = [Future() for _ in request_ids]
+        with self.lock:
+            self.pending.update(zip(request_ids, futures))
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+        self.wakeup.set()
+        return futures
+
+    def poll(self):
+        """
+        Describe every pending request at once and resolve the ones that are
+        done
+
+        :rtype: int
+        :return: The number of requests resolved
+        """
+        with self.lock:
+            request_ids = self.pending.keys()
+        if not request_ids:
+            return 0
+        try:
+            requests = self.conn.get_all_spot_instance_requests(
+                request_ids=request_ids)
+        except EC2ResponseError as e:
+            # new requests can take a moment to become visible
+            log('Describing spot requests failed:', e.error_code)
+            return 0
+        resolved = 0
+        for request in requests:
+            with self.lock:
+                future = self.pending.get(request.id)
+                if future is None:
+                    continue
+                if request.instance_id:
+                    del self.pending[request.id]
+                    future.set_result(request.instance_id)
+                elif request.state in DEAD_STATES:
+                    del self.pending[request.id]
+                    future.set_exception(SpotRequestError(
+                        '%s is %s: %s' % (request.id, request.state,
+                                          request.status.code)))
+                else:
+                    continue
+            resolved += 1
+        return resolved
+
+    def fail_pending(self, error):
+        """
+        Fail every pending request's future and stop tracking them
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.thread = None
+        for future in pending.values():
+            future.set_exception(error)
+
+    def run(self):
+        interval = self.min_interval
+        failures = 0
+        while True:
+            self.wakeup.wait(interval)
+            if self.wakeup.is_set():
+                self.wakeup.clear()
+                interval = self.min_interval
+            try:
+                resolved = self.poll()
+                failures = 0
+            except Exception as e:
+                # e.g. socket and HTTP errors, which would otherwise end the
+                # thread and leave every caller waiting
+                failures += 1
+                log('Polling spot requests failed:', repr(e))
+                if failures >= self.max_failures:
+                    self.fail_pending(SpotRequestError(
+                        'Gave up on spot requests after %d failed polls: %r'
+                        % (failures, e)))
+                    return
+                resolved = 0
+            if resolved:
+                interval = self.min_interval
+            else:
+                interval = min(interval * 2, self.max_interval)
+            with self.lock:
+                if not self.pending:
+                    self.thread = None
+                    return
+
+
+class InventoryCache(object):
+    """
+    Counts of active instances and spot requests, refreshed at most every
+    `ttl` seconds. Requests made in between are added to the cached counts.
+    """
+
+    def __init__(self, conn, ttl=60):
+        """
+        :type conn: class:`boto.ec2.connection.EC2Connection`
+        :param conn: The connection to list instances and requests with
+
+        :type ttl: float
+        :param ttl: Seconds to trust the cached counts for
+        """
+        self.conn = conn
+        self.ttl = ttl
+        self.fetched = 0
+        self.instances = 0
+        self.requests = 0
+
+    def refresh(self):
+        # pending, running, shutting-down, stopping
+        self.instances = len(filter(
+            lambda x: x.state_code in (0, 16, 32, 64),
+            self.conn.get_only_instances()))
+        self.requests = len(filter(
+            lambda x: x.status.code != 'instance-terminated-by-user',
+            self.conn.get_all_spot_instance_requests()))
+        self.fetched = time()
+
+    def counts(self, refresh=False):
+        """
+        :type refresh: bool
+        :param refresh: Ignore the cache
+
+        :rtype: tuple
+        :return: The number of active instances and active spot requests
+        """
+        if refresh or time() - self.fetched > self.ttl:
+            self.refresh()
+        return self.instances, self.requests
+
+    def add(self, count):
+        """
+        Account for new spot requests until the next refresh
+        """
+        self.instances += count
+        self.requests += count
@@ -0,0 +1,252 @@
+"""
+Work stealing across instances.
+
+Instead of one fixed event file per instance, the launcher splits each
+instance's share of the IDs into small weighted chunks under a home prefix
+for that instance. Instances work through their own chunks, heaviest first,
+and once they run dry they claim chunks from whichever peer has the most
+weight left, taking from the light end so they don't end up holding the
+job's longest chunk themselves.
+
+Chunk names carry their weight, so listing the queue is enough to decide
+what to take:
+
+    lb_queue/<job>/<node>/<weight>_<uuid>
+"""
+
+import os
+from abc import ABCMeta, abstractmethod
+from boto.exception import S3ResponseError
+from boto.s3.key import Key
+from uuid import uuid4
+
+QUEUE_PREFIX = 'lb_queue'
+
+
+def make_chunks(ids, callback, chunk_weight):
+    """
+    Group IDs into chunks of roughly chunk_weight each. IDs heavier than
+    chunk_weight get a chunk to themselves.
+
+    :type ids: list
+    :param ids: The IDs to chunk
+
+    :type callback: function
+    :param callback: Given an ID, returns its weight
+
+    :type chunk_weight: int
+    :param chunk_weight: The target total weight of a chunk
+
+    :rtype: list
+    :return: (list of IDs, total weight) tuples
+    """
+    chunks = []
+    chunk, weight = [], 0
+    for id_ in sorted(ids, key=callback, reverse=True):
+        chunk.append(id_)
+        weight += callback(id_)
+        if weight >= chunk_weight:
+            chunks.append((chunk, weight))
+            chunk, weight = [], 0
+    if chunk:
+        chunks.append((chunk, weight))
+    return chunks
+
+
+def chunk_name(weight):
+    return '%d_%s' % (weight, uuid4())
+
+
+def chunk_weight_from_name(name):
+    return int(name.split('_', 1)[0])
+
+
+class ChunkQueue(object):
+    """
+    Chunks of IDs, grouped by the node they were originally assigned to.
+    Subclasses store them somewhere every node can see and implement put,
+    list and claim.
+    """
+
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def put(self, node, contents, weight):
+        """
+        Add a chunk to a node's home
+
+        :type node: string
+        :param node: The node the chunk is assigned to
+
+        :type contents: string
+        :param contents: The chunk, as it should be handed to the worker
+
+        :type weight: int
+        :param weight: The chunk's total weight
+        """
+
+    @abstractmethod
+    def list(self):
+        """
+        :rtype: list
+        :return: (node, chunk name) tuples for every unclaimed chunk
+        """
+
+    @abstractmethod
+    def claim(self, node, name, claimer):
+        """
+        Take a chunk out of the queue
+
+        :type node: string
+        :param node: The home of the chunk
+
+        :type name: string
+        :param name: The chunk name
+
+        :type claimer: string
+        :param claimer: The node claiming it
+
+        :rtype: string
+        :return: The chunk's contents, or None if another node got it first
+        """
+
+    def next_chunk(self, node):
+        """
+        Claim the next chunk for a node: its own heaviest, or failing that the
+        lightest chunk of the peer with the most weight left
+
+        :type node: string
+        :param node: The claiming node
+
+        :rtype: string
+        :return: The chunk's contents, or None once the queue is empty
+        """
+        while True:
+            homes = {}
+            for home, name in self.list():
+                homes.setdefault(home, []).append(name)
+            if not homes:
+                return None
+            if node in homes:
+                home = node
+                name = max(homes[node], key=chunk_weight_from_name)
+            else:
+                home = max(homes, key=lambda h: sum(
+                    map(chunk_weight_from_name, homes[h])))
+                name = min(homes[home], key=chunk_weight_from_name)
+            contents = self.claim(home, name, node)
+            if contents is not None:
+                return contents
+            # somebody beat us to it; look again
+
+    def iterate_chunks(self, node):
+        """
+        Yield chunk contents for a node until the whole queue is empty
+        """
+        while True:
+            contents = self.next_chunk(node)
+            if contents is None:
+                return
+            yield contents
+
+
+class S3ChunkQueue(ChunkQueue):
+    """
+    Chunks stored as keys under lb_queue/<job>/. A chunk is claimed by
+    copying it under claimed/ and deleting the original, the same
+    move-to-claim pattern the pipeline uses for its event files. Like those,
+    two nodes can occasionally both get a chunk; the services are idempotent
+    so that only costs time.
+    """
+
+    def __init__(self, bucket, job):
+        """
+        :type bucket: class:`boto.s3.bucket.Bucket`
+        :param bucket: The bucket holding the queue
+
+        :type job: string
+        :param job: The job ID
+        """
+        self.bucket = bucket
+        self.prefix = '%s/%s/' % (QUEUE_PREFIX, job)
+
+    def put(self, node, contents, weight):
+        k = Key(self.bucket)
+        k.key = self.prefix + '%s/%s' % (node, chunk_name(weight))
+        k.set_contents_from_string(contents)
+
+    def list(self):
+        chunks = []
+        for key in self.bucket.list(prefix=self.prefix):
+            node, _, name = key.name[len(self.prefix):].partition('/')
+            if node != 'claimed':
+                chunks.append((node, name))
+        return chunks
+
+    def claim(self, node, name, claimer):
+        old_key_name = self.prefix + '%s/%s' % (node, name)
+        new_key_name = self.prefix + 'claimed/%s/%s' % (claimer, name)
+        try:
+            key = self.bucket.get_key(old_key_name)
+            if key is None:
+                return None
+            key.copy(self.bucket, new_key_name)
+            key.delete()
+            new_key = self.bucket.get_key(new_key_name)
+            contents = new_key.get_contents_as_string()
+            new_key.delete()
+            return contents
+        except S3ResponseError:
+            return None
+
+
+class LocalChunkQueue(ChunkQueue):
+    """
+    Chunks stored as files under <directory>/<job>/. Claiming is an
+    os.rename, which is atomic, so every chunk goes to exactly one node.
+    Used for simulations and for running on a single machine.
+    """
+
+    def __init__(self, directory, job):
+        """
+        :type directory: string
+        :param directory: The directory holding the queue
+
+        :type job: string
+        :param job: The job ID
+        """
+        self.root = os.path.join(directory, job)
+        self.claimed = os.path.join(self.root, '.claimed')
+        for path in [self.root, self.claimed]:
+            if not os.path.exists(path):
+                os.makedirs(path)
+
+    def put(self, node, contents, weight):
+        home = os.path.join(self.root, node)
+        if not os.path.exists(home):
+            os.makedirs(home)
+        path = os.path.join(home, chunk_name(weight))
+        with open(path + '.tmp', 'w') as fl:
+            fl.write(contents)
+        os.rename(path + '.tmp', path)
+
+    def list(self):
+        chunks = []
+        for node in os.listdir(self.root):
+            if node == '.claimed':
+                continue
+            for name in os.listdir(os.path.join(self.root, node)):
+                if not name.endswith('.tmp'):
+                    chunks.append((node, name))
+        return chunks
+
+    def claim(self, node, name, claimer):
+        path = os.path.join(self.claimed, '%s_%s' % (claimer, name))
+        try:
+            os.rename(os.path.join(self.root, node, name), path)
+        except OSError:
+            return None
+        with open(path) as fl:
+            contents = fl.read()
+        os.remove(path)
+        return contents
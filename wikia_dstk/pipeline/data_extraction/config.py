@@ -10,6 +10,11 @@ default_config = {
     "threshold": 50,
     "max_size": 5,
     "git_ref": "master",
+    "policy": "predictive",  # or "threshold" for the old behavior
+    "min_size": 0,
+    "deadline": 3600,  # seconds in which the queue should empty
+    "up_cooldown": 300,
+    "trace_file": "",
     "services": ",".join([
         "AllNounPhrasesService",
         "AllVerbPhrasesService",
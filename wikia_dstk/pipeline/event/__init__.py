@@ -1,6 +1,13 @@
 import json
 import requests
+import threading
+import time
 from nltk.tokenize import PunktSentenceTokenizer
+from Queue import Queue
+
+
+BULLETS = ('\xe2\x80\xa2'.decode('utf-8'), '\xc2\xb7'.decode('utf-8'))
+sentence_tokenizer = PunktSentenceTokenizer()
 
 
 def clean_list(text):
@@ -13,16 +20,55 @@ def clean_list(text):
     :rtype: list
     :return: A list of strings that have been deemed worthy for parser input
     """
-    bullet1 = '\xe2\x80\xa2'.decode('utf-8')
-    bullet2 = '\xc2\xb7'.decode('utf-8')
     cleaned = []
-    for sentence in PunktSentenceTokenizer().tokenize(text):
+    for sentence in sentence_tokenizer.tokenize(text):
         if len(sentence.split(' ')) < 50:
-            if bullet1 not in sentence and bullet2 not in sentence:
+            if BULLETS[0] not in sentence and BULLETS[1] not in sentence:
                 cleaned.append(sentence.encode('utf-8'))
     return cleaned
 
 
+def clean_batch(docs):
+    """
+    Clean a batch of documents; meant to be mapped over a process pool.
+
+    :type docs: list
+    :param docs: A list of (doc_id, html_en) tuples
+
+    :rtype: list
+    :return: A list of (doc_id, cleaned text) tuples
+    """
+    return [(doc_id, '\n'.join(clean_list(text))) for doc_id, text in docs]
+
+
+class StageStats(object):
+    """Thread-safe per-stage document counters for throughput reporting."""
+
+    def __init__(self, stages):
+        """
+        :type stages: list
+        :param stages: Stage names, in pipeline order
+        """
+        self.stages = stages
+        self.counts = dict((stage, 0) for stage in stages)
+        self.lock = threading.Lock()
+        self.start = time.time()
+
+    def add(self, stage, count=1):
+        with self.lock:
+            self.counts[stage] += count
+
+    def report(self):
+        """
+        :rtype: string
+        :return: Counts and docs/sec for each stage since creation
+        """
+        elapsed = max(time.time() - self.start, 0.001)
+        return ', '.join(['%s: %d (%.1f docs/sec)' % (
+            stage, self.counts[stage], self.counts[stage] / elapsed)
+            for stage in self.stages])
+
+
 class QueryIterator(object):
     """ Options is a dictionary -- use vals(options) on an optparse instance """
     def __init__(self, config, options):
@@ -87,3 +133,141 @@ class QueryIterator(object):
             self.getMoreDocs()
         self.at += 1
         return self.docs.pop()
+
+
+class CursorQueryIterator(object):
+    """
+    Pages through Solr with cursorMark instead of start/rows offsets, so each
+    page costs the same no matter how deep it is. The next page is fetched on
+    a background thread while the current one is consumed, and the page size
+    adapts to how long Solr takes to answer.
+    """
+    def __init__(self, host, options, prefetch=2, min_rows=100,
+                 max_rows=2000, target_seconds=2.0):
+        """
+        :type host: string
+        :param host: The Solr core URL, ending in a slash
+
+        :type options: dict
+        :param options: query (required), fields, filterquery, sort, rows,
+                        limit -- as with QueryIterator
+
+        :type prefetch: int
+        :param prefetch: The number of pages to fetch ahead of the consumer
+
+        :type min_rows: int
+        :param min_rows: The smallest page size to shrink to
+
+        :type max_rows: int
+        :param max_rows: The largest page size to grow to
+
+        :type target_seconds: float
+        :param target_seconds: The response time the page size aims for
+        """
+        if type(host) == dict:
+            host = host["common"]["solr_endpoint"]
+        if not options.get('query', False):
+            raise Exception("Query is required")
+        self.host = host
+        self.query = options.get('query')
+        self.fields = options.get('fields', '*')
+        self.filterquery = options.get('filterquery', None)
+        self.limit = options.get('limit', None)
+        # cursorMark requires a sort that includes the unique key
+        sort = options.get('sort', None) or 'id asc'
+        if 'id' not in [c.split()[0] for c in sort.split(',') if c.strip()]:
+            sort += ',id asc'
+        self.sort = sort
+        self.rows = int(options.get('rows', min_rows))
+        self.min_rows = min_rows
+        self.max_rows = max_rows
+        self.target_seconds = target_seconds
+        self.numFound = None
+        self.at = 0
+        self.docs = []
+        self.exhausted = False
+        self.pages = Queue(maxsize=prefetch)
+        self.stopped = False
+        self.thread = threading.Thread(target=self.fetchPages)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __iter__(self):
+        return self
+
+    def getParams(self, cursor):
+        params = {
+            'q': self.query,
+            'wt': 'json',
+            'rows': self.rows,
+            'fl': self.fields,
+            'sort': self.sort,
+            'cursorMark': cursor
+            }
+        if self.filterquery:
+            params['fq'] = self.filterquery
+        return params
+
+    def adaptRows(self, elapsed):
+        if elapsed < self.target_seconds / 2 and self.rows < self.max_rows:
+            self.rows = min(self.rows * 2, self.max_rows)
+        elif elapsed > self.target_seconds and self.rows > self.min_rows:
+            self.rows = max(self.rows / 2, self.min_rows)
+
+    def fetchPages(self):
+        cursor = '*'
+        try:
+            while not self.stopped:
+                start = time.time()
+                request = requests.get(self.host+"select",
+                                       params=self.getParams(cursor),
+                                       timeout=300)
+                response = json.loads(request.content)
+                self.adaptRows(time.time() - start)
+                self.numFound = response['response']['numFound']
+                docs = response['response']['docs']
+                if docs:
+                    self.pages.put(docs)
+                next_cursor = response.get('nextCursorMark', cursor)
+                if next_cursor == cursor or not docs:
+                    break
+                cursor = next_cursor
+            self.pages.put(None)
+        except Exception as e:
+            self.pages.put(e)
+
+    def percentLeft(self):
+        max = self.numFound if not self.limit else self.limit
+        if not max:
+            # no results, or the first page hasn't arrived yet
+            return 0
+        return (float(self.at)/float(max)) * 100
+
+    def close(self):
+        """
+        Stop fetching pages early.
+        """
+        self.stopped = True
+        while self.thread.is_alive():
+            if self.pages.empty():
+                self.thread.join(0.1)
+            else:
+                self.pages.get()
+
+    def next(self):
+        if self.at == self.limit:
+            self.close()
+            raise StopIteration
+        if self.exhausted:
+            raise StopIteration
+        if not self.docs:
+            page = self.pages.get()
+            if page is None:
+                self.exhausted = True
+                raise StopIteration
+            if isinstance(page, Exception):
+                raise page
+            self.docs = page
+            self.docs.reverse()
+        self.at += 1
+        return self.docs.pop()
@@ -0,0 +1,132 @@
+"""
+Compares QueryIterator (start/rows) with CursorQueryIterator (cursorMark)
+against a local Solr stub serving a deep, synthetic result set.
+
+The stub collects the top start+rows documents for offset queries and the
+top rows documents after the cursor for cursorMark queries, the way Solr's
+priority queue does, so deep offset pages get progressively more expensive.
+
+python -m wikia_dstk.pipeline.event.benchmark_solr --num-docs 200000
+"""
+
+import heapq
+import json
+import threading
+import time
+import urlparse
+from argparse import ArgumentParser
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from . import QueryIterator, CursorQueryIterator
+
+
+def get_args():
+    ap = ArgumentParser(description="Benchmark Solr paging strategies")
+    ap.add_argument('--num-docs', dest='num_docs', type=int, default=200000)
+    ap.add_argument('--text-bytes', dest='text_bytes', type=int, default=2000,
+                    help="Size of the html_en field of each document")
+    ap.add_argument('--rows', dest='rows', type=int, default=100,
+                    help="Page size for QueryIterator")
+    ap.add_argument('--max-rows', dest='max_rows', type=int, default=2000,
+                    help="Largest page size for CursorQueryIterator")
+    ap.add_argument('--work-ms', dest='work_ms', type=float, default=0.0,
+                    help="Simulated per-document processing time")
+    ap.add_argument('--port', dest='port', type=int, default=0)
+    return ap.parse_args()
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def stub_handler(ids, text):
+    """
+    Build a request handler serving /solr/main/select over the given IDs.
+
+    :type ids: list
+    :param ids: The document IDs in the result set
+
+    :type text: string
+    :param text: The html_en value for every document
+    """
+    class SolrStubHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            params = dict(urlparse.parse_qsl(urlparse.urlparse(self.path).query))
+            rows = int(params.get('rows', 10))
+            cursor = params.get('cursorMark')
+            if cursor is None:
+                start = int(params.get('start', 0))
+                page = heapq.nsmallest(start + rows, ids)[start:]
+                body = {}
+            else:
+                after = '' if cursor == '*' else cursor
+                page = heapq.nsmallest(rows, (i for i in ids if i > after))
+                body = {'nextCursorMark': page[-1] if page else cursor}
+            body['response'] = {
+                'numFound': len(ids),
+                'docs': [{'id': i, 'wid': i.split('_')[0], 'html_en': text}
+                         for i in page]}
+            payload = json.dumps(body)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+    return SolrStubHandler
+
+
+def start_stub(num_docs, text_bytes, port=0):
+    """
+    Start the Solr stub on a background thread.
+
+    :rtype: tuple
+    :return: The server and the core URL to query
+    """
+    ids = ['%d_%d' % (831, i) for i in range(num_docs)]
+    server = ThreadedHTTPServer(('127.0.0.1', port),
+                                stub_handler(ids, 'x' * text_bytes))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d/solr/main/' % server.server_port
+
+
+def consume(iterator, work_ms):
+    """
+    Drain an iterator, optionally sleeping per document.
+
+    :rtype: tuple
+    :return: The number of documents and the elapsed seconds
+    """
+    start = time.time()
+    count = 0
+    for _ in iterator:
+        count += 1
+        if work_ms:
+            time.sleep(work_ms / 1000.0)
+    return count, time.time() - start
+
+
+def main():
+    args = get_args()
+    server, host = start_stub(args.num_docs, args.text_bytes, args.port)
+    options = {'query': '*:*', 'fields': 'id,wid,html_en', 'sort': 'id asc',
+               'rows': args.rows}
+    try:
+        for name, iterator in [
+                ('start/rows', lambda: QueryIterator(host, options)),
+                ('cursorMark', lambda: CursorQueryIterator(
+                    host, options, max_rows=args.max_rows))]:
+            count, elapsed = consume(iterator(), args.work_ms)
+            print "%-12s %8d docs in %8.2fs (%.0f docs/sec)" % (
+                name, count, elapsed, count / elapsed)
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,27 @@
-# TODO: use multiprocessing.Pool instead of Queue, since we only expect 4 (a
-# static number of) event files
-
 # Iterates over query queue files and writes text from queries specified in the
-# query queue files.
+# query queue files to append-only shards.
+#
+# Fetching is network-bound and cleaning is CPU-bound, so they run in separate
+# stages: a pool of fetch threads pages through Solr and queues batches of raw
+# documents, a process pool cleans the batches, and the main process writes
+# the results to shards. If cleaning or writing fails, the fetchers are told
+# to stop, so none is left blocked on the full batch queue, and the run's
+# event files are moved back to EVENT_DIR to be retried.
 
 import logging
 import os
 import shutil
 import sys
 import traceback
-from . import QueryIterator, clean_list
+from . import CursorQueryIterator, StageStats, clean_batch
+from .shards import ShardWriter
 from ... import ensure_dir_exists
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from optparse import OptionParser
-from time import sleep
+from Queue import Full, Queue
+from threading import Event, Thread
+from time import sleep, time
 
 # Set up logger
 logger = logging.getLogger(__name__)
@@ -24,56 +32,203 @@ logger.addHandler(logging.StreamHandler())
 parser = OptionParser()
 parser.add_option('-n', '--workers', dest='workers', type='int',
                   action='store', default=4,
-                  help='Specify the number of worker processes to open')
+                  help='Specify the number of cleaning processes to open')
+parser.add_option('-f', '--fetchers', dest='fetchers', type='int',
+                  action='store', default=4,
+                  help='Specify the number of Solr fetch threads')
+parser.add_option('-d', '--batch-docs', dest='batch_docs', type='int',
+                  action='store', default=200,
+                  help='Specify the number of documents per cleaning batch')
+parser.add_option('-r', '--max-rows', dest='max_rows', type='int',
+                  action='store', default=2000,
+                  help='Specify the largest Solr page size to request')
+parser.add_option('-s', '--shard-bytes', dest='shard_bytes', type='int',
+                  action='store', default=8 * 1024 * 1024,
+                  help='Specify the size at which a text shard is sealed')
 (options, args) = parser.parse_args()
 
 EVENT_DIR = ensure_dir_exists('/data/events/')
 TEMP_EVENT_DIR = ensure_dir_exists('/data/temp_events/')
-TEXT_DIR = ensure_dir_exists('/data/text/')
-TEMP_TEXT_DIR = ensure_dir_exists('/data/temp_text/')
+SHARD_DIR = ensure_dir_exists('/data/shards/')
+REPORT_INTERVAL = 60
+
+
+class Stopped(Exception):
+    pass
+
+
+def put_batch(batches, batch, stop):
+    """
+    Queue a batch, waiting for room until it's put or the writer stops
+
+    :type batches: class:`Queue.Queue`
+    :param batches: The queue feeding the cleaning pool
+
+    :type batch: list
+    :param batch: (doc ID, html) tuples
+
+    :type stop: class:`threading.Event`
+    :param stop: Set when nothing will read from the queue any more
+    """
+    while not stop.is_set():
+        try:
+            batches.put(batch, timeout=1)
+            return
+        except Full:
+            continue
+    raise Stopped()
 
 
-def write_text(event_file):
+def fetch_text(batches, stats, stop, event_file):
     """
-    Write text from Solr queries in an event file to TEXT_DIR
+    Queue batches of raw documents from Solr queries in an event file
+
+    :type batches: class:`Queue.Queue`
+    :param batches: The queue feeding the cleaning pool
+
+    :type stats: class:`wikia_dstk.pipeline.event.StageStats`
+    :param stats: Throughput counters
+
+    :type stop: class:`threading.Event`
+    :param stop: Set when the writer has given up, so fetching should too
 
     :type event_file: string
     :param event_file: Path to the event file containing Solr queries
 
-    :rtype: string
-    :return: A string indicating the name of the completed event file
+    :rtype: tuple
+    :return: The path the event file was moved to (None on failure) and a
+             status string
     """
     try:
+        if stop.is_set():
+            # still in EVENT_DIR, so the next run picks it up
+            raise Stopped()
         temp_event_file = os.path.join(
             TEMP_EVENT_DIR, os.path.basename(event_file))
         shutil.move(event_file, temp_event_file)
+        batch = []
         for line in open(temp_event_file):
             query = line.strip()
-            logger.info('Writing query: "%s"' % query)
-            qi = QueryIterator(
+            logger.info('Fetching query: "%s"' % query)
+            qi = CursorQueryIterator(
                 'http://search-9.prod.wikia.net:8983/solr/main/',
                 {'query': query, 'fields': 'id,wid,html_en,indexed',
-                 'sort': 'id asc'})
-            for doc in qi:
-                if doc['id'].count('_') > 1:
-                    # i love adding logic to my scripts just to avoid garbage, thanks guys
-                    continue
-                # Sanitize and write text
-                text = '\n'.join(clean_list(doc.get('html_en', '')))
-                localpath = os.path.join(TEXT_DIR, doc['id'])
-                logger.debug('Writing text from %s to %s' % (doc['id'],
-                                                             localpath))
-                with open(localpath, 'w') as f:
-                    f.write(text)
-        os.remove(temp_event_file)
-        return 'Finished event file %s' % event_file
+                 'sort': 'id asc'}, max_rows=options.max_rows)
+            try:
+                for doc in qi:
+                    if doc['id'].count('_') > 1:
+                        # i love adding logic to my scripts just to avoid garbage, thanks guys
+                        continue
+                    batch.append((doc['id'], doc.get('html_en', '')))
+                    stats.add('fetched')
+                    if len(batch) >= options.batch_docs:
+                        put_batch(batches, batch, stop)
+                        batch = []
+            finally:
+                # otherwise its prefetch thread blocks on a full page queue
+                qi.close()
+        if batch:
+            put_batch(batches, batch, stop)
+        return temp_event_file, 'Fetched event file %s' % event_file
     except KeyboardInterrupt:
         sys.exit(0)
+    except Stopped:
+        # requeued by the main loop, since its text didn't all get written
+        return None, 'Stopped fetching %s' % event_file
     except:
-        return '%s: %s' % (event_file, traceback.format_exc())
+        return None, '%s: %s' % (event_file, traceback.format_exc())
+
+
+def iterate_batches(batches):
+    """
+    Yield batches from a queue until the None sentinel arrives
+    """
+    while True:
+        batch = batches.get()
+        if batch is None:
+            return
+        yield batch
+
+
+def write_text(event_files, clean_pool):
+    """
+    Write cleaned text from Solr queries in event files to shards in SHARD_DIR
+
+    :type event_files: list
+    :param event_files: Paths to event files containing Solr queries
+
+    :type clean_pool: class:`multiprocessing.Pool`
+    :param clean_pool: The process pool that cleans text
+
+    :rtype: list
+    :return: Status strings for each event file
+    """
+    stats = StageStats(['fetched', 'cleaned'])
+    # bounded, so fetchers wait rather than buffering a whole wiki in memory
+    batches = Queue(maxsize=options.workers * 2)
+    stop = Event()
+    fetch_pool = ThreadPool(processes=options.fetchers)
+    fetching = fetch_pool.map_async(
+        lambda event_file: fetch_text(batches, stats, stop, event_file),
+        event_files)
+
+    def close_batches():
+        fetching.wait()
+        # even after a failure, the clean pool's task handler is still
+        # reading batches, and needs the sentinel to finish
+        batches.put(None)
+
+    closer = Thread(target=close_batches)
+    closer.daemon = True
+    closer.start()
+
+    writer = ShardWriter(SHARD_DIR, max_bytes=options.shard_bytes,
+                         prefix='%d_' % os.getpid())
+    last_report = time()
+    try:
+        for cleaned in clean_pool.imap_unordered(clean_batch,
+                                                 iterate_batches(batches)):
+            for doc_id, text in cleaned:
+                writer.write(doc_id, text)
+            stats.add('cleaned', len(cleaned))
+            if time() - last_report > REPORT_INTERVAL:
+                logger.info('%s; %d batches waiting to be cleaned' % (
+                    stats.report(), batches.qsize()))
+                last_report = time()
+        writer.close()
+    finally:
+        # a no-op once the last shard is sealed
+        writer.abort()
+        stop.set()
+        fetch_pool.close()
+        # so no fetcher is still moving event files once we return
+        fetch_pool.join()
+    logger.info(stats.report())
+
+    statuses = []
+    for temp_event_file, status in fetching.get():
+        if temp_event_file is not None:
+            os.remove(temp_event_file)
+        statuses.append(status)
+    return statuses
+
+
+def requeue(event_files):
+    """
+    Move event files from a failed run back to EVENT_DIR to be retried
+
+    :type event_files: list
+    :param event_files: Paths to the run's event files in EVENT_DIR
+    """
+    for event_file in event_files:
+        temp_event_file = os.path.join(
+            TEMP_EVENT_DIR, os.path.basename(event_file))
+        if os.path.exists(temp_event_file):
+            shutil.move(temp_event_file, event_file)
 
 
 if __name__ == '__main__':
+    clean_pool = Pool(processes=options.workers)
     while True:
         # List of query queue files to iterate over
         event_files = [os.path.join(EVENT_DIR, event_file) for event_file in
@@ -86,6 +241,11 @@ if __name__ == '__main__':
             sleep(60)
             continue
 
-        for status in Pool(processes=options.workers).map(write_text,
-                                                          event_files):
-            print status
+        try:
+            for status in write_text(event_files, clean_pool):
+                print status
+        except Exception:
+            logger.error('Failed writing text, requeueing %i event files: %s'
+                         % (len(event_files), traceback.format_exc()))
+            requeue(event_files)
+            sleep(60)
@@ -0,0 +1,163 @@
+"""
+Builds gzipped tarballs of text files and streams them to S3 as they are
+compressed, so a batch never touches the disk again after its source files
+are read.
+"""
+
+import gzip
+import os
+import tarfile
+from cStringIO import StringIO
+from .shards import is_shard, iter_records
+
+MIN_PART_SIZE = 5 * 1024 * 1024  # S3 rejects smaller parts, except the last
+
+
+class MultipartUploadWriter(object):
+    """
+    A write-only file object that uploads its contents to an S3 key in
+    multipart chunks as they accumulate.
+    """
+
+    def __init__(self, bucket, key_name, part_size=MIN_PART_SIZE):
+        """
+        :type bucket: class:`boto.s3.bucket.Bucket`
+        :param bucket: The bucket to upload to
+
+        :type key_name: string
+        :param key_name: The key to create
+
+        :type part_size: int
+        :param part_size: The number of bytes to buffer before uploading a part
+        """
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.upload = bucket.initiate_multipart_upload(key_name)
+        self.buffer = StringIO()
+        self.part_num = 0
+        self.written = 0
+
+    def write(self, data):
+        self.buffer.write(data)
+        self.written += len(data)
+        if self.buffer.tell() >= self.part_size:
+            self._upload_part()
+
+    def tell(self):
+        return self.written
+
+    def flush(self):
+        pass
+
+    def _upload_part(self):
+        self.part_num += 1
+        self.buffer.seek(0)
+        self.upload.upload_part_from_file(self.buffer, self.part_num)
+        self.buffer = StringIO()
+
+    def close(self):
+        """
+        Upload whatever is buffered and complete the multipart upload.
+        """
+        if self.buffer.tell() or not self.part_num:
+            self._upload_part()
+        self.upload.complete_upload()
+
+    def cancel(self):
+        """
+        Abort the upload so S3 discards the parts sent so far.
+        """
+        self.upload.cancel_upload()
+
+
+def select_batch(files, batch_bytes):
+    """
+    Take files from the front of a list until their sizes reach batch_bytes.
+
+    :type files: list
+    :param files: Filepaths, in the order they should be packaged
+
+    :type batch_bytes: int
+    :param batch_bytes: The target uncompressed size of a batch
+
+    :rtype: tuple
+    :return: The selected filepaths and their total size in bytes
+    """
+    batch = []
+    total = 0
+    for path in files:
+        if total >= batch_bytes:
+            break
+        try:
+            total += os.path.getsize(path)
+        except OSError:
+            continue  # removed since the directory was listed
+        batch.append(path)
+    return batch, total
+
+
+def stream_tarball(bucket, key_name, paths, compresslevel=6,
+                   part_size=MIN_PART_SIZE):
+    """
+    Package files into a .tgz on S3, compressing and uploading as it reads.
+
+    Shard files are expanded so that each of their records becomes its own
+    member. The source files are read exactly once and are left in place; the
+    caller removes them once this returns.
+
+    :type bucket: class:`boto.s3.bucket.Bucket`
+    :param bucket: The bucket to upload to
+
+    :type key_name: string
+    :param key_name: The key for the tarball
+
+    :type paths: list
+    :param paths: Shards, or text files to store under their base names
+
+    :type compresslevel: int
+    :param compresslevel: The gzip compression level, 1-9
+
+    :type part_size: int
+    :param part_size: The multipart upload part size in bytes
+
+    :rtype: int
+    :return: The number of compressed bytes uploaded
+    """
+    upload = MultipartUploadWriter(bucket, key_name, part_size)
+    try:
+        gz = gzip.GzipFile(filename='', mode='wb', fileobj=upload,
+                           compresslevel=compresslevel)
+        tar = tarfile.open(fileobj=gz, mode='w|')
+        for path in paths:
+            if is_shard(path):
+                add_shard(tar, path)
+                continue
+            with open(path, 'rb') as fl:
+                info = tar.gettarinfo(arcname=os.path.basename(path),
+                                      fileobj=fl)
+                tar.addfile(info, fl)
+        tar.close()
+        gz.close()
+        upload.close()
+    except:
+        upload.cancel()
+        raise
+    return upload.tell()
+
+
+def add_shard(tar, path):
+    """
+    Add each record in a shard to a tarball as a file named by its doc ID.
+
+    :type tar: class:`tarfile.TarFile`
+    :param tar: An open tarball
+
+    :type path: string
+    :param path: A sealed shard file
+    """
+    mtime = os.path.getmtime(path)
+    for doc_id, text in iter_records(path):
+        info = tarfile.TarInfo(doc_id)
+        info.size = len(text)
+        info.mtime = mtime
+        info.mode = 0644
+        tar.addfile(info, StringIO(text))
@@ -1,16 +1,13 @@
-# Iterates over files in the text directory, attempts to tar them in batches of
-# a specified size, optionally uploads them to S3, and cleans up the original
-# files.
+# Iterates over text files and sealed shards, streams them to S3 as gzipped
+# tarballs in batches of a specified size, and cleans up the original files.
 
 import logging
 import os
-import shutil
 import sys
-import tarfile
 import traceback
+from . import package, shards
 from ... import chrono_sort, ensure_dir_exists
 from boto.s3.connection import S3Connection
-from boto.s3.key import Key
 from optparse import OptionParser
 from time import sleep
 from uuid import uuid4
@@ -22,18 +19,38 @@ logger.addHandler(logging.StreamHandler())
 
 # Allow user to configure options
 parser = OptionParser()
-parser.add_option('-b', '--batchsize', dest='batchsize', type='int',
-                  action='store', default=500,
-                  help='Specify the maximum number of files in a .tgz batch')
+parser.add_option('-b', '--batch-bytes', dest='batch_bytes', type='int',
+                  action='store', default=8 * 1024 * 1024,
+                  help='Specify the uncompressed size of a .tgz batch in bytes')
+parser.add_option('-z', '--compression-level', dest='compression_level',
+                  type='int', action='store', default=6,
+                  help='Specify the gzip compression level (1-9)')
+parser.add_option('-p', '--part-size', dest='part_size', type='int',
+                  action='store', default=package.MIN_PART_SIZE,
+                  help='Specify the S3 multipart upload part size in bytes')
 (options, args) = parser.parse_args()
 
-BATCHSIZE = options.batchsize
+BATCH_BYTES = options.batch_bytes
 
 TEXT_DIR = ensure_dir_exists('/data/text/')
-TEMP_TEXT_DIR = ensure_dir_exists('/data/temp_text/')
+SHARD_DIR = ensure_dir_exists('/data/shards/')
 
 bucket = S3Connection().get_bucket('nlp-data')
 
+
+def list_sources():
+    """
+    List loose text files and sealed shards, oldest first.
+
+    :rtype: list
+    :return: A list of filepaths
+    """
+    sources = chrono_sort(TEXT_DIR) + [
+        source for source in chrono_sort(SHARD_DIR)
+        if shards.is_shard(source[0])]
+    sources.sort(key=lambda x: x[1])
+    return [path for path, _ in sources]
+
 if __name__ == '__main__':
 
     # Set to run indefinitely
@@ -41,60 +58,51 @@ if __name__ == '__main__':
 
         try:
             bypass_minimum = False
-            # Attempt to enforce minimum batch size, continue after 30 seconds
+            # Attempt to enforce minimum batch size, continue after 60 seconds
             # if not
-            logger.debug('Checking # of files in text directory...')
-            num_text_files = len(os.listdir(TEXT_DIR))
-            logger.info(
-                'There are %i files in the text directory.' % num_text_files)
-            if num_text_files == 0:
+            logger.debug('Checking size of text directory...')
+            text_files = list_sources()
+            _, text_bytes = package.select_batch(text_files, BATCH_BYTES)
+            logger.info('There are %i files (at least %i bytes) in the text '
+                        'directory.' % (len(text_files), text_bytes))
+            if not text_files:
                 logger.info(
                     'Waiting 60 seconds for text directory to populate...')
                 sleep(60)
                 continue
-            if num_text_files < BATCHSIZE:
-                logger.warning('Current batch does not meet %i file minimum,' +
-                               ' waiting for 60 seconds...' % BATCHSIZE)
+            if text_bytes < BATCH_BYTES:
+                logger.warning('Current batch does not meet %i byte minimum,'
+                               ' waiting for 60 seconds...' % BATCH_BYTES)
                 bypass_minimum = True
                 sleep(60)
             logger.info('Sorting text files chronologically.')
-            text_files = chrono_sort(TEXT_DIR)
-
-            for n in range(0, len(text_files), BATCHSIZE):
-                files_left = len(text_files) - n
-                if files_left < BATCHSIZE:
-                    if not bypass_minimum:
-                        logger.warning(
-                            'Exhausted chronological file list; refreshing.')
-                        break
-                # Move text files to temp directory
-                text_batch_dir = ensure_dir_exists(os.path.join(TEMP_TEXT_DIR,
-                                                                str(uuid4())))
-                for text_file in text_files[n:n+BATCHSIZE]:
-                    shutil.move(text_file[0],
-                                os.path.join(text_batch_dir,
-                                             os.path.basename(text_file[0])))
-                logger.info(
-                    'Moving batch to %s; %i files left.' % (text_batch_dir,
-                                                            files_left))
+            text_files = list_sources()
 
-                # Tar batch
-                tarball_path = text_batch_dir + '.tgz'
-                logger.info('Archiving batch to %s' % tarball_path)
-                tarball = tarfile.open(tarball_path, 'w:gz')
-                tarball.add(text_batch_dir, '.')
-                tarball.close()
+            while text_files:
+                batch, batch_bytes = package.select_batch(text_files,
+                                                          BATCH_BYTES)
+                text_files = text_files[len(batch):]
+                if batch_bytes < BATCH_BYTES and not bypass_minimum:
+                    logger.warning(
+                        'Exhausted chronological file list; refreshing.')
+                    break
+                if not batch:
+                    break
 
-                # Remove temp directory
-                shutil.rmtree(text_batch_dir)
+                # Stream batch to S3
+                key_name = 'bulk_events/%s.tgz' % str(uuid4())
+                logger.info('Streaming %i files (%i bytes) to %s; %i files '
+                            'left.' % (len(batch), batch_bytes, key_name,
+                                       len(text_files)))
+                uploaded = package.stream_tarball(
+                    bucket, key_name, batch,
+                    compresslevel=options.compression_level,
+                    part_size=options.part_size)
+                logger.info('Uploaded %i compressed bytes' % uploaded)
 
-                # Upload to S3
-                logger.info(
-                    'Uploading %s to S3' % os.path.basename(tarball_path))
-                k = Key(bucket)
-                k.key = 'bulk_events/%s' % os.path.basename(tarball_path)
-                k.set_contents_from_filename(tarball_path)
-                os.remove(tarball_path)
+                # Remove the packaged text
+                for text_file in batch:
+                    os.remove(text_file)
 
         except KeyboardInterrupt:
             sys.exit(0)
@@ -0,0 +1,121 @@
+"""
+Append-only shard files for extracted text.
+
+A shard is a sequence of records, each an 8-byte header holding the
+big-endian lengths of the document ID and the text, followed by both. Shards
+are written with a .part suffix and renamed once full, so readers only ever
+see complete shards.
+"""
+
+import os
+import struct
+from uuid import uuid4
+
+HEADER = struct.Struct('>II')
+SHARD_SUFFIX = '.shard'
+PART_SUFFIX = '.part'
+
+
+class ShardWriter(object):
+    """Appends documents to a rolling series of shard files."""
+
+    def __init__(self, directory, max_bytes=8 * 1024 * 1024, prefix=''):
+        """
+        :type directory: string
+        :param directory: Where to write shards
+
+        :type max_bytes: int
+        :param max_bytes: The size at which a shard is sealed
+
+        :type prefix: string
+        :param prefix: A prefix for shard filenames
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+        self.current = None
+        self.path = None
+        self.records = 0
+
+    def write(self, doc_id, text):
+        """
+        Append a document to the current shard.
+
+        :type doc_id: string
+        :param doc_id: The document ID, used as its filename downstream
+
+        :type text: string
+        :param text: The document text, as bytes
+        """
+        if isinstance(doc_id, unicode):
+            doc_id = doc_id.encode('utf-8')
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        if self.current is None:
+            self.path = os.path.join(self.directory, '%s%s%s%s' % (
+                self.prefix, uuid4(), SHARD_SUFFIX, PART_SUFFIX))
+            self.current = open(self.path, 'ab')
+        self.current.write(HEADER.pack(len(doc_id), len(text)))
+        self.current.write(doc_id)
+        self.current.write(text)
+        self.records += 1
+        if self.current.tell() >= self.max_bytes:
+            self.seal()
+
+    def seal(self):
+        """
+        Close the current shard and make it visible to readers.
+
+        :rtype: string
+        :return: The path of the sealed shard, or None if nothing was open
+        """
+        if self.current is None:
+            return None
+        self.current.close()
+        sealed = self.path[:-len(PART_SUFFIX)]
+        os.rename(self.path, sealed)
+        self.current = None
+        self.path = None
+        return sealed
+
+    def close(self):
+        return self.seal()
+
+    def abort(self):
+        """
+        Close and delete the current shard without sealing it, so a failed
+        run doesn't leave a .part file behind. Sealed shards are kept.
+        """
+        if self.current is None:
+            return
+        self.current.close()
+        os.remove(self.path)
+        self.current = None
+        self.path = None
+
+
+def iter_records(path):
+    """
+    Read the records of a shard in order.
+
+    :type path: string
+    :param path: A sealed shard file
+
+    :rtype: generator
+    :return: (doc_id, text) tuples
+    """
+    with open(path, 'rb') as fl:
+        while True:
+            header = fl.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            id_length, text_length = HEADER.unpack(header)
+            doc_id = fl.read(id_length)
+            text = fl.read(text_length)
+            if len(text) < text_length:
+                return  # truncated by a crash mid-write
+            yield doc_id, text
+
+
+def is_shard(path):
+    return path.endswith(SHARD_SUFFIX)
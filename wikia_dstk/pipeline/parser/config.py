@@ -9,5 +9,10 @@ default_config = {
     "tag": "parser",
     "threshold": 10,
     "max_size": 10,
-    "git_ref": "master"
+    "git_ref": "master",
+    "policy": "predictive",  # or "threshold" for the old behavior
+    "min_size": 0,
+    "deadline": 3600,  # seconds in which the queue should empty
+    "up_cooldown": 300,
+    "trace_file": ""
     }
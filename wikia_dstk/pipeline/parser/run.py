@@ -1,36 +1,92 @@
 # This script polls S3 to find new text batches to parse.
+#
+# The next tarball is fetched in the background once the text queue drops
+# below what the parser will get through in PREFETCH_SECONDS, judging by its
+# measured throughput, so the parser never waits on S3. Parsed XML is
+# uploaded by a pool of threads.
 
 import os
 import sys
 import tarfile
+import threading
 from ... import chrono_sort, ensure_dir_exists
 from ...loadbalancing import EC2Connection
 from boto import connect_s3
 from boto.s3.key import Key
 from boto.exception import S3ResponseError
 from boto.utils import get_instance_metadata
+from collections import deque
+from multiprocessing.pool import ThreadPool
 from socket import gethostname
 from subprocess import call
 from time import time, sleep
+from uuid import uuid4
 
 sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
 
 SIG = str(os.getpid()) + '_' + str(int(time()))
 TEXT_DIR = ensure_dir_exists('/tmp/text/')
 XML_DIR = ensure_dir_exists('/tmp/xml/')
-PACKAGE_DIR = ensure_dir_exists('/tmp/event_packages/')
 BUCKET_NAME = 'nlp-data'
 REGION = 'us-west-2'
+POLL_INTERVAL = 5
+REPORT_INTERVAL = 30
+PREFETCH_SECONDS = 120  # how long a tarball takes to arrive and unpack
+MIN_QUEUE = 10
+STALL_SECONDS = 150  # text waiting but nothing parsed for this long
+IDLE_POLL = 30  # how often to check S3 once it has come up empty
+UPLOADERS = 8
 
-s3_conn = connect_s3()
-bucket = s3_conn.get_bucket(BUCKET_NAME)
 hostname = gethostname()
 ec2_conn = EC2Connection(dict(region=REGION))
-stalling_increments = 0
+local = threading.local()
+
+
+def get_bucket():
+    """
+    boto connections aren't thread-safe, so each thread gets its own
+    """
+    if not hasattr(local, 'bucket'):
+        local.bucket = connect_s3().get_bucket(BUCKET_NAME)
+    return local.bucket
+
+
+class ThroughputMeter(object):
+    """Docs/sec over a sliding window of observed completions."""
+
+    def __init__(self, window=300):
+        """
+        :type window: int
+        :param window: The number of seconds to average over
+        """
+        self.window = window
+        self.events = deque()
+        self.started = time()
+        self.last_completion = time()
+
+    def add(self, count):
+        now = time()
+        if count:
+            self.events.append((now, count))
+            self.last_completion = now
+        while self.events and self.events[0][0] < now - self.window:
+            self.events.popleft()
+
+    def rate(self):
+        elapsed = min(time() - self.started, self.window)
+        if elapsed <= 0:
+            return 0.0
+        return sum([count for _, count in self.events]) / elapsed
 
 
 def add_files():
-    global hostname, bucket, PACKAGE_DIR, SIG, inqueue
+    """
+    Claim a tarball from the queue and unpack it into TEXT_DIR
+
+    :rtype: boolean
+    :return: True if a tarball was unpacked
+    """
+    bucket = get_bucket()
     print "[%s] Adding to text queue" % hostname
 
     keys = filter(lambda x: x.key.endswith('.tgz'),
@@ -47,7 +103,7 @@ def add_files():
         print "[%s] found key %s" % (hostname, old_key_name)
         # found a tar file, now try to capture it via move
         try:
-            new_key_name = '/parser_processing/'+SIG+'.tgz'
+            new_key_name = '/parser_processing/%s_%s.tgz' % (SIG, uuid4())
             key.copy(bucket, new_key_name)
             key.delete()
 
@@ -56,28 +112,61 @@ def add_files():
             # we'll just take the next key.
             continue
 
-        # now that it's been moved, pull it down
+        # now that it's been moved, unpack it straight from S3
         newkey = Key(bucket)
         newkey.key = new_key_name
-        newfname = PACKAGE_DIR+SIG+'.tgz'
-        newkey.get_contents_to_filename(newfname)
-
-        # untar that sucker
-        print "[%s] Unpacking %s" % (hostname, newfname)
-        tar = tarfile.open(newfname)
+        print "[%s] Unpacking %s" % (hostname, new_key_name)
+        tar = tarfile.open(fileobj=newkey, mode='r|gz')
         tar.extractall(TEXT_DIR)
         tar.close()
-        os.remove(newfname)
-        inqueue = len(os.listdir(TEXT_DIR))
+        newkey.close()
 
         # delete remnant data with extreme prejudice
         newkey.delete()
-
-        # at this point we want to get the list of keys all over again
         return True
     return False
 
 
+def upload_xml(xmlfile):
+    """
+    Upload a parsed XML file and remove it locally. A file that fails to
+    upload is kept, so the next pass retries it.
+
+    :type xmlfile: string
+    :param xmlfile: The name of a file in XML_DIR
+
+    :rtype: string
+    :return: The key it was uploaded to, or None if it wasn't an ID file or
+             couldn't be uploaded
+    """
+    id_data = tuple(xmlfile.replace('.xml', '').split('_'))
+    xmlfilename = XML_DIR+xmlfile
+    new_key = None
+    try:
+        if len(id_data) == 2:
+            new_key = '/xml/%s/%s.xml' % id_data
+            key = Key(get_bucket())
+            key.key = new_key
+            key.set_contents_from_filename(xmlfilename)
+        os.remove(xmlfilename)
+    except Exception as e:
+        # one failure shouldn't keep the rest of the batch out of the manifest
+        print "[%s] Couldn't upload %s: %s" % (hostname, xmlfile, e)
+        return None
+    return new_key
+
+
+def write_manifest(data_events):
+    """
+    Write uploaded keys to a new data_events file, if there are any
+    """
+    if not data_events:
+        return
+    event_key = Key(get_bucket())
+    event_key.key = '/data_events/%s_%s' % (SIG, uuid4())
+    event_key.set_contents_from_string("\n".join(data_events))
+
+
 def is_newest_older_than(duration):
     """
     Check whether the most recently modified file in TEXT_DIR is older than a
@@ -98,62 +187,75 @@ def is_newest_older_than(duration):
         return True
     return False
 
-while True:
-    for directory in [TEXT_DIR, XML_DIR, PACKAGE_DIR]:
-        if not os.path.exists(directory):
-            os.mkdir(directory)
-
-    inqueue = len(os.listdir(TEXT_DIR))
-
-    if inqueue < 10:
-        added = add_files()
-        # shut this instance down if we have an empty queue and we're above
-        # desired capacity
-        if (not added and len(os.listdir(XML_DIR)) == 0 and
-                is_newest_older_than(15)):
-            instances = ec2_conn.get_tagged_instances('parser')
-            print "[%s] Scaling down, shutting down." % hostname
-            current_id = get_instance_metadata()['instance-id']
-            if len(filter(lambda x: x == current_id, instances)) == 1:
-                ec2_conn.terminate([current_id])
-                sys.exit()
-
-    print "[%s] %d text files in queue..." % (hostname, inqueue)
-
-    data_events = []
-    xmlfiles = os.listdir(XML_DIR)
-
-    if len(xmlfiles) == 0:
-        stalling_increments += 1
-    else:
-        stalling_increments = 0
-
-    if stalling_increments == 5:
-        stalling_increments = 0
-        print("Restarting daemon and adding more files since it's being a " +
-              "slow douche.")
-        call("sv stop parser_daemon", shell=True)
-        call("killall java", shell=True)
-        call("sv start parser_daemon", shell=True)
-        print "Done with that. Now get to work!"
-
-    for xmlfile in xmlfiles:
-        key = Key(bucket)
-        id_data = tuple(xmlfile.replace('.xml', '').split('_'))
-        xmlfilename = XML_DIR+xmlfile
-        if len(id_data) == 2:
-            new_key = '/xml/%s/%s.xml' % id_data
-            key.key = new_key
-            data_events.append(new_key)
-            key.set_contents_from_filename(xmlfilename)
-        os.remove(xmlfilename)
 
-    print "[%s] Uploaded %d files (rate of %.2f docs/sec)" % (
-        hostname, len(xmlfiles), float(len(xmlfiles))/30.0)
+def restart_daemon():
+    print("Restarting daemon since it's being a slow douche.")
+    call("sv stop parser_daemon", shell=True)
+    call("killall java", shell=True)
+    call("sv start parser_daemon", shell=True)
+    print "Done with that. Now get to work!"
+
+
+def main():
+    meter = ThroughputMeter()
+    uploaders = ThreadPool(processes=UPLOADERS)
+    prefetcher = ThreadPool(processes=1)
+    prefetching = None
+    last_added = True
+    last_attempt = 0
+    last_report = time()
+    uploaded_since_report = 0
+
+    while True:
+        for directory in [TEXT_DIR, XML_DIR]:
+            ensure_dir_exists(directory)
+
+        # upload whatever the parser has finished
+        xmlfiles = os.listdir(XML_DIR)
+        data_events = filter(lambda x: x,
+                             uploaders.map(upload_xml, xmlfiles))
+        write_manifest(data_events)
+        meter.add(len(xmlfiles))
+        uploaded_since_report += len(xmlfiles)
+
+        if prefetching is not None and prefetching.ready():
+            try:
+                last_added = prefetching.get()
+            except Exception as e:
+                print "[%s] Prefetch failed: %s" % (hostname, e)
+                last_added = False
+            prefetching = None
+
+        # keep enough text queued to cover the time a new tarball takes
+        inqueue = len(os.listdir(TEXT_DIR))
+        watermark = max(MIN_QUEUE, int(meter.rate() * PREFETCH_SECONDS))
+        if inqueue < watermark and prefetching is None:
+            if last_added or time() - last_attempt > IDLE_POLL:
+                last_attempt = time()
+                prefetching = prefetcher.apply_async(add_files)
+            elif len(os.listdir(XML_DIR)) == 0 and is_newest_older_than(15):
+                # shut this instance down if we have an empty queue and
+                # we're above desired capacity
+                instances = ec2_conn.get_tagged_instances('parser')
+                print "[%s] Scaling down, shutting down." % hostname
+                current_id = get_instance_metadata()['instance-id']
+                if len(filter(lambda x: x == current_id, instances)) == 1:
+                    ec2_conn.terminate([current_id])
+                    sys.exit()
+
+        if inqueue and time() - meter.last_completion > STALL_SECONDS:
+            restart_daemon()
+            meter.last_completion = time()
+
+        if time() - last_report > REPORT_INTERVAL:
+            print "[%s] %d text files in queue..." % (hostname, inqueue)
+            print "[%s] Uploaded %d files (rate of %.2f docs/sec)" % (
+                hostname, uploaded_since_report, meter.rate())
+            uploaded_since_report = 0
+            last_report = time()
+
+        sleep(POLL_INTERVAL)
 
-    # write events to a new file
-    event_key = Key(bucket)
-    event_key.key = '/data_events/'+SIG
-    event_key.set_contents_from_string("\n".join(data_events))
 
-    sleep(30)  # don't want to bug the crap outta amazon
+if __name__ == '__main__':
+    main()
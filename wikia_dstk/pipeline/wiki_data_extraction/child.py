@@ -1,10 +1,11 @@
 import os
 import sys
 import traceback
-from multiprocessing import Pool
+from multiprocessing import Pool, cpu_count
 
 from nlp_services.caching import use_caching
 from config import config
+from scheduling import RuntimeHistory, build_chains, lpt_order
 from ... import log, get_argparser_from_config
 
 # we dump everything in here to be dynamic
@@ -15,22 +16,127 @@ from nlp_services.syntax import *
 from nlp_services.title_confirmation import *
 from nlp_services.authority import *
 
+# imported after the services so nothing in them can shadow it
+from time import time
+
 wiki_id = None
 
+# service pools by size, reused for every wiki this process runs
+pools = {}
+
 
 def get_args():
     ap = get_argparser_from_config(config)
     ap.add_argument('-w', '--wiki-id', dest='wiki_id', required=True,
                     help="The wiki ID to operate over")
+    ap.add_argument('--size', dest='size', type=int, default=None,
+                    help="The number of articles in the wiki, if known")
+    ap.add_argument('--processes', dest='processes', type=int,
+                    default=cpu_count(),
+                    help="The number of services to run at once")
     return ap.parse_known_args()
 
 
-def get_service(service):
-    log(wiki_id, service)
+def get_service(service, wid=None):
+    """
+    Call a service on a wiki, logging rather than raising failures
+
+    :type service: string
+    :param service: The name of a service class imported into this module
+
+    :type wid: string
+    :param wid: The wiki ID; defaults to the one set by main
+
+    :rtype: float
+    :return: The number of seconds the service took
+    """
+    wid = wiki_id if wid is None else wid
+    log(wid, service)
+    start = time()
     try:
-        getattr(sys.modules[__name__], service)().get(wiki_id)
+        getattr(sys.modules[__name__], service)().get(wid)
     except:
-        log(wiki_id, service, traceback.format_exc())
+        log(wid, service, traceback.format_exc())
+    return time() - start
+
+
+def run_chain(wid, chain):
+    """
+    Run services that depend on one another in order
+
+    :type wid: string
+    :param wid: The wiki ID
+
+    :type chain: list
+    :param chain: Service names, each depending on the ones before it
+
+    :rtype: list
+    :return: (service, seconds) tuples
+    """
+    return [(service, get_service(service, wid)) for service in chain]
+
+
+def configure_caching(services):
+    """
+    Configure write-only caching for the given services
+
+    :type services: list
+    :param services: Service names
+    """
+    caching_dict = dict([(service+'.get', {'write_only': True}) for service in
+                         services])
+    use_caching(per_service_cache=caching_dict)
+
+
+def get_pool(processes):
+    """
+    :type processes: int
+    :param processes: The number of services to run at once
+
+    :rtype: class:`multiprocessing.pool.Pool`
+    :return: This process's pool of that size, started on first use
+    """
+    if processes not in pools:
+        pools[processes] = Pool(processes=processes)
+    return pools[processes]
+
+
+def run_services(wid, services, size=None, processes=1, history_file=None):
+    """
+    Run each service on a wiki, longest expected first
+
+    Chains of services that don't depend on one another run concurrently
+    across up to `processes` processes; see scheduling.build_chains.
+
+    :type wid: string
+    :param wid: The wiki ID
+
+    :type services: list
+    :param services: Service names
+
+    :type size: int
+    :param size: The number of articles in the wiki, if known
+
+    :type processes: int
+    :param processes: The number of services to run at once
+
+    :type history_file: string
+    :param history_file: A JSON file of past runtimes to order by and update
+    """
+    log('Calling wiki-level services on %s' % wid)
+    history = RuntimeHistory(history_file or config['history_file'])
+    chains = lpt_order(build_chains(services), history, size)
+    start = time()
+    if processes > 1 and len(chains) > 1:
+        pool = get_pool(processes)
+        results = [pool.apply_async(run_chain, (wid, chain))
+                   for chain in chains]
+        timings = [timing for result in results for timing in result.get()]
+    else:
+        timings = [timing for chain in chains
+                   for timing in run_chain(wid, chain)]
+    log(wid, 'services finished in %.1fs' % (time() - start))
+    history.record(timings, size)
 
 
 def main():
@@ -40,17 +146,9 @@ def main():
     wiki_id = args.wiki_id
     services = args.services.split(',')
 
-    caching_dict = dict([(service+'.get', {'write_only': True}) for service in
-                         services])
-    use_caching(per_service_cache=caching_dict)
-
-    log('Calling wiki-level services on %s' % args.wiki_id)
-
-    #pool = Pool(processes=8)
-    #s = pool.map_async(get_service, services)
-    #s.wait()
-    for service in services:
-        get_service(service)
+    configure_caching(services)
+    run_services(wiki_id, services, size=args.size,
+                 processes=args.processes, history_file=args.history_file)
 
 
 if __name__ == '__main__':
@@ -15,5 +15,15 @@ config = {
         "TopHeadsService",
         "WpTopEntitiesService",
         "WpEntityDocumentCountsService"
-    ])
+    ]),
+    "history_file": "/home/ubuntu/service_runtimes.json"
 }
+
+# Services confirmed against nlp_services to read no other service's cached
+# output. Only these run concurrently; every other service runs in the order
+# given by "services", one after another, as they always have.
+INDEPENDENT_SERVICES = []
+
+# Services confirmed to read another service's cached output, mapped to the
+# service they must run after.
+SERVICE_DEPENDENCIES = {}
@@ -3,7 +3,8 @@ import json
 import requests
 from boto.ec2 import connect_to_region
 from wikia_dstk import get_argparser_from_config, argstring_from_namespace
-from ...loadbalancing import run_instances_lb
+from ...loadbalancing import run_instances_lb, run_instances_ws
+from ...loadbalancing.partition import PARTITIONERS
 from config import config
 
 
@@ -18,6 +19,12 @@ def get_args():
                     help="The Solr endpoint")
     ap.add_argument('-a', '--all', dest='all', action='store_true', default=False,
                     help="Index all wikis")
+    ap.add_argument('-p', '--partitioner', dest='partitioner', default='lpt',
+                    choices=sorted(PARTITIONERS.keys()),
+                    help="How to split wikis between instances")
+    ap.add_argument('-W', '--work-stealing', dest='work_stealing',
+                    action='store_true', default=False,
+                    help="Queue small chunks that idle instances can steal")
     return ap.parse_known_args()
 
 
@@ -74,14 +81,14 @@ def execute_old(args):
 
 
 def execute_all(args):
-    params = dict(wt='json', q='lang_s:en AND articles_i:[50 TO *]', rows=500, start=0, fields='articles_i, id')
+    params = dict(wt='json', q='lang_s:en AND articles_i:[50 TO *]', rows=500, start=0, fl='articles_i,id')
     return_data = []
     while True:
         response = requests.get('%s/xwiki/select' % args.solr_endpoint, params=params).json()
         return_data += [(doc['id'], doc['articles_i']) for doc in response['response']['docs']]
         if response['response']['numFound'] <= params['start'] + params['rows']:
             return_dict = dict(return_data)
-            return return_dict, return_dict.values()
+            return return_dict, return_dict.keys()
         params['start'] += params['rows']
 
 
@@ -106,10 +113,17 @@ git fetch origin
 git checkout {git_ref}
 git pull origin {git_ref} && sudo python setup.py install
 cd /home/ubuntu
-python -m wikia_dstk.pipeline.wiki_data_extraction.run --s3path={{key}} {argstring} 2>&1 | tee -a /home/ubuntu/wiki_data_extraction.log""".format(git_ref=args.git_ref, argstring=argstring_from_namespace(args, extras))
+python -m wikia_dstk.pipeline.wiki_data_extraction.run --{source}={{key}} {argstring} 2>&1 | tee -a /home/ubuntu/wiki_data_extraction.log""".format(git_ref=args.git_ref, argstring=argstring_from_namespace(args, extras),
+           source='work-queue' if args.work_stealing else 's3path')
 #python -m wikia_dstk.pipeline.wiki_data_extraction.test_log &> /home/ubuntu/test.log""".format(git_ref=args.git_ref)
-    instances = run_instances_lb(
-        wids, callback, num_instances, user_data, config)
+    if args.work_stealing:
+        instances = run_instances_ws(
+            wids, callback, num_instances, user_data, config,
+            strategy=args.partitioner)
+    else:
+        instances = run_instances_lb(
+            wids, callback, num_instances, user_data, config,
+            with_weights=True, strategy=args.partitioner)
     instance_ids = [i for i in instances.get() for i in i]
     conn = connect_to_region('us-west-2')
     conn.create_tags(instance_ids, {'Name': args.tag, 'type': 'wiki_data_extraction'})
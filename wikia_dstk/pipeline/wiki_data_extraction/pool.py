@@ -0,0 +1,218 @@
+"""
+A pre-forked pool of workers that run wiki-level services.
+
+nlp_services is imported once, in the parent, and workers are forked from it,
+so a wiki costs a fork rather than a fresh interpreter. Each worker runs one
+wiki at a time; a worker that crashes or runs past the per-wiki timeout is
+killed and replaced without affecting the others. Every worker has its own
+task queue and its own pipe to report on, so killing one can't leave a lock
+held that the others need.
+"""
+
+import os
+import signal
+import traceback
+from collections import deque
+from multiprocessing import Pipe, Process, Queue, active_children, cpu_count
+from select import select
+from time import time
+from . import child
+from ... import log
+
+
+def exit_on_term(signum, frame):
+    """
+    Take any service processes down with the worker when it's killed
+    """
+    for process in active_children():
+        process.terminate()
+    os._exit(1)
+
+
+def worker_loop(slot, tasks, events, services, processes=1,
+                history_file=None):
+    """
+    Take (wiki ID, size) tasks from this worker's queue until a None arrives
+
+    :type slot: int
+    :param slot: The worker's slot number, reported with each event
+
+    :type tasks: class:`multiprocessing.Queue`
+    :param tasks: Wiki IDs and sizes assigned to this worker
+
+    :type events: class:`multiprocessing.Connection`
+    :param events: The write end of this worker's pipe, to report completions
+
+    :type services: list
+    :param services: Service names to run on each wiki
+
+    :type processes: int
+    :param processes: The number of services to run at once per wiki
+
+    :type history_file: string
+    :param history_file: The service runtime history to order services by
+    """
+    signal.signal(signal.SIGTERM, exit_on_term)
+    child.configure_caching(services)
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        wid, size = task
+        try:
+            child.run_services(wid, services, size=size, processes=processes,
+                               history_file=history_file)
+            events.send((slot, wid, True))
+        except:
+            log(wid, traceback.format_exc())
+            events.send((slot, wid, False))
+
+
+class WikiWorkerPool(object):
+    """Runs child.run_services for each submitted wiki ID."""
+
+    def __init__(self, services, workers=8, timeout=3600, processes=None,
+                 history_file=None):
+        """
+        :type services: list
+        :param services: Service names to run on each wiki
+
+        :type workers: int
+        :param workers: The number of worker processes
+
+        :type timeout: int
+        :param timeout: Seconds a single wiki may take before its worker is
+                        killed
+
+        :type processes: int
+        :param processes: The number of services each worker runs at once;
+                          by default the CPUs are split evenly between workers,
+                          which is 1 unless there are more CPUs than workers
+
+        :type history_file: string
+        :param history_file: The service runtime history to order services by
+        """
+        self.services = services
+        self.num_workers = workers
+        self.timeout = timeout
+        if processes is None:
+            processes = max(1, cpu_count() // workers)
+        self.processes = processes
+        self.history_file = history_file
+        self.queue = deque()
+        self.workers = {}  # slot -> (process, task queue, event pipe)
+        self.running = {}  # slot -> (wid, start time)
+        self.failed = []
+
+    def start(self):
+        for slot in range(self.num_workers):
+            self.spawn(slot)
+        return self
+
+    def spawn(self, slot):
+        if slot in self.workers:
+            # whatever the old worker left in its pipe is stale
+            self.workers[slot][2].close()
+        tasks = Queue()
+        events, worker_events = Pipe(duplex=False)
+        worker = Process(target=worker_loop,
+                         args=(slot, tasks, worker_events, self.services,
+                               self.processes, self.history_file))
+        worker.start()
+        # only the worker writes, so we see EOF once it's gone
+        worker_events.close()
+        self.workers[slot] = (worker, tasks, events)
+
+    def submit(self, wid, size=None):
+        self.queue.append((wid, size))
+        self.dispatch()
+
+    def dispatch(self):
+        """
+        Hand queued wiki IDs to idle workers
+        """
+        for slot, (_, tasks, _) in self.workers.items():
+            if not self.queue:
+                return
+            if slot not in self.running:
+                wid, size = self.queue.popleft()
+                self.running[slot] = (wid, time())
+                tasks.put((wid, size))
+
+    def finish(self, slot, wid, succeeded):
+        if slot not in self.running or self.running[slot][0] != wid:
+            # a late report from a worker that has since been replaced
+            return
+        del self.running[slot]
+        if not succeeded:
+            self.failed.append(wid)
+
+    def replace(self, slot, reason):
+        wid, _ = self.running[slot]
+        log('Worker for', wid, reason, '- replacing it')
+        worker, _, _ = self.workers[slot]
+        if worker.is_alive():
+            worker.terminate()
+        worker.join()
+        self.finish(slot, wid, False)
+        self.spawn(slot)
+
+    def poll(self, wait=1):
+        """
+        Process completions, replace crashed or timed-out workers, and hand
+        out more work
+
+        :type wait: int
+        :param wait: Seconds to wait for the first completion
+        """
+        pipes = [events for _, _, events in self.workers.values()]
+        while pipes:
+            ready = select(pipes, [], [], wait)[0]
+            if not ready:
+                break
+            wait = 0
+            for events in ready:
+                try:
+                    slot, wid, succeeded = events.recv()
+                except (EOFError, IOError):
+                    # the worker is gone; it's replaced below
+                    pipes.remove(events)
+                    continue
+                self.finish(slot, wid, succeeded)
+
+        now = time()
+        for slot, (worker, _, _) in self.workers.items():
+            if slot in self.running:
+                wid, started = self.running[slot]
+                if not worker.is_alive():
+                    self.replace(slot, 'crashed')
+                elif now - started > self.timeout:
+                    self.replace(slot, 'timed out')
+            elif not worker.is_alive():
+                self.spawn(slot)
+        self.dispatch()
+
+    def busy(self):
+        return bool(self.queue or self.running)
+
+    def wait(self):
+        """
+        Block until every submitted wiki has finished or failed
+        """
+        while self.busy():
+            self.poll()
+
+    def wait_for_room(self):
+        """
+        Block until every submitted wiki has been handed to a worker, so the
+        next workers to finish would sit idle unless more are submitted
+        """
+        while self.queue:
+            self.poll()
+
+    def close(self):
+        for _, tasks, _ in self.workers.values():
+            tasks.put(None)
+        for worker, _, events in self.workers.values():
+            worker.join()
+            events.close()
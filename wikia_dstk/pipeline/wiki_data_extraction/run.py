@@ -1,10 +1,11 @@
 from boto import connect_s3
 from boto.ec2 import connect_to_region
 from boto.utils import get_instance_metadata
-from subprocess import Popen
 from time import sleep
-from wikia_dstk import get_argparser_from_config, argstring_from_namespace
+from wikia_dstk import get_argparser_from_config
 from config import config
+from ...loadbalancing.worksteal import S3ChunkQueue
+from pool import WikiWorkerPool
 
 
 def get_args():
@@ -13,9 +14,35 @@ def get_args():
                     help="The location of the wikis file on S3")
     ap.add_argument('-q', '--queue', dest='event_queue',
                     help="The an event queue to poll for files")
+    ap.add_argument('--work-queue', dest='work_queue',
+                    help="This instance's home in a work-stealing queue, "
+                         "lb_queue/<job>/<node>")
+    ap.add_argument('--workers', dest='workers', type=int, default=8,
+                    help="The number of wikis to process at once")
+    ap.add_argument('--wiki-timeout', dest='wiki_timeout', type=int,
+                    default=3600,
+                    help="Seconds a single wiki may take before it's killed")
+    ap.add_argument('--processes', dest='processes', type=int, default=None,
+                    help="The number of services to run at once per wiki; "
+                         "defaults to CPUs // workers, which is 1 unless "
+                         "there are more CPUs than workers")
     return ap.parse_known_args()
 
 
+def parse_wid(token):
+    """
+    Split an event file token into a wiki ID and its size
+
+    :type token: string
+    :param token: A wiki ID, optionally followed by ':<article count>'
+
+    :rtype: tuple
+    :return: The wiki ID and its size, or None if the size wasn't given
+    """
+    wid, _, size = token.strip().partition(':')
+    return wid, int(size) if size else None
+
+
 def iterate_wids_from_args(args):
     bucket = connect_s3().get_bucket('nlp-data')
     while True:
@@ -23,10 +50,16 @@ def iterate_wids_from_args(args):
             k = bucket.get_key(args.s3path)
             if k is None:
                 raise StopIteration
-            wids = [wid.strip() for wid in
+            wids = [parse_wid(wid) for wid in
                     k.get_contents_as_string().split(',')]
             k.delete()
             yield wids
+        elif args.work_queue:
+            _, job, node = args.work_queue.strip('/').split('/')
+            queue = S3ChunkQueue(bucket, job)
+            for chunk in queue.iterate_chunks(node):
+                yield [parse_wid(wid) for wid in chunk.split(',')]
+            raise StopIteration
         elif args.event_queue:
             tmp_folder = (args.event_queue.strip('/').split('/')[0] +
                           '/processing/')
@@ -36,7 +69,7 @@ def iterate_wids_from_args(args):
                     key.copy('nlp-data', new_key)
                     key.delete()
                     new_key_contents = [
-                        wid.strip() for wid in
+                        parse_wid(wid) for wid in
                         bucket.get_key(new_key).get_contents_as_string().split(
                             "\n") if wid]
                     # probably want to do this after completion, but whatever
@@ -46,50 +79,46 @@ def iterate_wids_from_args(args):
                     continue
             raise StopIteration
         else:
-            raise Exception("Please specify either s3path or queue")
+            raise Exception("Please specify s3path, work-queue or queue")
+
+
+def report_failures(pool):
+    if pool.failed:
+        print "%d wikis failed: %s" % (len(pool.failed), ','.join(pool.failed))
+        pool.failed = []
 
 
 def main():
     #sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
     args, extras = get_args()
-    processes = []
+    pool = WikiWorkerPool(args.services.split(','), workers=args.workers,
+                          timeout=args.wiki_timeout,
+                          processes=args.processes,
+                          history_file=args.history_file).start()
     shutdown_counter = 0
     while True:
         for wids in iterate_wids_from_args(args):
             shutdown_counter = 0
             print "Working on %d wids" % len(wids)
-            while len(wids) > 0:
-                while len(processes) < 8:
-                    if wids:
-                        wid = wids.pop()
-                        print 'Launching child to process %s' % wid
-                        cmdstring = (
-                            ('/usr/bin/python -m ' +
-                             'wikia_dstk.pipeline.wiki_data_extraction.child' +
-                             ' --wiki-id=%s %s') % (
-                                str(wid), argstring_from_namespace(args,
-                                                                   extras)))
-                        processes.append(Popen(cmdstring, shell=True))
-                    else:
-                        print 'No more wiki IDs to iterate over'
-                        break
+            for wid, size in wids:
+                pool.submit(wid, size)
+            # fetch the next chunk while the last of this one is running,
+            # rather than letting workers idle until the slowest wiki is done
+            pool.wait_for_room()
+            report_failures(pool)
+        pool.wait()
+        report_failures(pool)
 
-                processes = filter(lambda x: x.poll() is None, processes)
-                sleep(5)
-
-        if len(processes) > 0:
-            print len(processes), "processes still running"
-            processes = filter(lambda x: x.poll() is None, processes)
-            sleep(30)
-        else:
-            shutdown_counter += 1
-            if shutdown_counter == 10:
-                print ("Waited five minutes with nothing in the queue, " +
-                       "shutting down")
-                current_id = get_instance_metadata()['instance-id']
-                ec2_conn = connect_to_region(args.region)
-                ec2_conn.terminate_instances([current_id])
-            sleep(30)
+        shutdown_counter += 1
+        if shutdown_counter == 10:
+            print ("Waited five minutes with nothing in the queue, " +
+                   "shutting down")
+            pool.close()
+            current_id = get_instance_metadata()['instance-id']
+            ec2_conn = connect_to_region(args.region)
+            ec2_conn.terminate_instances([current_id])
+            return
+        sleep(30)
 
 
 if __name__ == '__main__':
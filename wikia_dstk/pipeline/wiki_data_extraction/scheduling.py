@@ -0,0 +1,190 @@
+"""
+Cost-aware ordering of wiki-level services.
+
+Services are grouped into chains, where a service runs after whatever it
+depends on, and chains are started longest-expected-first (LPT) so the
+slowest service doesn't end up starting last. Services that haven't been
+confirmed independent stay in one chain, in the order they were given. Expected runtimes come from a
+JSON history of past runs, bucketed by wiki size.
+"""
+
+import fcntl
+import json
+import math
+import os
+from config import INDEPENDENT_SERVICES, SERVICE_DEPENDENCIES
+from ... import log
+
+DEFAULT_SECONDS = 60.0  # expected runtime of a service we've never timed
+SMOOTHING = 0.3
+
+
+def size_bucket(size):
+    """
+    Bucket a wiki by the base-2 logarithm of its article count
+
+    :type size: int
+    :param size: The number of articles, or None if unknown
+
+    :rtype: string
+    :return: The bucket key
+    """
+    if not size:
+        return 'unknown'
+    return str(int(math.log(size, 2)))
+
+
+class RuntimeHistory(object):
+    """Smoothed per-service runtimes, keyed by wiki size bucket."""
+
+    def __init__(self, path):
+        """
+        :type path: string
+        :param path: The JSON file to keep the history in
+        """
+        self.path = path
+        self.data = self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as fl:
+                return json.load(fl)
+        except (IOError, ValueError):
+            return {}
+
+    def expected(self, service, size):
+        """
+        Estimate how long a service will take on a wiki of the given size
+
+        Falls back to the nearest bucket we have timings for, scaled
+        linearly by size, and then to DEFAULT_SECONDS.
+
+        :type service: string
+        :param service: The service name
+
+        :type size: int
+        :param size: The number of articles, or None if unknown
+
+        :rtype: float
+        :return: The expected runtime in seconds
+        """
+        buckets = self.data.get(service, {})
+        bucket = size_bucket(size)
+        if bucket in buckets:
+            return buckets[bucket]
+        known = [int(b) for b in buckets if b != 'unknown']
+        if size and known:
+            nearest = min(known, key=lambda b: abs(b - int(bucket)))
+            return buckets[str(nearest)] * 2 ** (int(bucket) - nearest)
+        if buckets:
+            return sum(buckets.values()) / len(buckets)
+        return DEFAULT_SECONDS
+
+    def record(self, timings, size):
+        """
+        Fold new timings into the history file
+
+        Several workers share the file, so it's re-read under a lock and
+        replaced atomically rather than written from our own copy. Timings
+        that can't be written are logged and dropped; they only affect
+        ordering, so they shouldn't fail the wiki.
+
+        :type timings: list
+        :param timings: (service, seconds) tuples
+
+        :type size: int
+        :param size: The number of articles in the wiki the timings are for
+        """
+        bucket = size_bucket(size)
+        directory = os.path.dirname(self.path)
+        try:
+            if directory and not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    pass  # another worker made it first
+            with open(self.path + '.lock', 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                self.data = self.load()
+                for service, seconds in timings:
+                    buckets = self.data.setdefault(service, {})
+                    if bucket in buckets:
+                        seconds = (SMOOTHING * seconds +
+                                   (1 - SMOOTHING) * buckets[bucket])
+                    buckets[bucket] = seconds
+                with open(self.path + '.tmp', 'w') as fl:
+                    json.dump(self.data, fl)
+                os.rename(self.path + '.tmp', self.path)
+        except (IOError, OSError) as e:
+            log("Couldn't record service runtimes in", self.path, e)
+
+
+def build_chains(services, dependencies=SERVICE_DEPENDENCIES,
+                 independent=INDEPENDENT_SERVICES):
+    """
+    Group services so each one follows the services it depends on
+
+    Services in neither `dependencies` nor `independent` may depend on
+    anything, so they're kept in one chain in the order given.
+
+    :type services: list
+    :param services: Service names
+
+    :type dependencies: dict
+    :param dependencies: Maps a service to the service it must run after
+
+    :type independent: list
+    :param independent: Services known to depend on no other service
+
+    :rtype: list
+    :return: Lists of service names, each to be run in order
+    """
+    dependencies = dict(dependencies)
+    previous = None
+    for service in services:
+        if service in dependencies or service in independent:
+            continue
+        if previous is not None:
+            dependencies[service] = previous
+        previous = service
+    chains = []
+    chain_of = {}
+    pending = list(services)
+    while pending:
+        progressed = False
+        for service in list(pending):
+            dependency = dependencies.get(service)
+            if dependency in pending:
+                continue
+            if dependency in chain_of:
+                chain = chain_of[dependency]
+            else:
+                chain = []
+                chains.append(chain)
+            chain.append(service)
+            chain_of[service] = chain
+            pending.remove(service)
+            progressed = True
+        if not progressed:
+            raise ValueError('Circular service dependencies: %s' % pending)
+    return chains
+
+
+def lpt_order(chains, history, size):
+    """
+    Sort chains longest expected runtime first
+
+    :type chains: list
+    :param chains: Lists of service names
+
+    :type history: class:`RuntimeHistory`
+    :param history: Past runtimes
+
+    :type size: int
+    :param size: The number of articles in the wiki
+
+    :rtype: list
+    :return: The chains, in the order they should be started
+    """
+    cost = lambda chain: sum([history.expected(s, size) for s in chain])
+    return sorted(chains, key=cost, reverse=True)
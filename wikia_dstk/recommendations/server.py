@@ -1,4 +1,5 @@
 import numpy as np
+import os
 import time
 from collections import defaultdict
 from scipy.spatial.distance import cdist
@@ -7,12 +8,15 @@ from datetime import datetime
 from argparse import ArgumentParser, FileType
 from boto import connect_s3
 from ..lda import harakiri
+from ..lda.vector_store import TopicVectorStore, download_vector_store
 
 
 def get_args():
     ap = ArgumentParser()
     ap.add_argument('--infile', dest="infile", type=FileType('r'))
     ap.add_argument('--s3file', dest='s3file')
+    ap.add_argument('--vector-store', dest='vector_store',
+                    help="A topic vector store to read instead of a CSV; a local directory or a key prefix in nlp-data")
     ap.add_argument('--metric', dest="metric", default="cosine")
     ap.add_argument('--slice-size', dest='slice_size', default=100, type=int)
     ap.add_argument('--use-batches', dest='use_batches', action='store_true', default=False)
@@ -127,23 +131,32 @@ def to_csv(args, docid_to_topics):
 
 def main():
     args = get_args()
-    print "Scraping CSV"
     docid_to_topics = dict()
 
-    if args.s3file:
-        fname = args.s3file.split('/')[-1]
-        connect_s3().get_bucket('nlp-data').get_key(args.s3file).get_file(open(fname, 'w'))
-        fl = open(fname, 'r')
+    if args.vector_store:
+        print "Loading topic vectors"
+        path = args.vector_store
+        if not os.path.exists(path):
+            path = download_vector_store(connect_s3().get_bucket('nlp-data'), args.vector_store,
+                                         '/mnt/' + args.vector_store.strip('/').split('/')[-1])
+        for docid, row in TopicVectorStore(path).items():
+            docid_to_topics[docid] = row
     else:
-        fl = args.infile
-
-    for line in fl:
-        cols = line.strip().split(',')
-        docid = cols[0]
-        docid_to_topics[docid] = [0] * args.num_topics  # initialize
-        for col in cols[1:]:
-            topic, val = col.split('-')
-            docid_to_topics[docid][int(topic)] = float(val)
+        print "Scraping CSV"
+        if args.s3file:
+            fname = args.s3file.split('/')[-1]
+            connect_s3().get_bucket('nlp-data').get_key(args.s3file).get_file(open(fname, 'w'))
+            fl = open(fname, 'r')
+        else:
+            fl = args.infile
+
+        for line in fl:
+            cols = line.strip().split(',')
+            docid = cols[0]
+            docid_to_topics[docid] = [0] * args.num_topics  # initialize
+            for col in cols[1:]:
+                topic, val = col.split('-')
+                docid_to_topics[docid][int(topic)] = float(val)
 
     to_csv(args, docid_to_topics)
     harakiri()